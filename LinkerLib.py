@@ -6,7 +6,8 @@ sys.path.insert(0, tnopath)
 
 import numpy as np
 import pandas as pd
-from collections import namedtuple
+import numbers
+import json
 
 from datetime import datetime
 import time
@@ -25,27 +26,6 @@ from orbfitScript import degToHour, degToDMS
 import GammaTPlotwStatTNOExFaster as gts
 from Orbit import Orbit
 
-Det = namedtuple('Det', 'ra dec mjd mag objid ' +
-                        'expnum ccd band fakeid posErr lookAhead')
-# Returns the bounds of ra and dec as a string.
-class Region:
-    # fields include the range for RA / Dec and list of detections
-    def __init__(self, raRng, decRng):
-        self.raLo = raRng[0]
-        self.raHi = raRng[1]
-        self.decLo = decRng[0]
-        self.decHi = decRng[1]
-        self.detections = []
-        
-    def add(self, tno):
-        self.detections.append(tno)
-    
-    def toStr(self):
-        minbounds = '(minRa: ' + str(self.raLo) + ', minDec: ' + str(self.decLo) + ')'
-        maxbounds = '(maxRa: ' + str(self.raHi) + ', maxDec: ' + str(self.decHi) + ')'
-        return minbounds + '  ' + maxbounds 
-
-
 # Returns several variables and strings pertaining to detection information.
 #ra is between -180 and 180
 class Detection:
@@ -69,16 +49,26 @@ class Detection:
         self.fakeid = fakeid
         self.posErr = 0
         self.lookAhead = lookAhead
-        #describes a cone region that would contain possible pair links
-        #angle in radians where 0 is along the x-axis, where change in dec is 0
-        #angle1 < angle2
-        # is an array of angles and radii for each nite with index corresponding
-        # to the nite ahead
-        self.angle1, self.angle2, self.radius = gts.calcCone(lookAhead, 
-                        self.ra, self.dec, self.mjd)
+        #the cone (angle1, angle2, radius) is computed on first use, see __getattr__,
+        #with the lookAhead given here even if lookAhead is changed before then
+        self.coneLookAhead = lookAhead
         #list of linked detections (intially empty)
         self.linkedList = []
 
+    #describes a cone region that would contain possible pair links
+    #angle in radians where 0 is along the x-axis, where change in dec is 0
+    #angle1 < angle2
+    # is an array of angles and radii for each nite with index corresponding
+    # to the nite ahead
+    #only called when the cone has not been computed yet
+    def __getattr__(self, name):
+        if(name in ('angle1', 'angle2', 'radius')):
+            lookAhead = self.__dict__.get('coneLookAhead', self.lookAhead)
+            self.angle1, self.angle2, self.radius = gts.calcCone(lookAhead,
+                        self.ra, self.dec, self.mjd)
+            return self.__dict__[name]
+        raise AttributeError(name)
+
     # Computes and returns posErr (which is based upon magnitude).
     def getPosErr(self):
         err_sec = 0
@@ -140,6 +130,8 @@ class Detection:
         
     
     #checks if another detection is inside the cone
+    #withinCone_batch, withinCone_pairs and withinCone_rows do the same for many
+    #detections at once
     def withinCone(self, det):
         #time0 = time.time()
         nitesAhead = int(det.mjd - self.mjd)
@@ -186,20 +178,490 @@ class Detection:
             else:
                 return False
 
-    #returns the min/max ra/dec of the cone
-    def bounds(self): 
-        vertex1 = [self.ra, self.dec]
-        vertex2 = [self.ra + np.amax(self.radius)*np.cos(np.amax(self.angle1)),
-                    self.dec + np.amax(self.radius)*np.sin(np.amax(self.angle1))]
-        vertex3 = [self.ra + np.amax(self.radius)*np.cos(np.amin(self.angle2)), 
-                     self.dec + np.amax(self.radius)*np.sin(np.amin(self.angle2))] 
-        minRa = min(vertex1[0],vertex2[0],vertex3[0])
-        maxRa = max(vertex1[0],vertex2[0],vertex3[0]) 
-        minDec = min(vertex1[1],vertex2[1],vertex3[1]) 
-        maxDec = max(vertex1[1],vertex2[1],vertex3[1])
-        return minRa, maxRa, minDec, maxDec  
-
-#Fake class for linkmap efficiency
+# band names are stored in a DetectionCatalog as small integer codes
+BANDS = ['g', 'r', 'i', 'z', 'Y', 'u']
+
+# one row of a DetectionCatalog
+# mag and magerr are f8, not f4: they are written to the triplet files and
+# pickles and give the sigma of a detection without posErr, which have to
+# match what the csv reader always gave
+DET_DTYPE = np.dtype([('ra', 'f8'), ('dec', 'f8'), ('mjd', 'f8'),
+                      ('mag', 'f8'), ('magerr', 'f8'), ('objid', 'i8'),
+                      ('expnum', 'i4'), ('ccd', 'i2'), ('band', 'i1'),
+                      ('fakeid', 'i8'), ('posErr', 'f8')])
+
+'''
+input: --number of nites to look ahead
+       --arrays of ra, dec and mjd
+output: --angle1, angle2 and radius as (N, lookAhead) arrays, row i holding
+          what gts.calcCone gives for detection i
+          nites past the end of a shorter cone are left with a radius of 0,
+          so nothing is inside the cone on them
+'''
+def calcCones(lookAhead, ra, dec, mjd):
+    width = max(lookAhead, 0)
+    angle1 = np.zeros((len(ra), width))
+    angle2 = np.zeros((len(ra), width))
+    radius = np.zeros((len(ra), width))
+    for i in range(len(ra)):
+        cone = gts.calcCone(lookAhead, float(ra[i]), float(dec[i]), float(mjd[i]))
+        for out, values in zip([angle1, angle2, radius], cone):
+            values = np.asarray(values, dtype='f8')[:width]
+            out[i, :len(values)] = values
+    return angle1, angle2, radius
+
+# renames applied to the lower cased columns of a detection csv file
+CSV_RENAMES = {'snobjid': 'objid', 'snfake_id': 'fakeid', 'ccdnum': 'ccd'}
+
+# dtypes used to read the columns a DetectionCatalog needs (after renaming)
+# mag, flux and flux_err are read as f8 so mag and magerr come out as before
+CSV_DTYPES = {'ra': 'f8', 'dec': 'f8', 'mjd': 'f8', 'mag': 'f8',
+              'flux': 'f8', 'flux_err': 'f8', 'objid': 'i8', 'expnum': 'i4',
+              'ccd': 'i2', 'band': 'category', 'fakeid': 'i8',
+              'errawin_world': 'f8'}
+
+'''
+input: --csv file of detections (csvFile)
+       --the column names wanted after renaming, all of CSV_DTYPES if None
+output: --a dictionary from renamed column to the column name in the file,
+          only for the columns the file has
+'''
+def csvColumns(csvFile, wanted=None):
+    if(wanted is None):
+        wanted = CSV_DTYPES.keys()
+    columns = {}
+    for orig in pd.read_csv(csvFile, nrows=0).columns:
+        name = orig.lower()
+        name = CSV_RENAMES.get(name, name)
+        if(name in wanted):
+            columns[name] = orig
+    return columns
+
+# counts the rows of a csv file (not counting the header) without parsing it
+def countCsvRows(csvFile, blockSize=1<<24):
+    lines = 0
+    last = b'\n'
+    with open(csvFile, 'rb') as f:
+        block = f.read(blockSize)
+        while(block):
+            lines += block.count(b'\n')
+            last = block[-1:]
+            block = f.read(blockSize)
+    if(last != b'\n'):
+        lines += 1
+    return max(lines - 1, 0)
+
+# rebuilds a plain Detection from the fields of a catalog row (used for pickling)
+def _plainDetection(fields):
+    det = _Blank()
+    det.__class__ = Detection
+    det.__dict__.update(fields)
+    return det
+
+class _Blank:
+    pass
+
+# A light view of one row of a DetectionCatalog that behaves like a Detection.
+# Nothing is copied out of the catalog until an attribute is read.
+class CatalogDet(Detection, object):
+    erra = 0
+    errb = 0
+    pa = 0
+
+    def __init__(self, catalog, idx, lookAhead=None):
+        self.catalog = catalog
+        self.idx = idx
+        self.lookAhead = catalog.lookAhead if lookAhead is None else lookAhead
+        self.coneLookAhead = self.lookAhead
+
+    def _get(self, name):
+        return self.catalog.data[name][self.idx]
+
+    def _set(self, name, value):
+        self.catalog.data[name][self.idx] = value
+
+    ra = property(lambda self: float(self._get('ra')),
+                  lambda self, v: self._set('ra', v))
+    dec = property(lambda self: float(self._get('dec')),
+                   lambda self, v: self._set('dec', v))
+    mjd = property(lambda self: float(self._get('mjd')),
+                   lambda self, v: self._set('mjd', v))
+    mag = property(lambda self: float(self._get('mag')),
+                   lambda self, v: self._set('mag', v))
+    magerr = property(lambda self: float(self._get('magerr')),
+                      lambda self, v: self._set('magerr', v))
+    objid = property(lambda self: int(self._get('objid')))
+    expnum = property(lambda self: int(self._get('expnum')))
+    ccd = property(lambda self: int(self._get('ccd')))
+    fakeid = property(lambda self: int(self._get('fakeid')))
+    posErr = property(lambda self: float(self._get('posErr')),
+                      lambda self, v: self._set('posErr', v))
+    band = property(lambda self: self.catalog.bands[self._get('band')])
+    flux = property(lambda self: 10**((31.4-self.mag)/2.5))
+
+    # reads the cone from the catalog's bulk arrays when the lookAhead matches
+    def _cone(self, k):
+        if(self.coneLookAhead == self.catalog.lookAhead):
+            return self.catalog.cones([self.idx])[k][0]
+        return gts.calcCone(self.coneLookAhead, self.ra, self.dec, self.mjd)[k]
+
+    angle1 = property(lambda self: self._cone(0))
+    angle2 = property(lambda self: self._cone(1))
+    radius = property(lambda self: self._cone(2))
+
+    # same as Detection.getPosErr but does not write back into the catalog
+    def getPosErr(self):
+        if(self.mag <= 21):
+            return 0.1/3600
+        return (0.1 + 0.1*(self.mag-21)/3)/3600
+
+    def fields(self):
+        return {'ra': self.ra, 'dec': self.dec, 'mjd': self.mjd,
+                'mag': self.mag, 'flux': self.flux, 'magerr': self.magerr,
+                'objid': self.objid, 'expnum': self.expnum, 'ccd': self.ccd,
+                'band': self.band, 'fakeid': self.fakeid,
+                'posErr': self.posErr, 'lookAhead': self.lookAhead,
+                'coneLookAhead': self.coneLookAhead,
+                'erra': 0, 'errb': 0, 'pa': 0, 'linkedList': []}
+
+    # pickles as a plain Detection so saved triplets do not drag the catalog along
+    def __reduce__(self):
+        return (_plainDetection, (self.fields(),))
+
+# A columnar catalog of detections backed by one structured numpy array
+# (DET_DTYPE). Indexing by objid works like a dictionary from objid to
+# Detection, but lookups are a searchsorted on a sorted copy of the
+# objids and rows are only wrapped as CatalogDet views when asked for.
+class DetectionCatalog(object):
+    def __init__(self, data, bands=None, lookAhead=0):
+        # data is a structured array, or anything indexable by column name
+        self.data = data
+        self.bands = list(BANDS) if bands is None else list(bands)
+        self.lookAhead = lookAhead
+        self.size = len(data['objid'])
+        self._order = None
+        self._sortedIds = None
+        self._cones = None
+        self._coneDone = None
+
+    # makes the sorted objid index used by indexOf
+    def _buildIndex(self):
+        if(self._order is None):
+            self._order = np.argsort(self.data['objid'], kind='mergesort')
+            self._sortedIds = self.data['objid'][self._order]
+
+    def __len__(self):
+        return self.size
+
+    # returns a column of the catalog as a numpy array
+    def col(self, name):
+        return self.data[name]
+
+    # returns the catalog row of each objid, -1 where it is not in the catalog
+    def indexOf(self, objids):
+        self._buildIndex()
+        objids = np.asarray(objids, dtype='i8')
+        if(self.size == 0):
+            return np.full(objids.shape, -1, dtype='i8')
+        pos = np.searchsorted(self._sortedIds, objids)
+        pos = np.minimum(pos, self.size-1)
+        found = self._sortedIds[pos] == objids
+        return np.where(found, self._order[pos], -1)
+
+    '''
+    input: --rows to get the cones of, all rows if None (idx)
+    output: --angle1, angle2 and radius arrays of shape (len(idx), lookAhead)
+    '''
+    # cones are computed in bulk the first time a row is asked for and kept
+    def cones(self, idx=None):
+        if(self._cones is None or self._cones[3] != self.lookAhead):
+            width = max(self.lookAhead, 0)
+            self._cones = (np.zeros((self.size, width)),
+                    np.zeros((self.size, width)),
+                    np.zeros((self.size, width)), self.lookAhead)
+            self._coneDone = np.zeros(self.size, dtype=bool)
+        if(idx is None):
+            idx = np.arange(self.size)
+        idx = np.asarray(idx, dtype='i8')
+        todo = np.unique(idx[~self._coneDone[idx]])
+        if(len(todo) > 0):
+            angle1, angle2, radius = calcCones(self.lookAhead,
+                        self.data['ra'][todo], self.data['dec'][todo],
+                        self.data['mjd'][todo])
+            self._cones[0][todo] = angle1
+            self._cones[1][todo] = angle2
+            self._cones[2][todo] = radius
+            self._coneDone[todo] = True
+        return self._cones[0][idx], self._cones[1][idx], self._cones[2][idx]
+
+    # returns a Detection-like view of row idx
+    def row(self, idx):
+        return CatalogDet(self, int(idx))
+
+    # returns a list of views for an array of rows
+    def rows(self, idx):
+        return [CatalogDet(self, int(i)) for i in idx]
+
+    # returns a new catalog holding only the given rows
+    def take(self, idx):
+        data = np.empty(len(idx), dtype=DET_DTYPE)
+        for name in DET_DTYPE.names:
+            data[name] = self.data[name][idx]
+        return DetectionCatalog(data, self.bands, self.lookAhead)
+
+    # returns the band name of every row
+    def bandNames(self):
+        return np.array(self.bands, dtype=object)[self.data['band']]
+
+    # returns the code of a band name, adding it if it has not been seen
+    def bandCode(self, band):
+        if(band not in self.bands):
+            self.bands.append(band)
+        return self.bands.index(band)
+
+    # dictionary interface, keyed by objid
+    def __getitem__(self, objid):
+        idx = self.indexOf([objid])[0]
+        if(idx < 0):
+            raise KeyError(objid)
+        return self.row(idx)
+
+    def __contains__(self, objid):
+        return self.indexOf([objid])[0] >= 0
+
+    def get(self, objid, default=None):
+        idx = self.indexOf([objid])[0]
+        if(idx < 0):
+            return default
+        return self.row(idx)
+
+    def keys(self):
+        return self.data['objid']
+
+    def values(self):
+        return self.rows(range(self.size))
+
+    # iterating gives the detections in the order of the rows
+    def __iter__(self):
+        for idx in range(self.size):
+            yield CatalogDet(self, idx)
+
+    # returns the given columns as a pandas DataFrame
+    def toFrame(self, columns=None):
+        if(columns is None):
+            columns = list(DET_DTYPE.names)
+        frame = pd.DataFrame(dict((name, self.data[name]) for name in columns),
+                        columns=columns)
+        if('band' in columns):
+            frame['band'] = self.bandNames()
+        return frame
+
+    '''
+    input: --a pandas dataframe with the columns of a detection csv file
+           --lookAhead for the rows of the catalog
+    output: --a DetectionCatalog with the values a Detection of each row would have
+    '''
+    @classmethod
+    def fromDataFrame(cls, df, lookAhead=0, bands=None):
+        df = df.rename(columns=str.lower)
+        df = df.rename(columns=CSV_RENAMES)
+        catalog = cls(np.zeros(len(df), dtype=DET_DTYPE), bands, lookAhead)
+        catalog.fill(0, df)
+        return catalog
+
+    # writes the rows of dataframe df (columns already renamed) from row start
+    # returns the row after the last one written
+    def fill(self, start, df):
+        data = self.data
+        stop = start + len(df)
+        ra = df['ra'].values.astype('f8')
+        data['ra'][start:stop] = np.where(ra > 180, ra-360, ra)
+        data['dec'][start:stop] = df['dec'].values
+        data['mjd'][start:stop] = df['mjd'].values
+        # a mag column wins over flux, as it always has: the flux is taken as 0,
+        # so magerr is inf (nan where the truncated flux_err is 0)
+        if('mag' in df.columns):
+            flux = np.zeros(len(df))
+        else:
+            flux = df['flux'].values.astype('f8')
+        if('flux_err' in df.columns):
+            fluxErr = np.trunc(df['flux_err'].values.astype('f8'))
+        else:
+            fluxErr = np.full(len(df), 10.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mag = -2.5*np.log10(flux) + 31.4
+            magerr = np.abs(-2.5/np.log(10)*fluxErr/flux)
+        if('mag' in df.columns):
+            mag = df['mag'].values.astype('f8')
+        data['mag'][start:stop] = mag
+        data['magerr'][start:stop] = magerr
+        data['objid'][start:stop] = df['objid'].values
+        data['expnum'][start:stop] = df['expnum'].values
+        data['ccd'][start:stop] = df['ccd'].values
+        if(hasattr(df['band'], 'cat')):
+            names = df['band'].cat.categories.astype(str)
+            codes = df['band'].cat.codes.values
+        else:
+            names, codes = np.unique(df['band'].astype(str).values,
+                            return_inverse=True)
+        lookup = np.array([self.bandCode(name) for name in names], dtype='i1')
+        data['band'][start:stop] = lookup[codes.ravel()]
+        if('fakeid' in df.columns):
+            data['fakeid'][start:stop] = df['fakeid'].values
+        else:
+            data['fakeid'][start:stop] = 0
+        if('errawin_world' in df.columns):
+            data['posErr'][start:stop] = df['errawin_world'].values
+        else:
+            data['posErr'][start:stop] = 0
+        self._order = None
+        self._sortedIds = None
+        return stop
+
+    '''
+    input: --csv file of detections (csvFile)
+           --lookAhead for the rows of the catalog
+           --number of csv rows read at a time (chunkSize)
+    output: --a DetectionCatalog filled chunk by chunk, so only one chunk of
+              the csv is in memory next to the catalog at any time
+    '''
+    @classmethod
+    def fromCsv(cls, csvFile, lookAhead=0, chunkSize=1000000):
+        columns = csvColumns(csvFile)
+        dtypes = dict((orig, CSV_DTYPES[name]) for name, orig in columns.items())
+        size = countCsvRows(csvFile)
+        catalog = cls(np.zeros(size, dtype=DET_DTYPE), None, lookAhead)
+        renames = dict((orig, name) for name, orig in columns.items())
+        start = 0
+        reader = pd.read_csv(csvFile, usecols=list(columns.values()),
+                        dtype=dtypes, chunksize=chunkSize)
+        for chunk in reader:
+            chunk.rename(columns=renames, inplace=True)
+            if(start + len(chunk) > size):
+                raise ValueError('more rows in ' + csvFile + ' than counted')
+            start = catalog.fill(start, chunk)
+        if(start < size):
+            catalog.data = catalog.data[:start]
+            catalog.size = start
+        return catalog
+
+    # makes a catalog out of a list of Detection objects
+    @classmethod
+    def fromDetections(cls, dets, lookAhead=0):
+        catalog = cls(np.zeros(len(dets), dtype=DET_DTYPE), None, lookAhead)
+        data = catalog.data
+        for name in DET_DTYPE.names:
+            if(name == 'band'):
+                data[name] = [catalog.bandCode(det.band) for det in dets]
+            else:
+                data[name] = [getattr(det, name) for det in dets]
+        return catalog
+
+# returns ra, dec and mjd arrays for a catalog, a structured array or a list of detections
+def _detCoords(dets):
+    if(isinstance(dets, DetectionCatalog)):
+        dets = dets.data
+    if(isinstance(dets, list)):
+        ra = np.array([det.ra for det in dets], dtype='f8')
+        dec = np.array([det.dec for det in dets], dtype='f8')
+        mjd = np.array([det.mjd for det in dets], dtype='f8')
+    else:
+        ra = np.asarray(dets['ra'], dtype='f8')
+        dec = np.asarray(dets['dec'], dtype='f8')
+        mjd = np.asarray(dets['mjd'], dtype='f8')
+    return ra, dec, mjd
+
+'''
+input: --angle1, angle2 and radius of M anchors, each (M, lookAhead)
+       --lookAhead of the anchors
+       --ra, dec, mjd of the M anchors, each (M, 1)
+       --ra, dec, mjd of the candidates, (1, N) to test every anchor against
+         every candidate or (M, 1) to test anchor i against candidate i
+output: --boolean array of the broadcast shape, True where
+          Detection.withinCone would be
+'''
+def _coneMask(angle1, angle2, radius, lookAhead, ra0, dec0, mjd0, ra, dec, mjd):
+    shape = np.broadcast(ra0, ra).shape
+    if(lookAhead < 2 or angle1.shape[1] < 2):
+        return np.zeros(shape, dtype=bool)
+    # int() in withinCone truncates towards zero
+    nitesAhead = np.trunc(mjd - mjd0).astype('i8')
+    nitesAhead = np.broadcast_to(nitesAhead, shape)
+    valid = (nitesAhead + 1 < lookAhead) & (nitesAhead >= 0)
+    nite = np.clip(nitesAhead, 0, angle1.shape[1]-2)
+    # make sure ra is between -180 and 180
+    ra = np.where(ra > 180, ra - 360, ra)
+    deltaRa = ra - ra0
+    deltaDec = dec - dec0
+    dist = np.sqrt(deltaRa**2 + deltaDec**2)
+    angle = np.arctan2(deltaDec, deltaRa)
+    angle = np.where(angle < 0, angle + 2*np.pi, angle)
+    a1 = np.take_along_axis(angle1, nite, axis=1)
+    a1Next = np.take_along_axis(angle1, nite+1, axis=1)
+    a2 = np.take_along_axis(angle2, nite, axis=1)
+    a2Next = np.take_along_axis(angle2, nite+1, axis=1)
+    rev = a1 > a2
+    #a one night interval
+    lo = np.maximum(a1, a1Next)
+    hi = np.minimum(a2, a2Next)
+    rad = np.maximum(np.take_along_axis(radius, nite, axis=1),
+                     np.take_along_axis(radius, nite+1, axis=1))
+    inAngle = np.where(rev, (angle < lo) & (angle > hi),
+                        (angle < lo) | (angle > hi))
+    return valid & inAngle & (dist < rad)
+
+'''
+input: --a Detection whose cone is used (anchor)
+       --a DetectionCatalog, structured array or list of detections (candidates)
+output: --a boolean array, True for each candidate inside the anchor's cone
+'''
+# same result as calling anchor.withinCone on every candidate
+def withinCone_batch(anchor, candidates):
+    ra, dec, mjd = _detCoords(candidates)
+    angle1 = np.atleast_2d(np.asarray(anchor.angle1, dtype='f8'))
+    angle2 = np.atleast_2d(np.asarray(anchor.angle2, dtype='f8'))
+    radius = np.atleast_2d(np.asarray(anchor.radius, dtype='f8'))
+    mask = _coneMask(angle1, angle2, radius, anchor.lookAhead,
+                np.array([[anchor.ra]]), np.array([[anchor.dec]]),
+                np.array([[anchor.mjd]]), ra[None, :], dec[None, :],
+                mjd[None, :])
+    return mask[0]
+
+'''
+input: --a DetectionCatalog (catalog)
+       --rows of the anchors, e.g. one exposure block (anchorRows)
+       --rows of the candidates, e.g. a later exposure block (candRows)
+output: --(len(anchorRows), len(candRows)) boolean array, True where the
+          candidate is inside the anchor's cone
+'''
+def withinCone_pairs(catalog, anchorRows, candRows):
+    anchorRows = np.asarray(anchorRows, dtype='i8')
+    candRows = np.asarray(candRows, dtype='i8')
+    angle1, angle2, radius = catalog.cones(anchorRows)
+    data = catalog.data
+    return _coneMask(angle1, angle2, radius, catalog.lookAhead,
+                data['ra'][anchorRows][:, None], data['dec'][anchorRows][:, None],
+                data['mjd'][anchorRows][:, None], data['ra'][candRows][None, :],
+                data['dec'][candRows][None, :], data['mjd'][candRows][None, :])
+
+'''
+input: --a DetectionCatalog (catalog)
+       --equal length arrays of anchor rows and candidate rows
+output: --a boolean array, True where candRows[i] is inside the cone of anchorRows[i]
+'''
+def withinCone_rows(catalog, anchorRows, candRows):
+    anchorRows = np.asarray(anchorRows, dtype='i8')
+    candRows = np.asarray(candRows, dtype='i8')
+    if(len(anchorRows) == 0):
+        return np.zeros(0, dtype=bool)
+    angle1, angle2, radius = catalog.cones(anchorRows)
+    data = catalog.data
+    mask = _coneMask(angle1, angle2, radius, catalog.lookAhead,
+                data['ra'][anchorRows][:, None], data['dec'][anchorRows][:, None],
+                data['mjd'][anchorRows][:, None], data['ra'][candRows][:, None],
+                data['dec'][candRows][:, None], data['mjd'][candRows][:, None])
+    return mask[:, 0]
+
 class Fake(): 
     def __init__(self, fakeid, objid, mjd, exp, ccd, ra, dec, flux, band):
         self.fakeid = fakeid 
@@ -231,6 +693,34 @@ class Fake():
         return s
  
 
+
+# ephem.date of every mjd converted so far; detections of one exposure, and the
+# dates triplets are predicted at, share an mjd
+_ephemDates = {}
+
+'''
+input: --mjds, a list or array (mjds)
+output: --a list of ephem.date, one per mjd, converted as
+          ephem.date(Time(mjd, format='mjd').datetime) with one Time call for
+          all mjds not seen before
+'''
+def ephemDates(mjds):
+    mjds = np.asarray(mjds, dtype='f8').ravel().tolist()
+    new = sorted(set(mjd for mjd in mjds if mjd not in _ephemDates))
+    if(new):
+        for mjd, dt in zip(new, Time(new, format='mjd').datetime):
+            _ephemDates[mjd] = ephem.date(dt)
+    return [_ephemDates[mjd] for mjd in mjds]
+
+# Fits the orbits of all triplets that do not have one yet, converting the
+# dates of all their detections at once.
+def setOrbits(triplets):
+    triplets = [trip for trip in triplets if trip.orbit == 0]
+    ephemDates([det.mjd for trip in triplets for det in trip.dets])
+    for trip in triplets:
+        trip.setOrbit()
+    return triplets
+
 #class that stores triplets
 class Triplet:
     #input is array of detections
@@ -367,12 +857,12 @@ class Triplet:
         else:
             errs = 0.15 + (mag -21.0) / 40.0
         #time1 = time.time()
-        ralist = [ephem.hours(np.deg2rad(det.ra)) for det in self.dets]
+        ralist = [ephem.hours(x) for x in np.deg2rad([det.ra for det in self.dets]).tolist()]
         #print('ra:' + str(time.time()-time1))
         #time2 = time.time()
-        declist = [ephem.degrees(np.deg2rad(det.dec)) for det in self.dets]
+        declist = [ephem.degrees(x) for x in np.deg2rad([det.dec for det in self.dets]).tolist()]
         #print('dec:' + str(time.time()-time2))
-        datelist = [ephem.date((Time(det.mjd,format='mjd')).datetime) for det in self.dets]
+        datelist = ephemDates([det.mjd for det in self.dets])
         #time3 = time.time()
         #print('date:' + str(time3-time2))
         #time2 = time.time()i
@@ -409,7 +899,9 @@ class Triplet:
         if(len(self.dets) == 0):
             return 999999999
         if(self.chiSq == -1):
-            self.setOrbit()
+            # the orbit may already be fit, e.g. by setOrbits
+            if(self.orbit == 0):
+                self.setOrbit()
             self.chiSq = self.orbit.chisq 
         #return self.orbit.chisq
         return self.chiSq
@@ -420,21 +912,26 @@ class Triplet:
     '''
     # predicts the position of the triplet at a future date
     def predictPos(self, date):
-        date = ephem.date((Time(date, format='mjd')).datetime)
+        pos, erra, errb, pa = self.predictPositions([date])
+        return (pos[0][0], pos[0][1]), erra[0], errb[0], pa[0]
+
+    '''
+    input: dates in the format MJD
+    output: an array of (ra, dec) rows and arrays of the error ellipse (erra, errb, pa)
+    '''
+    # predicts the positions of the triplet at many dates, converting the dates at once
+    def predictPositions(self, dates):
         if(self.orbit==0):
             self.setOrbit()
         orbit = self.orbit
-        predPos = orbit.predict_pos(date)
-        ra = ephem.hours(predPos['ra'])
-        dec = ephem.degrees(predPos['dec'])
-        erra = predPos['err']['a']
-        errb = predPos['err']['b']
-        pa = predPos['err']['PA']
-        ra = np.degrees(ra)
-        if(ra > 180):
-            ra -= 360
-        dec = np.degrees(dec)
-        return (ra, dec), erra, errb, pa
+        preds = [orbit.predict_pos(date) for date in ephemDates(dates)]
+        ra = np.degrees([float(ephem.hours(pred['ra'])) for pred in preds])
+        dec = np.degrees([float(ephem.degrees(pred['dec'])) for pred in preds])
+        ra = np.where(ra > 180, ra - 360, ra)
+        erra = np.array([pred['err']['a'] for pred in preds])
+        errb = np.array([pred['err']['b'] for pred in preds])
+        pa = np.array([pred['err']['PA'] for pred in preds])
+        return np.column_stack((ra, dec)), erra, errb, pa
 
     # return number of detections without repeats
     def realLength(self):
@@ -648,33 +1145,184 @@ class fakeObj:
         self.listobj = []
         self.campaigns = []
 
+# The columns of a .orbit file from BulkFit as numpy arrays, in the order of
+# the file. Tracks are joined to the orbits with a searchsorted on a sorted
+# copy of ORBITID, the way DetectionCatalog looks up objids.
+class OrbitColumns(object):
+    def __init__(self, columns):
+        self.columns = columns
+        self.size = len(columns['ORBITID'])
+        self._order = np.argsort(columns['ORBITID'], kind='mergesort')
+        self._sortedIds = columns['ORBITID'][self._order]
+
+    def __len__(self):
+        return self.size
+
+    def col(self, name):
+        return self.columns[name]
+
+    # returns the row of each orbitid, -1 where it was not fit
+    def indexOf(self, orbitids):
+        orbitids = np.asarray(orbitids, dtype='i8')
+        if(self.size == 0):
+            return np.full(orbitids.shape, -1, dtype='i8')
+        pos = np.minimum(np.searchsorted(self._sortedIds, orbitids), self.size-1)
+        return np.where(self._sortedIds[pos] == orbitids, self._order[pos], -1)
+
+    '''
+    input: --a chisq threshold (chiThresh)
+           --whether the threshold is per degree of freedom (perDof), as used
+             when merging, where a CHISQ of 0 also counts as a bad fit
+    output: --a boolean array, True for the orbits that were fit well
+    '''
+    def goodFits(self, chiThresh, perDof=False):
+        chisq = self.columns['CHISQ']
+        good = self.columns['FLAGS'] == 0
+        if(perDof):
+            return good & (chisq < chiThresh*self.columns['DOF']) & (chisq > 0.0)
+        return good & (chisq < chiThresh)
+
+    # reads the given columns (all by default) of the first table of a .orbit file
+    @classmethod
+    def read(cls, orbitFile, names=None):
+        with fits.open(orbitFile) as hdul:
+            data = hdul[1].data
+            if(names is None):
+                names = data.columns.names
+            return cls(dict((name, np.array(data[name])) for name in names))
+
+    @classmethod
+    def fromTable(cls, table, names=None):
+        if(names is None):
+            names = table.colnames
+        return cls(dict((name, np.asarray(table[name])) for name in names))
+
+# The predictions of BulkPredict as arrays, sorted by ORBITID then MJD. ORBITID and
+# MJD are kept as the sorted unique values and a code per row; RA and DEC stay f8
+# and ERROR_A (arcseconds) is kept as f4. ERROR_B (arcseconds) and PA (degrees) are
+# only kept, as f4, when they are given; read and fromTable leave them out unless
+# asked for with ellipse=True. When every orbit is predicted at every mjd, as
+# writeNites asks for, the row of (orbitid, mjd) is found from the two codes alone.
+class PredictionTable(object):
+    def __init__(self, orbitid, mjd, ra, dec, errA, errB=None, pa=None):
+        orbitid = np.asarray(orbitid, dtype='i8')
+        mjd = np.asarray(mjd, dtype='f8')
+        order = np.lexsort((mjd, orbitid))
+        self.orbitids, orbitCode = np.unique(orbitid, return_inverse=True)
+        self.mjds, mjdCode = np.unique(mjd, return_inverse=True)
+        orbitCode = orbitCode.ravel()[order]
+        mjdCode = mjdCode.ravel()[order]
+        self.size = len(order)
+        self.indptr = np.zeros(len(self.orbitids)+1, dtype='i8')
+        self.indptr[1:] = np.cumsum(np.bincount(orbitCode, minlength=len(self.orbitids)))
+        keys = orbitCode*len(self.mjds) + mjdCode
+        self._dense = (self.size == len(self.orbitids)*len(self.mjds) and
+                       bool((np.diff(keys) == 1).all()))
+        self._keys = None if self._dense else keys
+        self._mjdCode = None if self._dense else mjdCode.astype('i4')
+        self.columns = {'RA': np.asarray(ra, dtype='f8')[order],
+                        'DEC': np.asarray(dec, dtype='f8')[order],
+                        'ERROR_A': np.asarray(errA, dtype='f4')[order]}
+        if(errB is not None):
+            self.columns['ERROR_B'] = np.asarray(errB, dtype='f4')[order]
+        if(pa is not None):
+            self.columns['PA'] = np.asarray(pa, dtype='f4')[order]
+
+    def __len__(self):
+        return self.size
+
+    def col(self, name):
+        if(name == 'ORBITID'):
+            return np.repeat(self.orbitids, np.diff(self.indptr))
+        if(name == 'MJD'):
+            if(self._dense):
+                return np.tile(self.mjds, len(self.orbitids))
+            return self.mjds[self._mjdCode]
+        return self.columns[name]
+
+    # returns the row of each (orbitid, mjd), -1 where there is no prediction
+    def indexOf(self, orbitids, mjds):
+        orbitids, mjds = np.broadcast_arrays(np.asarray(orbitids, dtype='i8'),
+                                             np.asarray(mjds, dtype='f8'))
+        if(self.size == 0):
+            return np.full(orbitids.shape, -1, dtype='i8')
+        orbitCode = np.minimum(np.searchsorted(self.orbitids, orbitids), len(self.orbitids)-1)
+        mjdCode = np.minimum(np.searchsorted(self.mjds, mjds), len(self.mjds)-1)
+        found = (self.orbitids[orbitCode] == orbitids) & (self.mjds[mjdCode] == mjds)
+        pos = orbitCode*len(self.mjds) + mjdCode
+        if(not self._dense):
+            key = pos
+            pos = np.minimum(np.searchsorted(self._keys, key), self.size-1)
+            found &= self._keys[pos] == key
+        return np.where(found, pos, -1)
+
+    '''
+    input: --orbitids and mjds, arrays or scalars (orbitids, mjds)
+           --names of the columns to return (names)
+    output: --the value of each column for every (orbitid, mjd)
+              raises KeyError with the first (orbitid, mjd) that was not predicted
+    '''
+    def lookup(self, orbitids, mjds, names=('RA', 'DEC', 'ERROR_A')):
+        idx = self.indexOf(orbitids, mjds)
+        if((idx < 0).any()):
+            orbitids, mjds = np.broadcast_arrays(orbitids, mjds)
+            miss = np.nonzero(idx < 0)
+            raise KeyError((int(orbitids[miss][0]), float(mjds[miss][0])))
+        return [self.columns[name][idx] for name in names]
+
+    # reads the first table of a BulkPredict output file, with ERROR_B and PA if ellipse
+    @classmethod
+    def read(cls, predictFile, ellipse=False):
+        with fits.open(predictFile) as hdul:
+            return cls.fromTable(hdul[1].data, ellipse)
+
+    @classmethod
+    def fromTable(cls, table, ellipse=False):
+        names = ['ORBITID', 'MJD', 'RA', 'DEC', 'ERROR_A']
+        if(ellipse):
+            names += ['ERROR_B', 'PA']
+        return cls(*[np.asarray(table[name]) for name in names])
+
 #saves the orbital elements from the orbitTable into the list of triplets
-# tripList and orbitTable should have the same length
+# tripList and orbitTable (a Table, an OrbitColumns or a .orbit file) should have the same length
+# the triplets are returned in the order of the orbits
 def saveElements(tripList, orbitTable):
     print('size of list: ' + str(len(tripList)))
     assert(len(tripList) == len(orbitTable))
-    
-    trackids = orbitTable['ORBITID'].tolist()
-    elements = orbitTable['ELEMENTS'].tolist()
-    errs = orbitTable['ELCOV'].tolist()
-    chisqs = orbitTable['CHISQ'].tolist()
-    flags = orbitTable['FLAGS'].tolist()
-    abg = orbitTable['ABG'].tolist()
-    cov = orbitTable['ABGCOV'].tolist()
-    aeiCov = orbitTable['ELCOV'].tolist()
+    if(isinstance(orbitTable, str)):
+        orbits = OrbitColumns.read(orbitTable)
+    elif(isinstance(orbitTable, OrbitColumns)):
+        orbits = orbitTable
+    else:
+        orbits = OrbitColumns.fromTable(orbitTable)
+
+    # the triplet of each orbit; the last one when triplets share a trackid
+    trackids = np.array([trip.trackid for trip in tripList], dtype='i8')
+    order = np.argsort(trackids, kind='mergesort')
+    orbitids = orbits.col('ORBITID')
+    pos = np.searchsorted(trackids[order], orbitids, side='right') - 1
+    found = pos >= 0
+    found[found] = trackids[order][pos[found]] == orbitids[found]
+    if(not found.all()):
+        raise KeyError(orbitids[~found][0])
+    tripIdx = order[pos]
+
+    ok = orbits.col('FLAGS') == 0
+    size = len(orbits)
+    chisqs = orbits.col('CHISQ').tolist()
+    elements = orbits.col('ELEMENTS').reshape(size, -1).tolist()
+    aeiCov = orbits.col('ELCOV').reshape(size, -1)
+    # the diagonal of each 6x6 covariance
+    with np.errstate(invalid='ignore'):
+        errs = np.sqrt(aeiCov[:, [0, 7, 14, 21, 28, 35]]).tolist()
+    aeiCov = aeiCov.tolist()
+    abg = orbits.col('ABG').tolist()
+    cov = orbits.col('ABGCOV').tolist()
 
     newList = []
-    trackDict = {}
-    for trip in tripList:
-        trackDict[trip.trackid] = trip
-    for x in range(len(trackids)):
-        trip = trackDict[trackids[x]]
-        try:
-            assert(trip.trackid == trackids[x])
-        except AssertionError:
-            print(trip)
-            print(trackids[x])
-        if(flags[x] != 0):
+    for x in range(size):
+        trip = tripList[tripIdx[x]]
+        if(not ok[x]):
             trip.chiSq = -1
             trip.elements = 0
             trip.errs = 0
@@ -682,16 +1330,185 @@ def saveElements(tripList, orbitTable):
             trip.chiSq = chisqs[x]
             els = elements[x]
             ers = errs[x]
-            trip.aeiCov = aeiCov[x]           
+            trip.aeiCov = aeiCov[x]
             trip.elements = {'a': els[0], 'e': els[1], 'i': els[2],
                             'lan': els[3], 'top': els[5], 'aop': els[4]}
             trip.abg = abg[x]
             trip.cov = cov[x]
-            trip.errs = {'a': np.sqrt(ers[0]), 'e': np.sqrt(ers[7]), 'i': np.sqrt(ers[17]), 
-                        'lan': np.sqrt(ers[21]), 'top': np.sqrt(ers[28]), 'aop': np.sqrt(ers[35])}
+            trip.errs = {'a': ers[0], 'e': ers[1], 'i': ers[2],
+                        'lan': ers[3], 'top': ers[4], 'aop': ers[5]}
         newList.append(trip)
     return newList
 
+# A chunk of triplets kept as arrays: an int64 trackid per triplet and an
+# (N, 3) int64 array of the objids in it. Saved as a .npz file it replaces
+# the pickled list of (trackid, [objid, objid, objid]) tuples.
+class TripletChunk(object):
+    def __init__(self, trackids, objids):
+        self.trackids = np.asarray(trackids, dtype='i8')
+        self.objids = np.asarray(objids, dtype='i8').reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.trackids)
+
+    # gives the same (trackid, [objids]) tuples as the pickled lists
+    def __getitem__(self, x):
+        return (int(self.trackids[x]), self.objids[x].tolist())
+
+    def __iter__(self):
+        objids = self.objids.tolist()
+        for x in range(len(self.trackids)):
+            yield (int(self.trackids[x]), objids[x])
+
+    def save(self, outfile):
+        print('\nsaving to ' + outfile)
+        with open(outfile, 'wb') as f:
+            np.savez(f, trackid=self.trackids, objids=self.objids)
+
+    @classmethod
+    def load(cls, infile):
+        with np.load(infile) as data:
+            return cls(data['trackid'], data['objids'])
+
+    # makes a chunk out of a list of (trackid, [objids]) tuples
+    @classmethod
+    def fromList(cls, tripList):
+        trackids = np.array([x[0] for x in tripList], dtype='i8')
+        objids = np.array([x[1] for x in tripList], dtype='i8').reshape(-1, 3)
+        return cls(trackids, objids)
+
+    # returns Triplet objects with the detections of a DetectionCatalog
+    def toTriplets(self, catalog):
+        rows = catalog.indexOf(self.objids)
+        if((rows < 0).any()):
+            raise KeyError('objid not in catalog: ' +
+                    str(self.objids[rows < 0][0]))
+        tripList = []
+        for x in range(len(self.trackids)):
+            trip = Triplet(catalog.rows(rows[x]))
+            trip.trackid = int(self.trackids[x])
+            tripList.append(trip)
+        return tripList
+
+'''
+input: --a .npz triplet chunk or a pickle file of triplets (infile)
+       --a DetectionCatalog to turn a chunk into Triplet objects (catalog)
+output: --a TripletChunk, or a list of Triplets if a catalog was given,
+          for .npz files; whatever was pickled otherwise
+'''
+def loadTriplets(infile, catalog=None):
+    if(infile.endswith('.npz')):
+        chunk = TripletChunk.load(infile)
+        if(catalog is None):
+            return chunk
+        return chunk.toTriplets(catalog)
+    with open(infile, 'rb') as f:
+        return pickle.load(f)
+
+'''
+input: --ra and dec in degrees, scalars or arrays (ra, dec)
+       --the tangent point in degrees, one for all positions or one per position (ra0, dec0)
+output: --x, y in degrees on the plane tangent to the sky at (ra0, dec0)
+'''
+def gnomonic(ra, dec, ra0, dec0):
+    dra = np.radians((np.asarray(ra) - ra0 + 180) % 360 - 180)
+    dec = np.radians(dec)
+    dec0 = np.radians(dec0)
+    c_dec0 = np.cos(dec0)
+    s_dec0 = np.sin(dec0)
+    c_dec = np.cos(dec)
+    s_dec = np.sin(dec)
+    c_ra = np.cos(dra)
+    cos_c = s_dec0*s_dec + c_dec0*c_dec*c_ra
+    x = c_dec*np.sin(dra)/cos_c
+    y = (c_dec0*s_dec - s_dec0*c_dec*c_ra)/cos_c
+    return np.degrees(x), np.degrees(y)
+
+'''
+input: --x, y in degrees on the plane tangent at (ra0, dec0), scalars or arrays (x, y)
+       --the tangent point in degrees (ra0, dec0)
+output: --ra in [0, 360) and dec in degrees, the inverse of gnomonic
+'''
+def gnomonicInverse(x, y, ra0, dec0):
+    x = np.radians(x)
+    y = np.radians(y)
+    dec0 = np.radians(dec0)
+    rho = np.hypot(x, y)
+    c = np.arctan(rho)
+    s_c = np.sin(c)
+    c_c = np.cos(c)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where(rho > 0, y*s_c/np.where(rho > 0, rho, 1), 0)
+    dec = np.arcsin(c_c*np.sin(dec0) + ratio*np.cos(dec0))
+    dra = np.arctan2(x*s_c, rho*np.cos(dec0)*c_c - y*np.sin(dec0)*s_c)
+    return (ra0 + np.degrees(dra)) % 360, np.degrees(dec)
+
+'''
+input: --a DetectionCatalog (catalog)
+       --an (N, 3) array of the objids in each triplet (objids)
+       --largest rate of motion in degrees per day (maxRate)
+       --largest change of that rate in degrees per day per day (maxAccel)
+       --largest acceleration across the great circle through the first and
+         last detections in degrees per day per day (maxBend)
+       --largest spread of magnitudes within a band, as in Triplet.magFilter (magThresh)
+       --how many position errors to allow for on top of every cut (nSigma)
+output: --a boolean array, False for triplets no orbit could go through
+'''
+# Every cut is loosened by nSigma times the error the positions put on it, so
+# close pairs of detections, where a small error is a large rate, are not cut.
+# The defaults are loose enough for anything beyond about 2 AU.
+def prefilterTriplets(catalog, objids, maxRate=1.0, maxAccel=0.05, maxBend=0.02,
+                      magThresh=1.0, nSigma=5.0):
+    objids = np.asarray(objids, dtype='i8').reshape(-1, 3)
+    rows = catalog.indexOf(objids)
+    if((rows < 0).any()):
+        raise KeyError('objid not in catalog: ' + str(objids[rows < 0][0]))
+    data = catalog.data
+    mjd = data['mjd'][rows]
+    order = np.argsort(mjd, axis=1, kind='mergesort')
+    rows = np.take_along_axis(rows, order, axis=1)
+    mjd = np.take_along_axis(mjd, order, axis=1)
+    ra = data['ra'][rows]
+    dec = data['dec'][rows]
+    mag = data['mag'][rows].astype('f8')
+    err = posErrArray(data['posErr'][rows], mag)
+
+    # positions on the plane tangent at the middle detection, where great
+    # circles are straight lines
+    x, y = gnomonic(ra, dec, ra[:, 1:2], dec[:, 1:2])
+    dt1 = np.maximum(mjd[:, 1] - mjd[:, 0], 1e-8)
+    dt2 = np.maximum(mjd[:, 2] - mjd[:, 1], 1e-8)
+    vx1 = (x[:, 1] - x[:, 0])/dt1
+    vy1 = (y[:, 1] - y[:, 0])/dt1
+    vx2 = (x[:, 2] - x[:, 1])/dt2
+    vy2 = (y[:, 2] - y[:, 1])/dt2
+    err1 = np.hypot(err[:, 0], err[:, 1])/dt1
+    err2 = np.hypot(err[:, 1], err[:, 2])/dt2
+    keep = np.hypot(vx1, vy1) <= maxRate + nSigma*err1
+    keep &= np.hypot(vx2, vy2) <= maxRate + nSigma*err2
+
+    half = (dt1 + dt2)/2
+    accel = np.hypot(vx2 - vx1, vy2 - vy1)/half
+    keep &= accel <= maxAccel + nSigma*np.hypot(err1, err2)/half
+
+    # distance of the middle detection from the line through the other two;
+    # a path bending at maxBend is off it by maxBend*dt1*dt2/2
+    chordX = x[:, 2] - x[:, 0]
+    chordY = y[:, 2] - y[:, 0]
+    chord = np.maximum(np.hypot(chordX, chordY), 1e-12)
+    offset = np.abs(chordX*(y[:, 1] - y[:, 0]) - chordY*(x[:, 1] - x[:, 0]))/chord
+    keep &= offset <= maxBend*dt1*dt2/2 + nSigma*np.sqrt((err**2).sum(axis=1))
+
+    band = data['band'][rows]
+    for name in ('g', 'r', 'i', 'z'):
+        if(name not in catalog.bands):
+            continue
+        inBand = band == catalog.bands.index(name)
+        magMin = np.where(inBand, mag, 30).min(axis=1)
+        magMax = np.where(inBand, mag, 0).max(axis=1)
+        keep &= ~((magMax - magMin > magThresh) & (magMin != 30))
+    return keep
+
 #Write the triplet list to a file
 def writeTriplets(tripList, outfile, writeOrbit=False, isObj=True):
     print('\nwriting triplets to: ' + outfile)
@@ -773,24 +1590,19 @@ def isNumber(s):
         return False
 
 # Creates and returns a tripDict of detections.
-# prints its progress in process.
+# takes a csv file or a DetectionCatalog
 def fakeDict(csvFile):
-    detlist = wrapDets(csvFile)
+    if(isinstance(csvFile, DetectionCatalog)):
+        catalog = csvFile
+    else:
+        catalog = loadCatalog(csvFile)
+    fakeids = np.array(catalog.col('fakeid'))
+    fakeids[fakeids > 800000000] = 0
+    order = np.argsort(fakeids, kind='mergesort')
+    ids, starts = np.unique(fakeids[order], return_index=True)
     tripDict = {}
-    size = len(detlist)
-    time0 = time.time()
-    # Records an inital time.
-    counter = 0
-    for det in detlist:
-        i = det.fakeid
-        if(i > 800000000):
-            i = 0
-        if(i not in tripDict):
-            tripDict[i] = [det]
-        else:
-            tripDict[i].append(det)
-        counter += 1
-        printPercentage(counter, size, time.time()-time0)
+    for fakeid, rows in zip(ids, np.split(order, starts[1:])):
+        tripDict[int(fakeid)] = catalog.rows(rows)
     return tripDict
 
 # Returns a dictionary of detections called expdict.
@@ -803,103 +1615,95 @@ def expDictionary(dets):
             expdict[det.expnum].append(det)
     return expdict
 
-# input: a pandas dataframe with the necessary headers for the Detection object
-#           false: returns dictionary, true: saves to pickle file
-# output: a dictionary that goes from objid to Detection object
-def objidDictionary(csvFile, lookAhead=0, printP=False, toPickle=False, efficient=False):
-    cand = False
-    if(lookAhead == -1):
-        cand = True
-        lookAhead = 0
-    print('start wrap')
-    detList = wrapDets(csvFile, lookAhead, printP, efficient)
-    detDict = {}
-    size = len(detList)
-    print('\nadding ' + str(size) +' objects to dictionary') 
-    counter = 0
+# version of the binary detection cache layout, bump when it changes
+DET_CACHE_VERSION = 2
+
+# returns the directory holding the binary cache for a csv file of detections
+def detCachePath(csvFile):
+    return os.path.splitext(csvFile)[0] + '.detcache'
+
+'''
+input: --csv file of detections (csvFile)
+       --the catalog of that file, read from the csv if None (catalog)
+output: --writes one .npy file per column, the sorted objid index and a
+          header.json next to the csv; returns the cache directory
+'''
+def writeDetCache(csvFile, catalog=None):
+    if(catalog is None):
+        catalog = DetectionCatalog.fromCsv(csvFile)
+    path = detCachePath(csvFile)
+    if(not os.path.isdir(path)):
+        os.makedirs(path)
+    print('writing detection cache to ' + path)
+    for name in DET_DTYPE.names:
+        np.save(os.path.join(path, name + '.npy'),
+                np.ascontiguousarray(catalog.col(name)))
+    catalog._buildIndex()
+    np.save(os.path.join(path, 'objidOrder.npy'), catalog._order)
+    np.save(os.path.join(path, 'objidSorted.npy'), catalog._sortedIds)
+    stat = os.stat(csvFile)
+    header = {'version': DET_CACHE_VERSION, 'nrows': len(catalog),
+              'columns': [[name, DET_DTYPE[name].str] for name in DET_DTYPE.names],
+              'bands': catalog.bands, 'source': os.path.basename(csvFile),
+              'sourceSize': stat.st_size, 'sourceMtime': stat.st_mtime}
+    # the header goes last so a half written cache is never picked up
+    with open(os.path.join(path, 'header.json.tmp'), 'w') as f:
+        json.dump(header, f)
+    os.rename(os.path.join(path, 'header.json.tmp'),
+              os.path.join(path, 'header.json'))
+    return path
+
+'''
+input: --csv file of detections (csvFile)
+output: --a DetectionCatalog whose columns are memory-mapped from the cache,
+          or None if there is no cache or it is out of date
+          the columns are mapped copy-on-write, so rows can be changed like those of
+          a catalog read from the csv without touching the cache files
+'''
+def readDetCache(csvFile, lookAhead=0):
+    path = detCachePath(csvFile)
+    try:
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if(header.get('version') != DET_CACHE_VERSION):
+        print('detection cache version ' + str(header.get('version')) +
+                ' is out of date: ' + path)
+        return None
+    if(header['columns'] != [[name, DET_DTYPE[name].str] for name in DET_DTYPE.names]):
+        print('detection cache columns do not match: ' + path)
+        return None
+    # a cache is still usable when only it was copied to this machine
+    if(os.path.isfile(csvFile)):
+        stat = os.stat(csvFile)
+        if(stat.st_size != header['sourceSize'] or
+                abs(stat.st_mtime - header['sourceMtime']) > 1e-3):
+            print('detection cache is older than ' + csvFile)
+            return None
+    data = {}
+    for name in DET_DTYPE.names:
+        data[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode='c')
+    catalog = DetectionCatalog(data, header['bands'], lookAhead)
+    catalog._order = np.load(os.path.join(path, 'objidOrder.npy'), mmap_mode='r')
+    catalog._sortedIds = np.load(os.path.join(path, 'objidSorted.npy'), mmap_mode='r')
+    return catalog
+
+# Returns a DetectionCatalog for a csv file of detections.
+# The binary cache from writeDetCache is memory-mapped instead when there is one.
+def loadCatalog(csvFile, lookAhead=0, useCache=True):
     time0 = time.time()
-    for det in detList:
-        if(cand):
-            det.lookAhead = -1
-        detDict[det.objid] = det
-        if(printP):
-            printPercentage(counter, size, time.time()-time0)
-        counter += 1
-    if(toPickle):
-        savename = (csvFile.split('+')[-1] if '+' in csvFile else
-                    csvFile.split('/')[-1] if '/' in csvFile else
-                    csvFile)
-        
-        savename = 'objDict+' + savename.split('.')[0]
-        with open(savename + '.pickle', 'wb') as f:
-            print('\npickling to ' + savename)
-            pickle.dump(detDict, f)
-    else:
-        return detDict
-
-#takes a csvfile of detections and wraps them with Detection class
-def wrapDets(csvFile, lookAhead=0, printP=False, efficient=False):
-    df = pd.read_csv(csvFile)
-    df.rename(str.lower, axis='columns', inplace=True)
-    df.rename(columns={'snobjid': 'objid',
-            'snfake_id': 'fakeid', 'ccdnum': 'ccd'}, inplace=True)
-
-    size = len(df['objid'])
-    raList = df['ra'].tolist()
-    decList = df['dec'].tolist()
-    mjdList = df['mjd'].tolist()
-    if 'mag' in df.columns:
-        print('using mag')
-        magList = df['mag'].tolist()
-        fluxList = [0]*len(magList)
+    catalog = None
+    if(useCache):
+        catalog = readDetCache(csvFile, lookAhead)
+    if(catalog is None):
+        print('loading detections from ' + csvFile)
+        catalog = DetectionCatalog.fromCsv(csvFile, lookAhead)
     else:
-        print('using flux')
-        fluxList = df['flux'].tolist()
-    objidList = df['objid'].tolist()
-    expnumList = df['expnum'].tolist()
-    ccdList = df['ccd'].tolist()
-    bandList = df['band'].tolist()
-    try:
-        fakeidList = df['fakeid'].tolist()
-    except KeyError:
-        print('no fakeids')
-        fakeidList = [0]*len(objidList)
-    try:
-        fluxErrList = df['flux_err'].tolist()
-    except KeyError:
-        print('no flux err')
-        fluxErrList = [10]*len(objidList)
-    try:
-        posErrList = df['errawin_world'].tolist()
-    except KeyError:
-        print('no poserr')
-        posErrList = [0]*len(objidList)
-    detlist = []
-    startT = time.time()
-    print('wrapping ' + str(size) + ' objects')
-    update = 60
-    
-    for y in range(size):
-        if(time.time() - startT > update and printP):
-            printPercentage(y,size, time.time()-startT)
-            update += 60
-        if(efficient):
-            det = Det(ra=float(raList[y]), dec=float(decList[y]), mjd=float(mjdList[y]),
-                        mag=float(magList[y]), objid=float(objidList[y]), 
-                        expnum=float(expnumList[y]),
-                        ccd=float(ccdList[y]), band=bandList[y], 
-                        fakeid=float(fakeidList[y]), posErr=float(posErrList[y]), lookAhead=-1)
-        else:
-            det = Detection(float(raList[y]), float(decList[y]), float(mjdList[y]),
-                    float(fluxList[y]), int(objidList[y]),
-                    int(expnumList[y]), int(ccdList[y]), bandList[y],
-                    lookAhead, int(fakeidList[y])) 
-            det.setMagErr(int(fluxErrList[y]))
-            det.posErr = float(posErrList[y])
-            if(det.mag > 40):
-                det.mag = float(magList[y])
-        detlist.append(det)
-    return detlist
+        print('loading detections from ' + detCachePath(csvFile))
+    print('loaded ' + str(len(catalog)) + ' detections after ' +
+            str(time.time()-time0) + ' seconds')
+    return catalog
 
 # takes a list of detections and returns all detections in an exposure
 def findDetections(exposure, detList):
@@ -942,59 +1746,151 @@ def setTrackId(chunkname, savename):
     print('trackid header: ' + TRACK_ID_HEADER)
     return TRACK_ID_HEADER
 
+# returns the position errors in degrees, from the magnitude as in
+# Detection.getPosErr where posErr is 0
+def posErrArray(posErr, mag):
+    mag = np.asarray(mag, dtype='f8')
+    return np.where(posErr != 0, posErr, (0.1 + 0.1*np.maximum(mag - 21, 0)/3)/3600)
+
+# A dictionary from trackid to the detections of a track, kept as the rows
+# of a DetectionCatalog in CSR form: the rows of track x are
+# rows[indptr[x]:indptr[x+1]]. writeDetToOrb writes it without looking at
+# the detections one by one, and reading a track makes CatalogDet views.
+class TrackRows(object):
+    def __init__(self, catalog, trackids, indptr, rows):
+        self.catalog = catalog
+        self.trackids = np.asarray(trackids, dtype='i8')
+        self.indptr = np.asarray(indptr, dtype='i8')
+        self.rows = np.asarray(rows, dtype='i8')
+        self._order = np.argsort(self.trackids, kind='mergesort')
+        self._sorted = self.trackids[self._order]
+        self._live = np.ones(len(self.trackids), dtype=bool)
+
+    # returns the position of a trackid in trackids
+    def _pos(self, trackid):
+        i = np.searchsorted(self._sorted, trackid)
+        if(i < len(self._sorted) and self._sorted[i] == trackid and self._live[self._order[i]]):
+            return self._order[i]
+        raise KeyError(trackid)
+
+    def __len__(self):
+        return int(self._live.sum())
+
+    def __contains__(self, trackid):
+        try:
+            self._pos(trackid)
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__(self, trackid):
+        x = self._pos(trackid)
+        return self.catalog.rows(self.rows[self.indptr[x]:self.indptr[x+1]])
+
+    def __delitem__(self, trackid):
+        self._live[self._pos(trackid)] = False
+
+    def keys(self):
+        return self.trackids[self._live].tolist()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def values(self):
+        return [self[trackid] for trackid in self.keys()]
+
+    # the live tracks as (trackids, indptr, rows), in trackid order
+    def csr(self):
+        order = self._order[self._live[self._order]]
+        counts = (self.indptr[1:] - self.indptr[:-1])[order]
+        ends = np.cumsum(counts)
+        index = np.repeat(self.indptr[:-1][order] - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+        indptr = np.zeros(len(order)+1, dtype='i8')
+        indptr[1:] = ends
+        return self.trackids[order], indptr, self.rows[index]
+
+    # the rows of the live tracks in the order the tracks were given
+    def liveRows(self):
+        return self.rows[np.repeat(self._live, np.diff(self.indptr))]
+
+    # makes a TrackRows out of a dictionary from trackid to a list of detections
+    @classmethod
+    def fromDict(cls, trackIDs):
+        trackids = list(trackIDs.keys())
+        counts = [len(trackIDs[trackid]) for trackid in trackids]
+        dets = [det for trackid in trackids for det in trackIDs[trackid]]
+        catalog = dets[0].catalog if len(dets) and isinstance(dets[0], CatalogDet) else None
+        if(catalog is not None and all(isinstance(det, CatalogDet) and det.catalog is catalog for det in dets)):
+            rows = np.array([det.idx for det in dets], dtype='i8')
+        else:
+            catalog = DetectionCatalog.fromDetections(dets)
+            rows = np.arange(len(dets))
+        indptr = np.zeros(len(trackids)+1, dtype='i8')
+        indptr[1:] = np.cumsum(counts)
+        return cls(catalog, trackids, indptr, rows)
+
+# Returns the sum of an array added up one value at a time from the first, as
+# the loop over the detections that writeDetToOrb replaced did.
+def _sequentialSum(values):
+    values = np.asarray(values, dtype='f8')
+    return float(np.cumsum(values)[-1]) if len(values) else 0.0
+
 # takes in a dictionary from trackid to list of dets and writes to a file
 # to feed into the orbit fitter
-# trackIDs is a dictionary from a 6 digit string to a list of detections
+# trackIDs is a dictionary from a 6 digit string to a list of detections,
+# or a TrackRows
+# the detections of a dictionary are read one by one, unless they are all
+# CatalogDet views of one catalog, whose rows are read straight from it
 def writeDetToOrb(trackIDs, outName='defaultTempSift.fits', verbose=True):
-    ra_sum = 0
-    dec_sum = 0
-    mjd_sum = 0
-    num_dets = 0
+    if(not isinstance(trackIDs, TrackRows)):
+        dets = [det for track in trackIDs.values() for det in track]
+        catalog = dets[0].catalog if len(dets) and isinstance(dets[0], CatalogDet) else None
+        if(catalog is not None and all(isinstance(det, CatalogDet) and
+                det.catalog is catalog for det in dets)):
+            trackIDs = TrackRows.fromDict(trackIDs)
     if(verbose):
         print('\nnumber of triplets to be fit: ' + str(len(trackIDs)))
-    for track in trackIDs.values():
-        for det in track:
-            ra_sum += det.ra
-            dec_sum += det.dec
-            mjd_sum += det.mjd
-            num_dets += 1
-    if(num_dets == 0):
+    if(isinstance(trackIDs, TrackRows)):
+        trackids, indptr, rows = trackIDs.csr()
+        data = trackIDs.catalog.data
+        counts = np.diff(indptr)
+        ra = data['ra'][rows]
+        dec = data['dec'][rows]
+        expnum = data['expnum'][rows]
+        sigma = posErrArray(data['posErr'][rows], data['mag'][rows])*3600
+        objid = data['objid'][rows]
+        # the center is added up in the order the tracks were given
+        given = trackIDs.liveRows()
+        center = [data[name][given] for name in ('ra', 'dec', 'mjd')]
+    else:
+        trackids = sorted(trackIDs.keys())
+        counts = [len(trackIDs[trackid]) for trackid in trackids]
+        dets = [det for trackid in trackids for det in trackIDs[trackid]]
+        ra = np.array([det.ra for det in dets], dtype='f8')
+        dec = np.array([det.dec for det in dets], dtype='f8')
+        expnum = np.array([det.expnum for det in dets], dtype='i8')
+        sigma = posErrArray(np.array([det.posErr for det in dets], dtype='f8'),
+                np.array([det.mag for det in dets], dtype='f8'))*3600
+        objid = np.array([det.objid for det in dets], dtype='i8')
+        given = [det for track in trackIDs.values() for det in track]
+        center = [[getattr(det, name) for det in given] for name in ('ra', 'dec', 'mjd')]
+    if(len(ra) == 0):
         print('nothing to fit')
         return False
-    ra_center = ra_sum / num_dets
-    dec_center = dec_sum / num_dets
-    mjd_center = mjd_sum / num_dets
 
     time0 = time.time()
-    hdu = fits.PrimaryHDU()
-    trackList = []
-    expList = []
-    raList = []
-    decList = []
-    errList = []
-    objList = []
-    for trackID in sorted(trackIDs.iterkeys()):
-        dets = trackIDs[trackID]
-        for det in dets:
-            trackList.append(trackID)
-            expList.append(det.expnum)
-            raList.append(det.ra)
-            decList.append(det.dec)
-            if(det.posErr == 0):
-                errList.append(det.getPosErr()*3600)
-            else:
-                errList.append(det.posErr*3600)
-            objList.append(det.objid)
-    #print(trackList)
-    outTable = Table([trackList, expList, raList, decList, errList, objList],
-                names=('ORBITID', 'EXPNUM', 'RA', 'DEC', 'SIGMA', 'OBJID'),
-                dtype=('int64', 'i4', 'f8', 'f8', 'f8', 'i8'))
-    
-    binTable = fits.BinTableHDU(outTable)
-    binTable.header['RA0'] = ra_center
-    binTable.header['DEC0'] = dec_center
-    binTable.header['MJD0'] = mjd_center
-    hdul = HDUList([hdu, binTable])
+    cols = [fits.Column(name='ORBITID', format='K',
+                    array=np.repeat(np.asarray(trackids, dtype='i8'), counts)),
+            fits.Column(name='EXPNUM', format='J', array=np.asarray(expnum).astype('i4')),
+            fits.Column(name='RA', format='D', array=ra),
+            fits.Column(name='DEC', format='D', array=dec),
+            fits.Column(name='SIGMA', format='D', array=sigma),
+            fits.Column(name='OBJID', format='K', array=np.asarray(objid).astype('i8'))]
+    binTable = fits.BinTableHDU.from_columns(cols)
+    binTable.header['RA0'] = _sequentialSum(center[0]) / len(ra)
+    binTable.header['DEC0'] = _sequentialSum(center[1]) / len(ra)
+    binTable.header['MJD0'] = _sequentialSum(center[2]) / len(ra)
+    hdul = HDUList([fits.PrimaryHDU(), binTable])
     if(verbose):
         print('writing to: ' + outName)
     hdul.writeto(outName, overwrite=True)
@@ -1002,6 +1898,3 @@ def writeDetToOrb(trackIDs, outName='defaultTempSift.fits', verbose=True):
     if(verbose):
         print('fits save time: ' + str(time1-time0))
     return outName
-
-
-
@@ -0,0 +1,238 @@
+# Stand-ins for the orbit tools BulkFit, BulkPredict, BulkProximity and BulkElements.
+# They read and write the same FITS tables as the real tools, so the pipeline can be run and timed
+# on a machine without them. Put fakebin/ first on PATH, or run
+#     python fakeBulk.py BulkFit -observationFile=... -orbitFile=...
+# The "orbit" is a straight line in the plane tangent at RA0, DEC0 of the request, fit by weighted
+# least squares; the ELEMENTS are made up from it and mean nothing. Outputs only depend on the inputs.
+# The requests only have exposure numbers, so the mjd of each exposure is read from the detection
+# file in -detections= or $FAKE_BULK_DETECTIONS, through a small table kept next to it (exposureTable).
+# The fakebin/ wrappers run fakeBulk.py with $PYTHON, or python3 when it is not set.
+# -latency= or $FAKE_BULK_LATENCY adds that many seconds per request row, to stand in for fitter time.
+import sys
+import os
+tnopath = os.environ['TNO_PATH']
+sys.path.insert(0, tnopath)
+import time
+
+import numpy as np
+import pandas as pd
+from astropy.table import Table
+
+import LinkerLib as LL
+
+# Returns a dictionary of the -name=value options on the command line.
+def parseOptions(argv):
+    options = {}
+    for arg in argv:
+        if(arg.startswith('-') and '=' in arg):
+            name, value = arg.lstrip('-').split('=', 1)
+            options[name] = value
+    return options
+
+# returns the file next to the detection cache that keeps the mjd of each exposure
+def exposureTablePath(detFile):
+    return os.path.splitext(detFile)[0] + '.expmjd.npz'
+
+'''
+input: --a detection file (detFile)
+output: --the sorted exposure numbers in it and the mjd of each, read from the
+          small table of exposureTablePath, which is made the first time from
+          only the expnum and mjd columns and made again when the file changes
+'''
+def exposureTable(detFile):
+    path = exposureTablePath(detFile)
+    stat = os.stat(detFile)
+    source = np.array([stat.st_size, stat.st_mtime])
+    try:
+        with np.load(path) as table:
+            if((table['source'] == source).all()):
+                return table['expnum'], table['mjd']
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    catalog = LL.readDetCache(detFile)
+    if(catalog is not None):
+        expnum = catalog.col('expnum')
+        mjd = catalog.col('mjd')
+    else:
+        columns = LL.csvColumns(detFile, ['expnum', 'mjd'])
+        df = pd.read_csv(detFile, usecols=list(columns.values()),
+                dtype=dict((orig, LL.CSV_DTYPES[name]) for name, orig in columns.items()))
+        expnum = df[columns['expnum']].values
+        mjd = df[columns['mjd']].values
+    exps, first = np.unique(expnum, return_index=True)
+    mjd = np.asarray(mjd[first], dtype='f8')
+    # written under another name first so a half written table is never read
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, expnum=exps, mjd=mjd, source=source)
+    os.rename(tmp, path)
+    return exps, mjd
+
+'''
+input: --the command line options (options)
+       --exposure numbers (expnums)
+output: --the mjd of each exposure, from the detection file
+'''
+def expnumMjds(options, expnums):
+    detFile = options.get('detections', os.environ.get('FAKE_BULK_DETECTIONS'))
+    if(detFile is None):
+        raise RuntimeError('set -detections= or FAKE_BULK_DETECTIONS to a detection file')
+    exps, mjd = exposureTable(detFile)
+    pos = np.minimum(np.searchsorted(exps, expnums), len(exps)-1)
+    if(len(exps) == 0 or (exps[pos] != expnums).any()):
+        raise RuntimeError('exposure not in ' + detFile)
+    return mjd[pos]
+
+# Sleeps for the latency per row given by -latency= or $FAKE_BULK_LATENCY.
+def wait(options, rows):
+    latency = float(options.get('latency', os.environ.get('FAKE_BULK_LATENCY', 0)))
+    if(latency > 0):
+        time.sleep(latency*rows)
+
+# Returns the RA0, DEC0 and MJD0 in the header of a table.
+def frame(meta):
+    return float(meta['RA0']), float(meta['DEC0']), float(meta['MJD0'])
+
+# Makes up orbital elements from the columns of ABG.
+def fakeElements(abg):
+    rate = np.hypot(abg[:, 3], abg[:, 4])*180/np.pi
+    a = 1 + 0.985/np.maximum(rate, 1e-6)
+    elements = np.zeros((len(abg), 6))
+    elements[:, 0] = a
+    elements[:, 2] = np.degrees(np.abs(np.arctan2(abg[:, 4], abg[:, 3]))) % 90
+    elements[:, 3] = np.degrees(abg[:, 0]) % 360
+    return elements, np.tile(np.eye(6).ravel()*1e-4, (len(abg), 1))
+
+'''
+input: --orbits from a .orbit file, with the columns of fakeBulkFit (orbits)
+       --rows of those orbits to predict (idx)
+       --mjds to predict at (mjd)
+       --RA0, DEC0 and MJD0 of the orbit file (ra0, dec0, mjd0)
+output: --the predicted ra, dec and the error of the position in degrees
+'''
+def predict(orbits, idx, mjd, ra0, dec0, mjd0):
+    abg = orbits['ABG'][idx]
+    cov = orbits['ABGCOV'][idx]
+    dt = mjd - mjd0
+    x = np.degrees(abg[:, 0] + abg[:, 3]*dt)
+    y = np.degrees(abg[:, 1] + abg[:, 4]*dt)
+    var = cov[:, 0] + cov[:, 21]*dt**2 + cov[:, 7] + cov[:, 28]*dt**2
+    err = np.degrees(np.sqrt(np.maximum(var, 0)))
+    ra, dec = LL.gnomonicInverse(x, y, ra0, dec0)
+    return ra, dec, np.maximum(err, 0.1/3600)
+
+'''
+input: --the command line options, -observationFile= and -orbitFile= (options)
+output: --fits a line to the observations of every ORBITID and writes CHISQ, DOF,
+          FLAGS, ELEMENTS, ELCOV, ABG and ABGCOV to the orbit file
+'''
+def fakeBulkFit(options):
+    obs = Table.read(options['observationFile'], format='fits')
+    ra0, dec0, mjd0 = frame(obs.meta)
+    wait(options, len(obs))
+    ids, group = np.unique(np.asarray(obs['ORBITID']), return_inverse=True)
+    dt = expnumMjds(options, np.asarray(obs['EXPNUM'])) - mjd0
+    x, y = LL.gnomonic(np.asarray(obs['RA']), np.asarray(obs['DEC']), ra0, dec0)
+    w = 1/np.maximum(np.asarray(obs['SIGMA'])/3600, 1e-6)**2
+    def total(values):
+        return np.bincount(group, values, minlength=len(ids))
+    n = total(np.ones(len(obs)))
+    S, St, Stt = total(w), total(w*dt), total(w*dt*dt)
+    det = S*Stt - St**2
+    ok = (n >= 3) & (det > 0)
+    det = np.where(ok, det, 1)
+    fit = []
+    chisq = np.zeros(len(ids))
+    for pos in (x, y):
+        Sp, Stp = total(w*pos), total(w*dt*pos)
+        p0 = (Stt*Sp - St*Stp)/det
+        v = (S*Stp - St*Sp)/det
+        chisq += total(w*(pos - p0[group] - v[group]*dt)**2)
+        fit.append((np.radians(p0), np.radians(v)))
+    (x0, vx), (y0, vy) = fit
+    abg = np.column_stack((x0, y0, np.zeros(len(ids)), vx, vy, np.zeros(len(ids))))
+    abgcov = np.zeros((len(ids), 36))
+    abgcov[:, 0] = abgcov[:, 7] = np.radians(1)**2*Stt/det
+    abgcov[:, 21] = abgcov[:, 28] = np.radians(1)**2*S/det
+    elements, elcov = fakeElements(abg)
+    abg[:, 2] = 1/elements[:, 0]
+    orbits = Table([ids.astype('i8'), np.where(ok, chisq, -1), (2*n - 4).astype('i4'),
+                    np.where(ok, 0, 1).astype('i4'), elements, elcov, abg, abgcov],
+                   names=('ORBITID', 'CHISQ', 'DOF', 'FLAGS', 'ELEMENTS', 'ELCOV', 'ABG', 'ABGCOV'))
+    orbits.meta.update({'RA0': ra0, 'DEC0': dec0, 'MJD0': mjd0})
+    orbits.write(options['orbitFile'], format='fits', overwrite=True)
+
+'''
+input: --the command line options, -orbitFile= (options)
+output: --writes ELEMENTS and ELCOV of the orbit file again from ABG
+'''
+def fakeBulkElements(options):
+    orbits = Table.read(options['orbitFile'], format='fits')
+    wait(options, len(orbits))
+    orbits['ELEMENTS'], orbits['ELCOV'] = fakeElements(np.asarray(orbits['ABG']))
+    orbits.write(options['orbitFile'], format='fits', overwrite=True)
+
+'''
+input: --the command line options, -observationFile= with ORBITID and MJD,
+         -orbitFile= and -predictFile= (options)
+output: --writes ORBITID, MJD, RA, DEC, ERROR_A, ERROR_B and PA to the predict file,
+          for the rows with an ORBITID in the orbit file
+'''
+def fakeBulkPredict(options):
+    request = Table.read(options['observationFile'], format='fits')
+    orbits = Table.read(options['orbitFile'], format='fits')
+    wait(options, len(request))
+    ra0, dec0, mjd0 = frame(orbits.meta)
+    orbitids = np.asarray(orbits['ORBITID'])
+    order = np.argsort(orbitids, kind='mergesort')
+    pos = np.minimum(np.searchsorted(orbitids[order], request['ORBITID']), len(orbitids)-1)
+    found = orbitids[order][pos] == np.asarray(request['ORBITID'])
+    idx = order[pos][found]
+    mjd = np.asarray(request['MJD'])[found]
+    ra, dec, err = predict(orbits, idx, mjd, ra0, dec0, mjd0)
+    abg = np.asarray(orbits['ABG'])[idx]
+    pa = np.degrees(np.arctan2(abg[:, 3], abg[:, 4])) % 180
+    Table([np.asarray(request['ORBITID'])[found], mjd, ra, dec, err*3600, err*3600/2, pa],
+          names=('ORBITID', 'MJD', 'RA', 'DEC', 'ERROR_A', 'ERROR_B', 'PA')).write(
+          options['predictFile'], format='fits', overwrite=True)
+
+'''
+input: --the command line options, -observationFile= with ORBITID, OBJ_ID, EXPNUM,
+         RA, DEC and SIGMA, -orbitFile= and -chisqFile= (options)
+output: --writes ORBITID, OBJ_ID and the CHISQ of each detection against the
+          predicted position of its orbit to the chisq file
+'''
+def fakeBulkProximity(options):
+    request = Table.read(options['observationFile'], format='fits')
+    orbits = Table.read(options['orbitFile'], format='fits')
+    wait(options, len(request))
+    ra0, dec0, mjd0 = frame(orbits.meta)
+    orbitids = np.asarray(orbits['ORBITID'])
+    order = np.argsort(orbitids, kind='mergesort')
+    pos = np.minimum(np.searchsorted(orbitids[order], request['ORBITID']), len(orbitids)-1)
+    found = orbitids[order][pos] == np.asarray(request['ORBITID'])
+    request = request[found]
+    mjd = expnumMjds(options, np.asarray(request['EXPNUM']))
+    ra, dec, err = predict(orbits, order[pos][found], mjd, ra0, dec0, mjd0)
+    x, y = LL.gnomonic(np.asarray(request['RA']), np.asarray(request['DEC']), ra, dec)
+    sigma = np.asarray(request['SIGMA'])/3600
+    chisq = (x**2 + y**2)/(err**2 + sigma**2)
+    Table([np.asarray(request['ORBITID']), np.asarray(request['OBJ_ID']), chisq],
+          names=('ORBITID', 'OBJ_ID', 'CHISQ')).write(
+          options['chisqFile'], format='fits', overwrite=True)
+
+TOOLS = {'BulkFit': fakeBulkFit, 'BulkElements': fakeBulkElements,
+         'BulkPredict': fakeBulkPredict, 'BulkProximity': fakeBulkProximity}
+
+def main():
+    if(len(sys.argv) < 2 or sys.argv[1] not in TOOLS):
+        sys.stderr.write('usage: fakeBulk.py ' + '|'.join(sorted(TOOLS)) + ' -name=value ...\n')
+        sys.exit(2)
+    try:
+        TOOLS[sys.argv[1]](parseOptions(sys.argv[2:]))
+    except Exception as e:
+        sys.stderr.write(sys.argv[1] + ': ' + str(e) + '\n')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+# Runs the external orbit fitter BulkFit on a request file.
+# The request is split by ORBITID into shards that are fit by separate BulkFit processes at the same time,
+# and the .orbit outputs are put back together in ORBITID order.
+# Fits can be kept in a FitCache so an orbit with the same observations is only ever fit once.
+import sys
+import os
+tnopath = os.environ['TNO_PATH']
+sys.path.insert(0, tnopath)
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import subprocess
+from collections import OrderedDict
+try:
+   import cPickle as pickle
+except:
+   import pickle
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table, vstack
+
+'''
+input: --a command as a list of arguments (cmd)
+output: --raises RuntimeError if it does not exit with 0
+'''
+def runCommand(cmd):
+    print(' '.join(cmd))
+    ret = subprocess.call(cmd)
+    if(ret != 0):
+        raise RuntimeError(cmd[0] + ' exited with ' + str(ret))
+
+'''
+input: --a fits request file with an ORBITID column (requestFile)
+       --number of shards (nShards)
+       --directory for the shard files (shardDir)
+output: --the names of the shard files, each holding the rows of a run of
+          ORBITIDs, in increasing ORBITID order
+'''
+def splitRequest(requestFile, nShards, shardDir):
+    with fits.open(requestFile) as hdul:
+        primary = hdul[0].header.copy()
+        header = hdul[1].header.copy()
+        data = hdul[1].data
+        orbitids = np.asarray(data['ORBITID'])
+        order = np.argsort(orbitids, kind='mergesort')
+        ids, starts = np.unique(orbitids[order], return_index=True)
+        nShards = max(1, min(nShards, len(ids)))
+        # split on whole orbits so every orbit is fit by one process
+        cuts = [starts[len(ids)*s//nShards] for s in range(1, nShards)]
+        names = []
+        for s, rows in enumerate(np.split(order, cuts)):
+            name = os.path.join(shardDir, 'shard{0:03d}.fits'.format(s))
+            shard = fits.BinTableHDU(data=data[rows], header=header)
+            fits.HDUList([fits.PrimaryHDU(header=primary), shard]).writeto(name, overwrite=True)
+            names.append(name)
+    return names
+
+'''
+input: --a list of .orbit files from the shards (shardOrbits)
+       --name of the combined .orbit file (orbitFile)
+output: --writes the rows of every shard to orbitFile, sorted by ORBITID, with
+          the headers of the first shard
+'''
+def joinOrbits(shardOrbits, orbitFile):
+    tables = [Table.read(name, hdu=1) for name in shardOrbits]
+    orbits = vstack(tables, metadata_conflicts='silent')
+    orbits = orbits[np.argsort(np.asarray(orbits['ORBITID']), kind='mergesort')]
+    orbits.meta = tables[0].meta
+    primary = fits.getheader(shardOrbits[0], 0)
+    hdul = fits.HDUList([fits.PrimaryHDU(header=primary), fits.table_to_hdu(orbits)])
+    hdul.writeto(orbitFile, overwrite=True)
+
+'''
+input: --fits file with the observations of each orbit (requestFile)
+       --name of the .orbit file to write (orbitFile)
+       --number of BulkFit processes to run at once (nShards)
+       --extra command line options for BulkFit, e.g. ['-bindingFactor=1']
+       --a FitCache to take fits from and add new fits to (cache), see runCachedBulkFit
+output: --the name of the .orbit file
+'''
+def runBulkFit(requestFile, orbitFile, nShards=1, options=[], cache=None, matchFrame=True):
+    if(cache is not None):
+        return runCachedBulkFit(requestFile, orbitFile, nShards, options, cache, matchFrame)
+    print('running BulkFit on ' + str(nShards) + ' processes...')
+    time0 = time.time()
+    if(nShards <= 1):
+        runCommand(['BulkFit', '-observationFile=' + requestFile,
+                    '-orbitFile=' + orbitFile] + list(options))
+        print('done running BulkFit after ' + str(time.time()-time0) + ' seconds')
+        return orbitFile
+    shardDir = tempfile.mkdtemp(prefix=os.path.basename(orbitFile) + '.',
+                    dir=os.path.dirname(os.path.abspath(orbitFile)))
+    try:
+        shards = splitRequest(requestFile, nShards, shardDir)
+        procs = []
+        for shard in shards:
+            cmd = ['BulkFit', '-observationFile=' + shard,
+                   '-orbitFile=' + os.path.splitext(shard)[0] + '.orbit'] + list(options)
+            procs.append((cmd, subprocess.Popen(cmd)))
+        failed = []
+        for cmd, proc in procs:
+            if(proc.wait() != 0):
+                failed.append(' '.join(cmd) + ' exited with ' + str(proc.returncode))
+        if(failed):
+            raise RuntimeError('BulkFit failed:\n' + '\n'.join(failed))
+        joinOrbits([os.path.splitext(shard)[0] + '.orbit' for shard in shards], orbitFile)
+    finally:
+        shutil.rmtree(shardDir, ignore_errors=True)
+    print('done running BulkFit after ' + str(time.time()-time0) + ' seconds')
+    return orbitFile
+
+# Where the fit cache is kept unless a script is told otherwise.
+FIT_CACHE = os.environ.get('FIT_CACHE', 'fitCache.db')
+
+'''
+input: --the rows of a request file for one orbit (rows)
+       --extra command line options for BulkFit (options)
+output: --sha1 of the observations sorted by OBJID and the options, the same
+          for every request that fits those observations the same way
+          fits with other options get other keys and are never shared: siftTriplets fits
+          with -bindingFactor=1 and mergeTrips without it, so mergeTrips does not take
+          the fits of siftTriplets, only those of its own earlier rounds and runs
+'''
+def fitKey(rows, options=[]):
+    rows = rows[np.argsort(rows['OBJID'], kind='mergesort')]
+    h = hashlib.sha1()
+    for name in ('OBJID', 'EXPNUM', 'RA', 'DEC', 'SIGMA'):
+        h.update(np.ascontiguousarray(rows[name], dtype='f8' if name in ('RA', 'DEC', 'SIGMA') else 'i8').tobytes())
+    h.update(' '.join(sorted(options)).encode('ascii'))
+    return h.hexdigest()
+
+# An sqlite file of BulkFit results keyed by fitKey. Each entry keeps the whole
+# .orbit row (CHISQ, DOF, FLAGS, ELEMENTS, ELCOV, ABG, ABGCOV, ...) and the
+# RA0, DEC0 and MJD0 of the request it was fit in, which ABG is relative to.
+# Callers that use ABG (siftTriplets, whose orbits go to BulkPredict) only take
+# entries fit in the frame of their request; callers that only read CHISQ, DOF
+# and FLAGS (mergeTrips) take them from any frame.
+class FitCache(object):
+    def __init__(self, path=FIT_CACHE):
+        self.path = path
+        # siftTriplets opens the cache in one thread and fits in another
+        self.db = sqlite3.connect(path, timeout=600, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, '
+                'chisq REAL, dof INTEGER, flags INTEGER, ra0 REAL, dec0 REAL, mjd0 REAL, '
+                'meta TEXT, row BLOB)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS metas (key TEXT PRIMARY KEY, meta BLOB)')
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM fits').fetchone()[0]
+
+    '''
+    input: --fitKeys to look up (keys)
+           --the (RA0, DEC0, MJD0) an entry has to be fit in, None for any (frame)
+    output: --a dictionary from key to (row, meta) for the keys found
+    '''
+    def get(self, keys, frame=None):
+        found = {}
+        metas = {}
+        keys = list(keys)
+        for x in range(0, len(keys), 500):
+            batch = keys[x:x+500]
+            query = ('SELECT key, ra0, dec0, mjd0, meta, row FROM fits WHERE key IN (' +
+                    ','.join('?'*len(batch)) + ')')
+            for key, ra0, dec0, mjd0, meta, row in self.db.execute(query, batch):
+                if(frame is not None and (ra0, dec0, mjd0) != tuple(frame)):
+                    continue
+                if(meta not in metas):
+                    blob = self.db.execute('SELECT meta FROM metas WHERE key=?', (meta,)).fetchone()[0]
+                    metas[meta] = pickle.loads(bytes(blob))
+                found[key] = (pickle.loads(bytes(row)), metas[meta])
+        return found
+
+    '''
+    input: --a dictionary from key to a row of an .orbit table as a dictionary (rows)
+           --the header of the .orbit table (meta)
+           --the (RA0, DEC0, MJD0) of the request (frame)
+    output: --adds the rows to the cache, replacing older fits of the same keys
+    '''
+    def put(self, rows, meta, frame):
+        blob = pickle.dumps(dict(meta), pickle.HIGHEST_PROTOCOL)
+        metaKey = hashlib.sha1(blob).hexdigest()
+        self.db.execute('INSERT OR IGNORE INTO metas VALUES (?, ?)', (metaKey, sqlite3.Binary(blob)))
+        entries = []
+        for key, row in rows.items():
+            entries.append((key, float(row['CHISQ']), int(row['DOF']), int(row['FLAGS']),
+                    frame[0], frame[1], frame[2], metaKey,
+                    sqlite3.Binary(pickle.dumps(row, pickle.HIGHEST_PROTOCOL))))
+        self.db.executemany('INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', entries)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+'''
+input: --fits file with the observations of each orbit (requestFile)
+       --name of the .orbit file to write (orbitFile)
+       --number of BulkFit processes to run at once (nShards)
+       --extra command line options for BulkFit (options)
+       --a FitCache (cache)
+       --whether a cached fit has to be in the frame of this request (matchFrame);
+         without it ABG and ABGCOV of cached rows may be relative to another frame
+output: --the name of the .orbit file, with a row for every orbit BulkFit fit,
+          where only the orbits not in the cache were sent to BulkFit
+'''
+def runCachedBulkFit(requestFile, orbitFile, nShards=1, options=[], cache=None, matchFrame=True):
+    with fits.open(requestFile) as hdul:
+        primary = hdul[0].header.copy()
+        header = hdul[1].header.copy()
+        data = hdul[1].data
+        frame = (float(header['RA0']), float(header['DEC0']), float(header['MJD0']))
+        order = np.argsort(data['ORBITID'], kind='mergesort')
+        ids, starts = np.unique(np.asarray(data['ORBITID'])[order], return_index=True)
+        groups = np.split(order, starts[1:])
+        keys = [fitKey(data[rows], options) for rows in groups]
+        found = cache.get(set(keys), frame if matchFrame else None)
+        miss = [x for x in range(len(ids)) if keys[x] not in found]
+        print('found ' + str(len(ids)-len(miss)) + ' of ' + str(len(ids)) +
+                ' orbits in ' + cache.path)
+        missRows = np.concatenate([groups[x] for x in miss]) if miss else None
+        if(missRows is not None):
+            workDir = tempfile.mkdtemp(prefix=os.path.basename(orbitFile) + '.',
+                    dir=os.path.dirname(os.path.abspath(orbitFile)))
+            missFile = os.path.join(workDir, 'miss.fits')
+            fits.HDUList([fits.PrimaryHDU(header=primary),
+                    fits.BinTableHDU(data=data[missRows], header=header)]).writeto(missFile)
+    fitted = {}
+    meta = None
+    if(missRows is not None):
+        try:
+            runBulkFit(missFile, os.path.join(workDir, 'miss.orbit'), nShards, options)
+            table = Table.read(os.path.join(workDir, 'miss.orbit'), hdu=1)
+            orbitPrimary = fits.getheader(os.path.join(workDir, 'miss.orbit'), 0)
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+        meta = table.meta
+        keyOf = dict((int(ids[x]), keys[x]) for x in miss)
+        for row in table:
+            fitted[int(row['ORBITID'])] = OrderedDict((name, row[name]) for name in table.colnames)
+        cache.put(dict((keyOf[orbitid], row) for orbitid, row in fitted.items()), meta, frame)
+    else:
+        orbitPrimary = primary
+    rows = []
+    for x in range(len(ids)):
+        orbitid = int(ids[x])
+        if(orbitid in fitted):
+            rows.append(fitted[orbitid])
+        elif(keys[x] in found):
+            row, cachedMeta = found[keys[x]]
+            row = OrderedDict(row)
+            row['ORBITID'] = orbitid
+            rows.append(row)
+            if(meta is None):
+                meta = cachedMeta
+    if(len(rows) == 0):
+        raise RuntimeError('BulkFit returned no orbits for ' + requestFile)
+    names = list(rows[0].keys())
+    orbits = Table([np.array([row[name] for row in rows]) for name in names], names=names)
+    orbits.meta = meta
+    hdul = fits.HDUList([fits.PrimaryHDU(header=orbitPrimary), fits.table_to_hdu(orbits)])
+    hdul.writeto(orbitFile, overwrite=True)
+    return orbitFile
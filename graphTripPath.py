@@ -68,8 +68,13 @@ def findMiss(trip, fakes):
     return missFakes
 
 # Runs the graph image function (graph_points) for each triplet.
+# fakeDict is a dictionary from ll.fakeDict or a DetectionCatalog
 def graph_triplets(triplets, savename1, orbs, fakeDict=0):
+    if(isinstance(fakeDict, ll.DetectionCatalog)):
+        fakeDict = ll.fakeDict(fakeDict)
     print('\nplotting graphs')
+    # fits the orbits getChiSq needs below all at once
+    ll.setOrbits([trip for trip in triplets if trip.chiSq == -1])
     counter = 0
     time0 = time.time()
     for trip in triplets:
@@ -116,14 +121,9 @@ Returns: a list of tuples consisting of predicted ra and dec values of trip (coo
 '''
 def generate_predictions(trip, mjd1, mjd2, orbfile):
     outname = gt.writeNites([trip], range(int(mjd1), int(mjd2), 2), 2, 'graph_path.fits')
-    trackToDf = gt.callMjdPrediction(outname, outname.split('.')[0] + '.pred', orbfile)
-    coords =[]
-    for trackid in trackToDf.iterkeys():
-        for mjd in sorted(trackToDf[trackid].iterkeys()):
-            ra = trackToDf[trackid][mjd].RA
-            dec = trackToDf[trackid][mjd].DEC
-            coords.append((ra,dec))
-    return coords
+    predictions = gt.callMjdPrediction(outname, outname.split('.')[0] + '.pred', orbfile)
+    # the predictions are sorted by trackid, then mjd
+    return list(zip(predictions.col('RA').tolist(), predictions.col('DEC').tolist()))
 
 # Generates fake predictions.
 # Input and returns are the same as above excluding orbfile.
@@ -134,15 +134,9 @@ def generate_fake_preds(trip, mjd1, mjd2):
             fakeDets.append(det)
     #fakeDets = [x for x in trip.dets if x.fakeid == fakeid]
     fakeTrip = Triplet(fakeDets)
-    coords = []
-    for days in range(int(mjd1), int(mjd2), 1):
-        coordinate = fakeTrip.predictPos(days)
-        coor = list(coordinate[0])
-        if coor[0] > 180:
-            coor[0] = coor[0]-360
-        # Ensures ra is between -180 and 180.
-        coords.append(coor)
-    return coords
+    # predictPositions already puts ra between -180 and 180
+    coords, _, _, _ = fakeTrip.predictPositions(np.arange(int(mjd1), int(mjd2), 1))
+    return coords.tolist()
 
 def main():
     args = argparse.ArgumentParser()
@@ -153,7 +147,7 @@ def main():
     triplets = pickle.load(open(args.triplets, 'rb'))
     # Opens the binary file specified in the first command line argument as read-only.
     if(args.csvDetectionFile):
-        fakeDict = ll.fakeDict(args.csvDetectionFile)
+        fakeDict = ll.loadCatalog(args.csvDetectionFile)
     else:
         fakeDict = 0
     orbs = args.triplets
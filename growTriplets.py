@@ -11,7 +11,6 @@ except KeyError:
 sys.path.insert(0, tnopath)
 
 import numpy as np
-import pandas as pd
 import scipy.spatial as sp
 import argparse
 try:
@@ -19,17 +18,17 @@ try:
 except:
    import pickle
 import time
+from multiprocessing import Pool
 
 from astropy.table import Table
 from astropy.table import unique
 
 import random
-import heapq
-from operator import itemgetter
 from collections import namedtuple
 
 import LinkerLib as LL
 from LinkerLib import Triplet, Detection
+import fitRunner
 
 # Returns the size of number in an easily understandable and human-readable format i.e. 10 KiB
 def sizeof_fmt(num, suffix='B'):
@@ -43,26 +42,12 @@ def sizeof_fmt(num, suffix='B'):
 '''
 Converts RA, DEC to x,y in gnomonic coordinates using pixmappy so we can use an Euclidean metric for the FoF
 Takes and returns values in degrees
-ra and dec are the values to convert
+ra and dec are the values to convert, scalars or arrays; ra may be in 0 to 360 or -180 to 180
 ra_0 and dec_0 are reference values (should be near the center of all values)
+LL.gnomonicInverse goes back to ra and dec
 '''
 def radec_to_gnomonic(ra, dec, ra_0, dec_0):
-
-    if(ra>180):
-        ra = ra - 360
-    
-    c_dec_0 = np.cos(np.pi*dec_0/180.)
-    s_dec_0 = np.sin(np.pi*dec_0/180.)
-    c_dec   = np.cos(np.pi*dec/180.)
-    s_dec   = np.sin(np.pi*dec/180.)
-    c_ra    = np.cos(np.pi*(ra-ra_0)/180.)
-    s_ra    = np.sin(np.pi*(ra-ra_0)/180.)
-
-    cos_c = s_dec_0*s_dec + c_dec_0*c_dec*c_ra
-
-    x = c_dec*s_ra/cos_c
-    y = (c_dec_0*s_dec - s_dec_0*c_dec*c_ra)/cos_c
-    return 180*x/np.pi, 180*y/np.pi
+    return LL.gnomonic(ra, dec, ra_0, dec_0)
 
 
 """ 
@@ -71,64 +56,74 @@ def radec_to_gnomonic(ra, dec, ra_0, dec_0):
 #Note: I should check how much the object moves in a given time span
 """
 
-# Makes a dictionary that maps MJD range to list of corresponding detections
+# The detections of one MJD range, or the candidates of a search, one array per field
+Det = namedtuple('Det', 'objid ra dec mjd expnum err')
+
+# Makes a dictionary that maps MJD range to the corresponding detections, as a Det of arrays
+# dets is a DetectionCatalog, or columns by name such as a DataFrame
 def mjd_det_dict(dets, interval=20):
+    if(isinstance(dets, LL.DetectionCatalog)):
+        dets = dets.toFrame(['objid', 'ra', 'dec', 'mjd', 'expnum', 'posErr'])
+        dets.rename(columns={'posErr': 'err'}, inplace=True)
+    columns = Det(*[np.asarray(dets[name]) for name in Det._fields])
+    bins = (columns.mjd / interval).astype(int) * interval
+    order = np.argsort(bins, kind='mergesort')
+    keys, starts = np.unique(bins[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
     mjd_dict = dict()
-    Det = namedtuple('Det', 'objid ra dec mjd expnum err')
-    for det in dets.itertuples():
-        mjd = int(det.mjd / interval) * interval
-        d = Det(objid=det.objid, ra=det.ra, dec=det.dec, 
-                    mjd=det.mjd,err=det.err,expnum=det.expnum)
-        mjd_dict.setdefault(mjd, []).append(d)
-    #pdb.set_trace()
+    for mjd, start, end in zip(keys.tolist(), starts, ends):
+        rows = order[start:end]
+        mjd_dict[mjd] = Det(*[column[rows] for column in columns])
     return mjd_dict
 
-# Makes a dictionary that maps MJD range to KD tree for the detections from 1
-def mjd_kd_tree_dict(mjd_det, ra_0, dec_0):
-    kd_dict = dict()
-    detlist_dict = dict()
-    for key, value in mjd_det.iteritems():
-        arr = [radec_to_gnomonic(x.ra, x.dec, ra_0, dec_0) for x in value]
-        kd_dict[key] = sp.cKDTree(arr)
-        detlist_dict[kd_dict[key]] = value
-    return kd_dict, detlist_dict
-    
+# Returns the unit vectors of ra, dec in degrees, one row per position
+def unit_vectors(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)))
+
+'''
+input: --ra and dec in degrees, arrays (ra, dec)
+       --about how wide a tile is in degrees (tileSize)
+output: --the sky tile of every position; the sky is cut into bands of dec tileSize
+          high, and each band into equal ranges of ra about tileSize wide on the sky
+'''
+def sky_tiles(ra, dec, tileSize):
+    nBands = int(np.ceil(180./tileSize))
+    band = np.clip(((np.asarray(dec) + 90)/tileSize).astype(int), 0, nBands-1)
+    nRa = tiles_in_band(band, tileSize)
+    raIdx = np.minimum(((np.asarray(ra) % 360)/360*nRa).astype(int), nRa-1)
+    return band*(int(360/tileSize)+1) + raIdx
+
+# Returns the number of ra ranges in each band of sky_tiles
+def tiles_in_band(band, tileSize):
+    low = -90 + band*tileSize
+    high = np.minimum(low + tileSize, 90)
+    widest = np.cos(np.radians(np.where(low*high < 0, 0, np.minimum(np.abs(low), np.abs(high)))))
+    return np.maximum(1, np.floor(360*widest/tileSize)).astype(int)
 
 # Converts the mjds into a numpy array.
 def mjd_generator(mjd_det):
-    arr = mjd_det.keys()
+    arr = list(mjd_det.keys())
     return np.array(arr)
 
-# Converts a dictionary of detections into gnomonic coordinates.
-# ra0 and dec0 are reference values (should be near the center of all values).
-def toGenomic(trackDict, ra0, dec0):
-    for key in trackDict.keys():
-        for mjd in trackDict[key].keys():
-            item = radec_to_gnomonic(trackDict[key][mjd].RA, 
-                                    trackDict[key][mjd].DEC, ra0, dec0)
-            item = list(item)
-            item.append(trackDict[key][mjd].ERR) 
-            trackDict[key][mjd] = item
-
-    return trackDict
 '''
-input: --trackid to mjd to position and error dictionary
-       --trackid of triplet
-       --mjd of radius that needs to be found
+input: --the predictions, a LL.PredictionTable
+       --trackids of triplets and the mjds of the ranges, one per trackid (trackids, mjds)
        --interval of the mjd range
-output: --maximum radius of where a detection should in a certain mjd
+output: --the predicted ra, dec of each track at its mjd
+        --maximum radius in degrees of where a detection of each track should be in its
+          mjd range, measured on the plane tangent at the prediction
 '''
-def search_radius(trackMJDtoPos, trackid, mjd, interval=2, errSize=3):
-    posC = trackMJDtoPos[trackid][mjd]
-    pos2 = trackMJDtoPos[trackid][mjd+interval]
-    pos3 = trackMJDtoPos[trackid][mjd-interval]
-    #distance from the two 
-    dist2 = np.sqrt((pos2[0]-posC[0])**2 + (pos2[1]-posC[1])**2)
-    dist3 = np.sqrt((pos3[0]-posC[0])**2 + (pos3[1]-posC[1])**2)
-    dist2 += pos2[2]*errSize/3600 
-    dist3 += pos3[2]*errSize/3600
-
-    return max(dist2, dist3)
+def search_radius(predictions, trackids, mjds, interval=2, errSize=3):
+    raC, decC = predictions.lookup(trackids, mjds, ('RA', 'DEC'))
+    radius = np.zeros(len(raC))
+    for mjd in (mjds+interval, mjds-interval):
+        ra, dec, err = predictions.lookup(trackids, mjd)
+        #distance from the two 
+        x, y = radec_to_gnomonic(ra, dec, raC, decC)
+        radius = np.maximum(radius, np.hypot(x, y) + err*errSize/3600)
+    return raC, decC, radius
 
 '''
 DEPRECATED
@@ -156,26 +151,19 @@ output: --prints the name of outfile
 def writeNites(trips, mjd_arr, interval, outfile):
    
     time0 = time.time()
-    trackCol = []
-    mjdCol = []
-    for trip in trips:
-        # When called by generate_predictions in graphTripPath, only runs once
-        mjdDict = {}
-        for mjd in mjd_arr:
-            if(mjd not in mjdDict):
-                mjdCol.append(mjd)
-                trackCol.append(int(trip.trackid))
-                mjdDict[mjd] = 1
-            if((mjd + interval) not in mjdDict):
-                mjdCol.append(mjd+interval)
-                trackCol.append(int(trip.trackid))
-                mjdDict[mjd+interval] = 1
-            if((mjd - interval) not in mjdDict):
-                mjdCol.append(mjd-interval)
-                trackCol.append(int(trip.trackid))
-                mjdDict[mjd-interval] = 1
-    outTable = Table([trackCol, mjdCol], 
-                names=('ORBITID', 'MJD'), dtype=['int64', 'f8'])
+    # every triplet is predicted at the same mjds, each mjd and the mjds
+    # one interval either side of it, each only once
+    mjds = []
+    mjdDict = {}
+    for mjd in mjd_arr:
+        for m in (mjd, mjd + interval, mjd - interval):
+            if(m not in mjdDict):
+                mjds.append(m)
+                mjdDict[m] = 1
+    mjds = np.array(mjds, dtype='f8')
+    trackids = np.array([int(trip.trackid) for trip in trips], dtype='i8')
+    outTable = Table([np.repeat(trackids, len(mjds)), np.tile(mjds, len(trackids))],
+                names=('ORBITID', 'MJD'), copy=False)
     print('writing to: ' + outfile) 
     outTable.write(outfile, format="fits", overwrite=True)
     print('total time: ' + str(time.time()-time0))
@@ -185,220 +173,248 @@ def writeNites(trips, mjd_arr, interval, outfile):
 input: --input file to C code for orbit position predictor
        --output file name 
        --orbital parameter fits file
-output: --dictionary from trackid and mjd to ra, dec, and error
+output: --a LL.PredictionTable of the ra, dec and error of every trackid and mjd
 '''
 def callMjdPrediction(inputFile, outputname, orbitFile, overwrite=True):
     if not os.path.isfile(outputname) or overwrite:
         # If the file doesn't exist or overwrite is true
         # Writes to the file below
-        cmd = 'BulkPredict -observationFile=' + (inputFile)
-        cmd = cmd + ' -orbitFile=' + orbitFile
-        cmd = cmd + ' -predictFile=' + outputname
-        # Writes a shell command
-        #TODO call the code in a way that isn't a disgrace to progammers everywhere
         print('running BulkPredict...')    
-        print(cmd)
         time0 = time.time()
-        os.system(cmd)
-        # Runs the shell command
+        fitRunner.runCommand(['BulkPredict', '-observationFile=' + inputFile,
+                              '-orbitFile=' + orbitFile, '-predictFile=' + outputname])
         print('done after ' + str(time.time()-time0) + ' seconds')
     else:
         print('file already exists: ' + outputname)
     print('reading in ' + outputname)
-    data = Table.read(outputname, format="fits")
-    
-    trackToDf = {}
     time0 = time.time()
-    trackids = data['ORBITID'].tolist()
-    mjds = data['MJD'].tolist()
-    ras = data['RA'].tolist()
-    decs = data['DEC'].tolist()
-    errs = data['ERROR_A'].tolist()
-    nextUp = 60
-    
-    MJD = namedtuple('MJD', 'RA DEC ERR')
-    for x in xrange(len(trackids)):
-        # Is this a typo? (xrange)
-        if time.time() - time0 > nextUp:
-            LL.printPercentage(x, len(trackids), time.time()-time0)
-            nextUp+=60
-        ra = ras[x]
-        dec = decs[x]
-        err = errs[x]
-        mjd = mjds[x]
-        mjdDict = MJD(RA=ra, DEC=dec, ERR=err)
-        if(trackids[x] in trackToDf):
-            trackToDf[trackids[x]][mjd] = mjdDict
-        else:
-            trackToDf[trackids[x]] = {mjd: mjdDict}
-    print('Dictionary time: ' + str(time.time() - time0))
-# #############################################3
-    for name, size in sorted(((name, sys.getsizeof(value)) for name,value in locals().items()), key= lambda x: -x[1])[:10]:
-        print("{:>30}: {:>8}".format(name,sizeof_fmt(size)))
-# #############################################TODO
-
-    return trackToDf
+    predictions = LL.PredictionTable.read(outputname)
+    print('read ' + str(len(predictions)) + ' predictions after ' + str(time.time() - time0) + ' seconds')
+    return predictions
+
+# set in every worker process by initSearch
+_search = None
+
+# Sets what searchTile needs in this process.
+def initSearch(dets, binStarts, binTrees, queries, tileQueries, maxCands, workers):
+    global _search
+    _search = (dets, binStarts, binTrees, queries, tileQueries, maxCands, workers)
 
 '''
-input: --a list of triplets to grow (trips)
-       --a dictionary from trackid and mjd to ra and dec (trackMJDtoPos)
-       --a kdtree for detections at each mjd interval (mjd_det)
-       --a dictionary from kdtree to a list of detections (mjd_arr)
+input: --a sky tile (tile)
+output: --for every prediction in the tile that has detections within its search radius,
+          up to maxCands of the nearest: the index of the prediction, the distance of the
+          detection on the plane tangent at the prediction, and the index of the
+          detection in _search's dets
+'''
+def searchTile(tile):
+    dets, binStarts, binTrees, queries, tileQueries, maxCands, workers = _search
+    qBin, qRa, qDec, qRadius = queries
+    rows = tileQueries[tile]
+    found = []
+    bins, starts = np.unique(qBin[rows], return_index=True)
+    ends = np.append(starts[1:], len(rows))
+    for b, start, end in zip(bins, starts, ends):
+        q = rows[start:end]
+        # a distance of r degrees on the plane tangent at the prediction is an angle of
+        # arctan(radians(r)) on the sky, a chord of 2*sin(angle/2) between the unit vectors
+        # a little wider, so rounding cannot lose a detection on the edge
+        chord = 2*np.sin(np.arctan(np.radians(qRadius[q]))/2)*(1 + 1e-9)
+        local = binTrees[b].query_ball_point(unit_vectors(qRa[q], qDec[q]), chord,
+                workers=workers)
+        counts = np.array([len(x) for x in local], dtype='i8')
+        if(counts.sum() == 0):
+            continue
+        qIdx = np.repeat(q, counts)
+        cand = binStarts[b] + np.concatenate([np.asarray(x, dtype='i8') for x in local])
+        x, y = radec_to_gnomonic(dets.ra[cand], dets.dec[cand], qRa[qIdx], qDec[qIdx])
+        dist = np.hypot(x, y)
+        keep = dist < qRadius[qIdx]
+        found.append((qIdx[keep], dist[keep], cand[keep]))
+    if(len(found) == 0):
+        return tile, np.zeros(0, dtype='i8'), np.zeros(0), np.zeros(0, dtype='i8')
+    qIdx, dist, cand = [np.concatenate(column) for column in zip(*found)]
+    # only the maxCands nearest of each prediction are kept
+    order = np.lexsort((dist, qIdx))
+    qIdx = qIdx[order]
+    first = np.ones(len(qIdx), dtype=bool)
+    first[1:] = qIdx[1:] != qIdx[:-1]
+    starts = np.nonzero(first)[0]
+    rank = np.arange(len(qIdx)) - np.repeat(starts, np.diff(np.append(starts, len(qIdx))))
+    keep = rank < maxCands
+    return tile, qIdx[keep], dist[order][keep], cand[order][keep]
 
-output: --a dictionary from trackid to a list of detections
 '''
-def determineCandsInRadius(trips, trackMJDtoPos, mjd_det, mjd_arr, interval=2, errSize=3):
-    print('making kd_trees')
-    ra_0 = trips[0].dets[0].ra
-    dec_0 = trips[0].dets[0].dec
-    trackMJDtoPos = toGenomic(trackMJDtoPos, ra_0, dec_0)
-    mjd_kd_tree, kd_tree_detlist = mjd_kd_tree_dict(mjd_det, ra_0, dec_0)
-    trackDict = {}
-    counter = 0
-    time0 = time.time()
-    nextUp = 60
+input: --a list of triplets to grow (trips)
+       --the predictions of every trackid and mjd, a LL.PredictionTable (predictions)
+       --the detections of each mjd range, from mjd_det_dict (mjd_det)
+       --an array of the mjd ranges to search (mjd_arr)
+       --number of processes to search the sky tiles with (nProcs)
+       --about how wide a sky tile is in degrees (tileSize)
+
+output: --the trackid of every (track, candidate) pair, in the order of trips, and
+          a Det of arrays with the candidates; the candidates of a track are in the
+          order of mjd_arr, then nearest first
+the predictions are cut into sky tiles that are searched one at a time; each
+prediction looks up the detections of its mjd range in a kd-tree of unit vectors
+and measures them on the plane tangent at itself
+'''
+def determineCandsInRadius(trips, predictions, mjd_det, mjd_arr, interval=2, errSize=3, nProcs=1,
+                           tileSize=10.):
     maxCands = 20
-    print('getting cands')
-    for trip in trips:
-        counter += 1
-        if(time.time()-time0 > nextUp):
-            LL.printPercentage(counter, len(trips), time.time()-time0)
-            nextUp += 60
-        # Prints the function's progress once every minute
-        trackDict[trip.trackid] = []
-        for mjd in mjd_arr:
-            radius = search_radius(trackMJDtoPos, trip.trackid, mjd, interval, errSize)
-            kdtree = mjd_kd_tree[mjd]
-            dets = kd_tree_detlist[kdtree]
-            
-            pos_err = trackMJDtoPos[trip.trackid][mjd]
-            pos = [pos_err[0],pos_err[1]]
-            dists, candKeys = kdtree.query(pos, k=maxCands, distance_upper_bound=radius)
-            candidates = []
-            for i in candKeys:
-                try:
-                    candidates.append(dets[i])
-                except IndexError:
-                    pass
-            #print(len(candidates))
-            if(len(candidates) > maxCands):
-                print('Overflow: num=' + str(len(candidates)))
-                print('radius: ' + str(radius))
-            #elif(len(candidates) > 1):
-            #    print('not overflow: num=' + str(len(candidates)))
-            trackDict[trip.trackid].extend(candidates)
-        #print(len(trackDict[trip.trackid]))
-# #############################################3
-    for name, size in sorted(((name, sys.getsizeof(value)) for name,value in locals().items()),
-                         key= lambda x: -x[1])[:10]:
-        print("{:>30}: {:>8}".format(name,sizeof_fmt(size)))
-# #############################################TODO
- 
-    return trackDict
+    trackids = np.array([trip.trackid for trip in trips], dtype='i8')
+    bins = list(mjd_arr)
+    if(len(trackids) == 0 or len(bins) == 0):
+        return np.zeros(0, dtype='i8'), Det(*[np.zeros(0) for name in Det._fields])
+    time0 = time.time()
+    # every (track, mjd range) to search, track-major
+    qTrack = np.repeat(np.arange(len(trackids)), len(bins))
+    qBin = np.tile(np.arange(len(bins)), len(trackids))
+    qRa, qDec, qRadius = search_radius(predictions, trackids[qTrack],
+            np.asarray(bins, dtype='f8')[qBin], interval, errSize)
+    print('largest search radius: ' + str(qRadius.max()) + ' degrees')
+    qTile = sky_tiles(qRa, qDec, tileSize)
+    order = np.lexsort((qBin, qTile))
+    tiles, starts = np.unique(qTile[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    tileQueries = dict((tile, order[start:end]) for tile, start, end in zip(tiles, starts, ends))
+
+    print('making kd_trees')
+    dets = Det(*[np.concatenate([mjd_det[mjd][x] for mjd in bins]) for x in range(len(Det._fields))])
+    counts = [len(mjd_det[mjd].objid) for mjd in bins]
+    binStarts = np.cumsum(counts) - counts
+    binTrees = [sp.cKDTree(unit_vectors(mjd_det[mjd].ra, mjd_det[mjd].dec)) for mjd in bins]
+
+    print('getting cands in ' + str(len(tiles)) + ' sky tiles')
+    # each process searches a share of the tiles, with one thread each
+    searchArgs = (dets, binStarts, binTrees, (qBin, qRa, qDec, qRadius), tileQueries, maxCands,
+                  1 if nProcs > 1 else -1)
+    tiles = tiles.tolist()
+    if(nProcs > 1):
+        pool = Pool(nProcs, initSearch, searchArgs)
+        results = pool.imap_unordered(searchTile, tiles)
+    else:
+        pool = None
+        initSearch(*searchArgs)
+        results = (searchTile(tile) for tile in tiles)
+    query = []
+    dist = []
+    cand = []
+    for counter, (tile, q, d, c) in enumerate(results):
+        LL.printPercentage(counter+1, len(tiles), time.time()-time0)
+        query.append(q)
+        dist.append(d)
+        cand.append(c)
+    if(pool is not None):
+        pool.close()
+        pool.join()
+    query = np.concatenate(query)
+    dist = np.concatenate(dist)
+    cand = np.concatenate(cand)
+    # every (track, mjd range) is in one tile and every detection in one mjd range,
+    # so a (track, detection) pair is only found once
+    order = np.lexsort((dist, qBin[query], qTrack[query]))
+    query = query[order]
+    cand = cand[order]
+    print('\nfound ' + str(len(cand)) + ' candidates after ' + str(time.time()-time0) + ' seconds')
+    return trackids[qTrack[query]], Det(*[column[cand] for column in dets])
 
 '''
-input: --trackid to cands list dictionary (trackToCandsDict)
+input: --the trackids and candidates from determineCandsInRadius (trackToCands)
        --name of output file (outfile)
 output:
        -- Writes a table consisting of Orbitid, Objid, expnum, ra, dec, and sigma to outfile and
        -- returns the filename of the table (outfile)
 '''
-def writeEllipses(trackToCandsDict, outfile):
-    count = sum(len(v) for v in trackToCandsDict.itervalues())
-    print(count)
-    trackList = np.empty(count)
-    objidList = np.empty(count)
-    expList = np.empty(count)
-    raList = np.empty(count)
-    decList = np.empty(count)
-    errList = np.empty(count)
-    time0 = time.time()
-    nextUp = 60
-    counter = 0
-        
-    for trackid in sorted(trackToCandsDict.iterkeys()):
-        candsList = trackToCandsDict[trackid]
-
-        if(time.time()-time0 > nextUp):
-            LL.printPercentage(counter, count, time.time()-time0)
-            nextUp += 60
-        # Prints the function's progress once every minute
-        for cand in candsList:
-            trackList[counter] = (int(trackid))
-            objidList[counter] = (cand.objid)
-            expList[counter] = (cand.expnum)
-            raList[counter] = (cand.ra)
-            decList[counter] = (cand.dec)
-            errList[counter] = (cand.err)*3600
-            counter+=1
-    # pdb.set_trace()
-    print('writing to fits table')    
-# #############################################3
-    for name, size in sorted(((name, sys.getsizeof(value)) for name,value in locals().items()),
-                         key= lambda x: -x[1])[:10]:
-        print("{:>30}: {:>8}".format(name,sizeof_fmt(size)))
-# #############################################TODO
-    outTable = Table([trackList, objidList, expList, raList, decList, errList], 
-                    names=('ORBITID', 'OBJ_ID', 'EXPNUM', 'RA', 'DEC', 'SIGMA'), 
-                    dtype = ('int64', 'i8', 'i4', 'f8', 'f8', 'f8'))
-    #pdb.set_trace()
-    del trackList
-    del objidList
-    del expList
-    del raList
-    del decList
-    del errList
-    gc.collect()
-#    pdb.set_trace()
+def writeEllipses(trackToCands, outfile):
+    trackids, cands = trackToCands
+    print(len(trackids))
+    return writeEllipseRequest(outfile, trackids, cands.objid, cands.expnum,
+                cands.ra, cands.dec, cands.err)
 
+'''
+input: --name of output file (outfile)
+       --one entry per (track, candidate) pair, grouped by trackid: the trackid
+         and the objid, expnum, ra, dec and position error in degrees of the candidate
+output:
+       -- Writes the same table as writeEllipses in one go and
+       -- returns the filename of the table (outfile)
+'''
+def writeEllipseRequest(outfile, trackids, objid, expnum, ra, dec, err):
+    time0 = time.time()
+    outTable = Table([np.asarray(trackids, dtype='int64'), np.asarray(objid, dtype='i8'),
+                    np.asarray(expnum, dtype='i4'), np.asarray(ra, dtype='f8'),
+                    np.asarray(dec, dtype='f8'), np.asarray(err, dtype='f8')*3600],
+                    names=('ORBITID', 'OBJ_ID', 'EXPNUM', 'RA', 'DEC', 'SIGMA'), copy=False)
     print('writing to: ' + str(outfile))
-    print('total time: ' + str(time.time()-time0))
     outTable.write(outfile, format = "fits", overwrite=True)
- #   pdb.set_trace()
+    print('total time: ' + str(time.time()-time0))
     return outfile
 
 '''
 input: --an input file to orbit prediction fitter code (inputFile)
        --the name of the file to which to write (outputname)
        --the orbit file (orbitFile)
-output: --a dictionary from track_id to objid to how many sigmas away a detection is from the prediction ellipse (trackDict)
+output: --the ORBITID, OBJ_ID and CHISQ columns of the output, how many sigmas away
+          each detection is from the prediction ellipse of its track
 '''
 def callSigmaDet(inputFile, outputname, orbitFile, overwrite=True):
     if(not os.path.isfile(outputname) or overwrite):
         # If the file doesn't exist or overwrite is true
         # Writes to the file below
-        #TODO call the c function in a way that's not a disgrace to programmers everywhere
-        cmd = 'BulkProximity -observationFile=' + (inputFile)
-        cmd = cmd + ' -orbitFile=' + orbitFile
-        cmd = cmd + ' -chisqFile=' + outputname
-        # Writes a shell command (cmd)
         print('running BulkProximity...')
         time0 = time.time()
-        os.system(cmd)
-        # Executes the shell command (cmd)
+        fitRunner.runCommand(['BulkProximity', '-observationFile=' + inputFile,
+                              '-orbitFile=' + orbitFile, '-chisqFile=' + outputname])
         print('done after ' + str(time.time()-time0) + ' seconds')
     else:
         print('file already exists: ' + outputname)
     data = Table.read(outputname, format='fits')
-    
-    print('making dictionary...')
-    time0 = time.time()
-    trackDict = {}
-    trackids = data['ORBITID']
-    objids = data['OBJ_ID']
-    chisq = data['CHISQ']
-    nextUp = 60
-    for x in xrange(len(trackids)):
-        if(time.time()-time0 > nextUp):
-            LL.printPercentage(x, len(objids), time.time()-time0)
-            nextUp+=60
-        # Prints the function's progress once every minute
-        if(trackids[x] in trackDict):
-            trackDict[trackids[x]][objids[x]] = chisq[x]
-        else:
-            trackDict[trackids[x]] = {objids[x]: chisq[x]}
-    print('done after ' + str(time.time()-time0) + ' seconds')
-    return trackDict
+    return (np.asarray(data['ORBITID'], dtype='i8'), np.asarray(data['OBJ_ID'], dtype='i8'),
+            np.asarray(data['CHISQ'], dtype='f8'))
+
+'''
+input: --the trackids of the triplets (trackids)
+       --the objids of the detections of each triplet, those of triplet x are
+         ownObjids[ownPtr[x]:ownPtr[x+1]] (ownPtr, ownObjids)
+       --the ORBITID, OBJ_ID and CHISQ columns from callSigmaDet (orbitid, objid, chisq)
+       --the largest CHISQ of a candidate (thresh)
+       --the most candidates to keep for a triplet (maxCands)
+output: --indptr and objids: the candidates of triplet x are objids[indptr[x]:indptr[x+1]],
+          the detections under thresh that are not in the triplet, smallest CHISQ first
+'''
+def selectCandidates(trackids, ownPtr, ownObjids, orbitid, objid, chisq, thresh, maxCands):
+    trackids = np.asarray(trackids, dtype='i8')
+    ownPtr = np.asarray(ownPtr, dtype='i8')
+    ownObjids = np.asarray(ownObjids, dtype='i8')
+    indptr = np.zeros(len(trackids)+1, dtype='i8')
+    if(len(trackids) == 0 or len(orbitid) == 0):
+        return indptr, np.zeros(0, dtype='i8')
+    # the triplet of every row under the threshold
+    order = np.argsort(trackids, kind='mergesort')
+    pos = np.minimum(np.searchsorted(trackids[order], orbitid), len(trackids)-1)
+    keep = (trackids[order][pos] == orbitid) & (chisq < thresh)
+    track = order[pos[keep]]
+    objid = objid[keep]
+    chisq = chisq[keep]
+    # drop the detections of the triplet itself, comparing with one of them at a time
+    counts = np.diff(ownPtr)
+    own = np.zeros(len(track), dtype=bool)
+    for x in range(counts.max() if len(counts) else 0):
+        has = counts[track] > x
+        own[has] |= ownObjids[ownPtr[track[has]] + x] == objid[has]
+    track = track[~own]
+    objid = objid[~own]
+    chisq = chisq[~own]
+    # the maxCands smallest CHISQ of every triplet
+    order = np.lexsort((objid, chisq, track))
+    track = track[order]
+    counts = np.bincount(track, minlength=len(trackids))
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(len(track)) - starts[track]
+    top = rank < maxCands
+    indptr[1:] = np.cumsum(np.minimum(counts, maxCands))
+    return indptr, objid[order][top]
 
 '''
 input: --list of triplets
@@ -408,16 +424,21 @@ input: --list of triplets
        --errSize
        --name of chunk
        --name of season
+       --mjd_det_dict(dets, interval), to reuse it across chunks (optional)
+       --number of processes to search for candidates with (nProcs)
+       --about how wide a sky tile of the search is in degrees (tileSize)
 output: --the same triplets but with a list of candidates added to their cands field
             these candidates are every detection in the list of detections that 
             falls into their prediciton ellipses 
 
 '''
-def find_candidates(trips, dets, orbitFile, interval=2, errSize=2, chunkname="", savename="", overwrite=True):
+def find_candidates(trips, dets, orbitFile, interval=2, errSize=2, chunkname="", savename="", overwrite=True,
+                    mjd_det=None, nProcs=1, tileSize=10.):
     maxCands = 100
     print('creating dictionaries...')
     # dict from mjd range to detections
-    mjd_det = mjd_det_dict(dets, interval)
+    if(mjd_det is None):
+        mjd_det = mjd_det_dict(dets, interval)
     # a list of mjdi
     mjd_arr = mjd_generator(mjd_det)
     
@@ -432,66 +453,48 @@ def find_candidates(trips, dets, orbitFile, interval=2, errSize=2, chunkname="",
 # ############################TODO
     gc.collect()    
     if(not os.path.isfile(ellRequest) or overwrite):
-        # call C function, get dictionary from trackid to mjd to positions and errors
-        trackMjdPos = callMjdPrediction(mjdPred, predictfile, orbitFile, overwrite)
+        # call C function, get the positions and errors of every trackid and mjd
+        predictions = callMjdPrediction(mjdPred, predictfile, orbitFile, overwrite)
         print('\ndetermining candidates in the maximum radius...')
-        # determine the good candidates, get dictionary from trackid to list of cands
-        trackToCandsDict = determineCandsInRadius(trips, 
-                trackMjdPos, mjd_det, mjd_arr, interval, errSize)
+        # determine the good candidates, get the (trackid, candidate) pairs
+        trackToCands = determineCandsInRadius(trips, 
+                predictions, mjd_det, mjd_arr, interval, errSize, nProcs, tileSize)
         # prepare to call C function to predict ellipses
-        '''
-        for cands in trackToCandsDict:
-            print('trackid: ' + str(cands))
-            print([x.objid for x in trackToCandsDict[cands]])
-        '''
         print('\nwriting to file for ellipse C function...')
+        writeEllipses(trackToCands, ellRequest)
     gc.collect()
-    # call C function, get dictionary from trackid to detections to their sigmas
-    trackCandsSigma = callSigmaDet(ellRequest, proxFile, orbitFile, overwrite)
+    # call C function, get the sigmas of the detections of each trackid
+    orbitid, objid, chisq = callSigmaDet(ellRequest, proxFile, orbitFile, overwrite)
     grownTrips = []
 
     # get all cands that are within errSize sigma of their respective predicitons
     # if greater than maxCands, then just get the smallest sigmas
-    print('\nlooping through triplets...')
+    print('\nselecting candidates...')
     time0 = time.time()
-    for trip in trips:
-        try:
-            candsToSigma = trackCandsSigma[trip.trackid]
-        except KeyError:
-            candsToSigma = {}
-        withinThresh = dict((key, value) for key, value in candsToSigma.iteritems() if value < errSize*10)
-        if(len(withinThresh) > maxCands):
-            withinThresh = heapq.nsmallest(maxCands, withinThresh.items()) 
-        else:
-            withinThresh = withinThresh.items()
-        trip.cands = [i[0] for i in withinThresh]
-        objids = [x.objid for x in trip.dets]
-        trip.cands = [x for x in trip.cands if x not in objids]
+    ownPtr = np.zeros(len(trips)+1, dtype='i8')
+    ownPtr[1:] = np.cumsum([len(trip.dets) for trip in trips])
+    indptr, cands = selectCandidates([trip.trackid for trip in trips], ownPtr,
+            [det.objid for trip in trips for det in trip.dets],
+            orbitid, objid, chisq, errSize*10, maxCands)
+    cands = cands.tolist()
+    for x, trip in enumerate(trips):
+        trip.cands = cands[indptr[x]:indptr[x+1]]
         if(len(trip.cands) >1):
             grownTrips.append(trip)
     print('done after ' + str(time.time()-time0) + ' seconds')
     return grownTrips
 
-# Input: a csv file (csvFile)
-# Output: a pandas DataFrame (df)
-def efficientWrap(csvFile):
-    print('reading csvFile')
-    df = pd.read_csv(csvFile)
-    print('converting')
-    df.rename(str.lower, axis='columns', inplace=True)
-    df.rename(columns={'snobjid':'objid', 'snfake_id':'fakeid',
-                    'ccdnum':'ccd', 'errawin_world': 'err'}, inplace=True)
-    df = df[['mjd', 'err', 'ra', 'dec', 'objid', 'expnum']]   
-    return df
-
-
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('triplets', help='path to triplet pickle file')
+    parser.add_argument('triplets', help='path to triplet pickle or .npz file')
     parser.add_argument('detections', help='path to detection list csv file')
     parser.add_argument('orbitFile', help='path to fits file with orbital parameters')
     parser.add_argument('-w', '--overwrite', action='store_true', 
                     help='whether to overwrite existing C files')
+    parser.add_argument('-j', '--Ncpu', type=int, default=1,
+                    help='number of processes to search for candidates with')
+    parser.add_argument('-t', '--tileSize', type=float, default=10.,
+                    help='about how wide the sky tiles of the candidate search are in degrees')
     args = parser.parse_args()
     # Takes input on the command line.
 
@@ -506,8 +509,8 @@ def main():
     
     print("Loading triplets and detections")
     time0 = time.time()
-    with open(args.triplets,'rb') as f:
-        triplets = pickle.load(f)
+    detections = LL.loadCatalog(args.detections)
+    triplets = LL.loadTriplets(args.triplets, detections)
     # TODO remove this
     '''
     #######
@@ -519,14 +522,19 @@ def main():
     #######
     '''
 
-    detections = efficientWrap(args.detections)
     print('loading and wrapping done after ' + str(time.time()-time0) + ' seconds')
     print('Finding candidates')
     t0 = time.time()
     errSize = 2
     interval = 2
-    grownTriplets = find_candidates(triplets, detections, args.orbitFile,
-                                interval, errSize, chunkName, saveName, args.overwrite)
+    if(len(triplets) == 0):
+        # siftTriplets writes no orbit file when it had nothing to fit
+        print('no triplets to grow')
+        grownTriplets = []
+    else:
+        grownTriplets = find_candidates(triplets, detections, args.orbitFile,
+                                interval, errSize, chunkName, saveName, args.overwrite,
+                                nProcs=args.Ncpu, tileSize=args.tileSize)
     t = time.time()-t0
     print('Completed after ' + str(t) + ' seconds for ' + str(len(triplets)) + ' triplets')
 
@@ -0,0 +1,167 @@
+# Links every detection to the detections on the following nights that fall inside its search cone (Detection.withinCone).
+# Saves the links to detectionLinks+<savename>.pickle, a list of (objid, [linked objids]) tuples that linkPairs.py reads.
+# The work is split by the night of the anchor detection across a pool of processes.
+import sys
+import os
+tnopath = os.environ['TNO_PATH']
+sys.path.insert(0, tnopath)
+import time
+import argparse
+try:
+   import cPickle as pickle
+except:
+   import pickle
+
+import numpy as np
+import scipy.spatial as sp
+from multiprocessing import Pool, cpu_count
+
+import LinkerLib as LL
+
+# set in every worker process by initWorker
+_catalog = None
+_niteRows = {}
+# kd-trees of the nights a worker has looked at, see niteTree
+_trees = {}
+
+# Sets the catalog and its rows per night for linkNite in this process.
+def initWorker(catalog, niteRows):
+    global _catalog, _niteRows, _trees
+    _catalog = catalog
+    _niteRows = niteRows
+    _trees = {}
+
+# Returns the rows of the catalog for each night (floor of mjd).
+def splitNites(catalog):
+    nites = np.floor(catalog.col('mjd')).astype('i8')
+    order = np.argsort(nites, kind='mergesort')
+    keys, starts = np.unique(nites[order], return_index=True)
+    return dict(zip(keys.tolist(), np.split(order, starts[1:])))
+
+# Returns the kd-tree of the positions on a night and the rows it was built from.
+# These trees are the index of the detections by night and position: a cone
+# only looks at the trees of the nights it reaches, within its largest radius.
+def niteTree(nite):
+    if(nite not in _trees):
+        rows = _niteRows.get(nite)
+        if(rows is None or len(rows) == 0):
+            _trees[nite] = None
+        else:
+            pos = np.column_stack((_catalog.col('ra')[rows], _catalog.col('dec')[rows]))
+            _trees[nite] = (sp.cKDTree(pos), rows)
+    return _trees[nite]
+
+'''
+input: --a night (nite)
+output: --the rows of the detections on that night (anchors)
+        --offsets into links for each anchor (indptr)
+        --the rows linked to each anchor, sorted by mjd (links)
+'''
+def linkNite(nite):
+    catalog = _catalog
+    lookAhead = catalog.lookAhead
+    anchors = _niteRows[nite]
+    # a worker only keeps the trees it can still use
+    for old in [x for x in _trees if x < nite - 1]:
+        del _trees[old]
+    radius = catalog.cones(anchors)[2]
+    if(lookAhead < 2 or radius.shape[1] == 0):
+        return anchors, np.zeros(len(anchors)+1, dtype='i8'), np.zeros(0, dtype='i8')
+    maxRadius = radius.max(axis=1)
+    pos = np.column_stack((catalog.col('ra')[anchors], catalog.col('dec')[anchors]))
+    pairAnchor = []
+    pairCand = []
+    # withinCone truncates the nights ahead, so the night before can still match
+    for other in range(nite - 1, nite + lookAhead):
+        tree = niteTree(other)
+        if(tree is None):
+            continue
+        kdtree, rows = tree
+        found = kdtree.query_ball_point(pos, maxRadius)
+        counts = np.array([len(x) for x in found], dtype='i8')
+        if(counts.sum() == 0):
+            continue
+        pairAnchor.append(np.repeat(np.arange(len(anchors)), counts))
+        pairCand.append(rows[np.concatenate([np.asarray(x, dtype='i8') for x in found])])
+    if(len(pairAnchor) == 0):
+        return anchors, np.zeros(len(anchors)+1, dtype='i8'), np.zeros(0, dtype='i8')
+    pairAnchor = np.concatenate(pairAnchor)
+    pairCand = np.concatenate(pairCand)
+    expnum = catalog.col('expnum')
+    keep = expnum[anchors[pairAnchor]] != expnum[pairCand]
+    pairAnchor = pairAnchor[keep]
+    pairCand = pairCand[keep]
+    keep = LL.withinCone_rows(catalog, anchors[pairAnchor], pairCand)
+    pairAnchor = pairAnchor[keep]
+    pairCand = pairCand[keep]
+    order = np.lexsort((catalog.col('objid')[pairCand],
+                        catalog.col('mjd')[pairCand], pairAnchor))
+    pairAnchor = pairAnchor[order]
+    pairCand = pairCand[order]
+    indptr = np.zeros(len(anchors)+1, dtype='i8')
+    indptr[1:] = np.cumsum(np.bincount(pairAnchor, minlength=len(anchors)))
+    return anchors, indptr, pairCand
+
+'''
+input: --a DetectionCatalog with the lookAhead to link with (catalog)
+       --number of processes (Ncpu)
+output: --a list of (objid, [linked objids]) for every detection, ordered by
+          mjd, with the links of each detection ordered by mjd
+'''
+def linkDetections(catalog, Ncpu=1):
+    niteRows = splitNites(catalog)
+    nites = sorted(niteRows.keys())
+    print('linking ' + str(len(catalog)) + ' detections over ' +
+            str(len(nites)) + ' nights')
+    time0 = time.time()
+    # consecutive nights go to the same worker so it can reuse its kd-trees
+    chunk = max(1, len(nites) // (4*Ncpu))
+    if(Ncpu > 1):
+        pool = Pool(Ncpu, initWorker, (catalog, niteRows))
+        results = pool.imap(linkNite, nites, chunk)
+    else:
+        pool = None
+        initWorker(catalog, niteRows)
+        results = (linkNite(nite) for nite in nites)
+    objid = catalog.col('objid')
+    mjd = catalog.col('mjd')
+    detPairs = []
+    numLinks = 0
+    counter = 0
+    for anchors, indptr, links in results:
+        counter += 1
+        LL.printPercentage(counter, len(nites), time.time()-time0)
+        linkIds = objid[links].tolist()
+        order = np.lexsort((objid[anchors], mjd[anchors]))
+        for i in order:
+            detPairs.append((int(objid[anchors[i]]), linkIds[indptr[i]:indptr[i+1]]))
+        numLinks += len(links)
+    if(pool is not None):
+        pool.close()
+        pool.join()
+    print('\nfound ' + str(numLinks) + ' links after ' + str(time.time()-time0) + ' seconds')
+    return detPairs
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('detections', help='path to csv file with detections')
+    args.add_argument('-l', '--lookAhead', type=int, default=10,
+            help='number of nights to look ahead for links')
+    args.add_argument('-n', '--Ncpu', type=int, default=cpu_count(),
+            help='number of processes to use')
+    args.add_argument('-o', '--outname', help='name of the output pickle file')
+    args = args.parse_args()
+
+    saveName = args.detections.split('/')[-1].split('.')[0]
+    outname = 'detectionLinks+' + saveName + '.pickle'
+    if(args.outname):
+        outname = args.outname
+
+    catalog = LL.loadCatalog(args.detections, args.lookAhead)
+    detPairs = linkDetections(catalog, args.Ncpu)
+    print('pickling to ' + outname)
+    with open(outname, 'wb') as f:
+        pickle.dump(detPairs, f, pickle.HIGHEST_PROTOCOL)
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ from LinkerLib import printPercentage
 from LinkerLib import Triplet
 from LinkerLib import writeTriplets
 from LinkerLib import pickleTriplets
+from LinkerLib import TripletChunk
 import LinkerLib as LL
 
 import numpy as np
@@ -18,81 +19,259 @@ except:
    import pickle
 import argparse
 import time
+import json
 import ephem
 
 from multiprocessing import Pool, cpu_count, Manager, Queue
 
 
+# Saves one chunk of triplets as chunk######+saveName.npz (or .pickle if asPickle).
+def saveChunk(tripList, x, saveName, asPickle=False):
+    name = 'chunk{0:06d}'.format(x) + '+' + saveName
+    if(asPickle):
+        pickleTriplets(tripList, name + '.pickle', False)
+    else:
+        TripletChunk.fromList(tripList).save(name + '.npz')
+
+# set in every worker process by initWorker
+_detPairs = None
+_linkDict = None
+
+# Sets the links formChunkRange goes through in this process.
+def initWorker(detPairs, linkDict):
+    global _detPairs, _linkDict
+    _detPairs = detPairs
+    _linkDict = linkDict
+
+# Returns a dictionary from objid to its list of links.
+def makeLinkDict(detPairs):
+    linkDict = {}
+    for pair in detPairs:
+        linkDict[pair[0]] = pair[1]
+    return linkDict
+
+'''
+Inputs:
+the (det, links) tuples (detPairs) and the dictionary from objid to links (linkDict)
+a position (anchor index, link offset, second link offset) to start from (start)
+Output:
+yields the position and objids of every triplet det -> link -> link2 from start on
+in the same order formTriplets goes through them
+'''
+def iterTriplets(detPairs, linkDict, start=(0, 0, 0)):
+    anchor, linkOffset, link2Offset = start
+    for i in range(anchor, len(detPairs)):
+        det, links = detPairs[i]
+        for j in range(linkOffset if i == anchor else 0, len(links)):
+            link = links[j]
+            links2 = linkDict[link]
+            first = link2Offset if (i == anchor and j == linkOffset) else 0
+            for k in range(first, len(links2)):
+                yield (i, j, k), (det, link, links2[k])
+
+# Returns the number of triplets that start at each detection of detPairs.
+def countTriplets(detPairs, linkDict):
+    counts = np.zeros(len(detPairs), dtype='i8')
+    for i in range(len(detPairs)):
+        counts[i] = sum(len(linkDict[link]) for link in detPairs[i][1])
+    return counts
+
+'''
+Inputs:
+the (det, links) tuples (detPairs) and the dictionary from objid to links (linkDict)
+the cumulative sum of countTriplets (cumCounts)
+the index of a triplet in the order of iterTriplets (index)
+Output:
+the position of that triplet to pass to iterTriplets
+'''
+def seekTriplet(detPairs, linkDict, cumCounts, index):
+    anchor = int(np.searchsorted(cumCounts, index, side='right'))
+    if(anchor >= len(detPairs)):
+        return (len(detPairs), 0, 0)
+    offset = index - (cumCounts[anchor-1] if anchor > 0 else 0)
+    links = detPairs[anchor][1]
+    for j in range(len(links)):
+        size = len(linkDict[links[j]])
+        if(offset < size):
+            return (anchor, j, int(offset))
+        offset -= size
+    return (anchor + 1, 0, 0)
+
+# Writes the triplets [begin, end) of the global order as numbered chunks.
+# Returns the triplets after the last full chunk (the end of the run).
+def formChunkRange(args):
+    begin, end, chunkSize, firstChunk, saveName, start, asPickle = args
+    tripList = []
+    x = firstChunk
+    count = begin
+    if(end > begin):
+        for pos, trip in iterTriplets(_detPairs, _linkDict, start):
+            tripList.append((len(tripList), list(trip)))
+            count += 1
+            if(len(tripList) >= chunkSize):
+                saveChunk(tripList, x, saveName, asPickle)
+                x += 1
+                tripList = []
+            if(count >= end):
+                break
+    return tripList
+
+'''
+Inputs:
+detPairs is a list of tuples of the format (det, links) where det is an objid and links is a list of objids.
+Size of each chunk (chunkSize)
+A name for the save file (saveName)
+Number of processes (Ncpu)
+Number of the first chunk (chunkStart)
+Whether to save chunks as pickled lists instead of .npz arrays (asPickle)
+Output:
+The triplets left after the last full chunk (tripList), exactly as formTriplets
+Writes manifest+saveName.json with the chunk number, file, size and start of every chunk
+'''
+def formTripletsParallel(detPairs, chunkSize, saveName, Ncpu, chunkStart=1, asPickle=False):
+    linkDict = makeLinkDict(detPairs)
+    cumCounts = np.cumsum(countTriplets(detPairs, linkDict))
+    total = int(cumCounts[-1]) if len(cumCounts) > 0 else 0
+    numChunks = total // chunkSize
+    print('forming ' + str(total) + ' triplets in ' + str(numChunks) +
+            ' chunks of ' + str(chunkSize) + ' on ' + str(Ncpu) + ' processes')
+    ext = '.pickle' if asPickle else '.npz'
+    manifest = []
+    for c in range(numChunks):
+        manifest.append({'chunk': chunkStart + c,
+                'file': 'chunk{0:06d}'.format(chunkStart + c) + '+' + saveName + ext,
+                'count': chunkSize,
+                'start': seekTriplet(detPairs, linkDict, cumCounts, c*chunkSize)})
+    with open('manifest+' + saveName + '.json', 'w') as f:
+        json.dump({'total': total, 'chunkSize': chunkSize, 'chunks': manifest}, f, indent=1)
+    # each task gets a run of whole chunks so no chunk is split between processes
+    perTask = max(1, -(-numChunks // (4*Ncpu)))
+    tasks = []
+    for c in range(0, numChunks, perTask):
+        last = min(c + perTask, numChunks)
+        tasks.append((c*chunkSize, last*chunkSize, chunkSize, chunkStart + c,
+                      saveName, manifest[c]['start'], asPickle))
+    tasks.append((numChunks*chunkSize, total, chunkSize, 0, saveName,
+                  seekTriplet(detPairs, linkDict, cumCounts, numChunks*chunkSize),
+                  asPickle))
+    time0 = time.time()
+    pool = Pool(Ncpu, initWorker, (detPairs, linkDict))
+    tripList = []
+    counter = 0
+    for tail in pool.imap(formChunkRange, tasks):
+        counter += 1
+        printPercentage(counter, len(tasks), time.time()-time0)
+        tripList = tail
+    pool.close()
+    pool.join()
+    return tripList
+
+
 '''
 Inputs:
 detPairs is a list of tuples of the format (det, links) where det is an objid and links is a list of objids.
 Size of each chunk (chunkSize)
 A name for the save file (saveName)
+The last triplet of a previous run to continue from, found by a scan (tripletStart)
+Whether to save chunks as pickled lists instead of .npz arrays (asPickle)
+The position to start from, as written to the checkpoint file (startPos)
+The number of triplets written before startPos (tripletCount)
 Output:
 A list of triplets (tripList)
+Writes checkpoint+saveName.json after every chunk so a run can be continued from there
 '''
-def formTriplets(detPairs, chunkSize, saveName, tripletStart=[-1,-1,-1], chunkStart = 1):
-    # detPairs, queue = args
-    linkDict = {}
-    for pair in detPairs:
-        linkDict[pair[0]] = pair[1]
+def formTriplets(detPairs, chunkSize, saveName, tripletStart=[-1,-1,-1], chunkStart = 1,
+                 asPickle=False, startPos=(0, 0, 0), tripletCount=0):
+    linkDict = makeLinkDict(detPairs)
+    if(tripletStart[0] != -1):
+        # old style continue: scan for the last triplet of the previous run
+        startPos = None
+        for pos, trip in iterTriplets(detPairs, linkDict):
+            if(list(trip) == list(tripletStart)):
+                startPos = pos
+                break
+        if(startPos is None):
+            print('triplet not found: ' + str(tripletStart))
+            return []
 
     tripList = []
     time0 = time.time()
-    counter = 0
     x = chunkStart
-    trackCount = 0
-    print('size of each chunk: ' +str(chunkSize)) 
-    notFound = True
-    for det in detPairs:
-        counter += 1
-        links = det[1] 
-        if counter%1000==0:
-            printPercentage(counter, len(detPairs), time.time()-time0)
-        if det[0] != tripletStart[0] and tripletStart[0] != -1 and notFound:
-            continue
-        for link in links:
-            if link != tripletStart[1] and tripletStart[1] != -1 and notFound :
-                continue
-            links2 = linkDict[link]
-            for trip in links2:
-                if trip != tripletStart[2] and tripletStart[2] != -1 and notFound:
-                    continue
-                elif(det[0] == tripletStart[0] and link == tripletStart[1] and trip == tripletStart[2]):
-                    notFound = False
-                trackid = (trackCount%chunkSize)
-                triplet = (trackid, [det[0], link, trip])
-               
-                trackCount += 1
-                tripList.append(triplet)
-                if chunkSize > 0 and len(tripList) >= chunkSize:
-                    pickleTriplets(tripList, 'chunk{0:06d}'.format(x) + '+' + saveName + '.pickle', False)
-                    # writeTriplets(tripList, 'chunk{0:06d}'.format(x) +
-                    # '+' + saveName + '.txt', False, False)
-                    x += 1
-                    trackCount = 0
-                    tripList = []
+    lastAnchor = -1
+    print('size of each chunk: ' +str(chunkSize))
+    for pos, trip in iterTriplets(detPairs, linkDict, startPos):
+        if pos[0] != lastAnchor and pos[0]%1000==0:
+            printPercentage(pos[0], len(detPairs), time.time()-time0)
+        lastAnchor = pos[0]
+        trackid = (len(tripList)%chunkSize)
+        tripList.append((trackid, list(trip)))
+        tripletCount += 1
+        if chunkSize > 0 and len(tripList) >= chunkSize:
+            saveChunk(tripList, x, saveName, asPickle)
+            x += 1
+            tripList = []
+            writeCheckpoint(saveName, (pos[0], pos[1], pos[2]+1), x, tripletCount)
     return tripList
 
+# Writes the position after the last saved chunk to checkpoint+saveName.json.
+def writeCheckpoint(saveName, nextPos, nextChunk, tripletCount):
+    name = 'checkpoint+' + saveName + '.json'
+    with open(name + '.tmp', 'w') as f:
+        json.dump({'anchor': nextPos[0], 'link': nextPos[1], 'link2': nextPos[2],
+                   'chunk': nextChunk, 'count': tripletCount}, f)
+    os.rename(name + '.tmp', name)
+
+# Returns the checkpoint written by formTriplets, None if there is none.
+def readCheckpoint(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
 
 def main():
     args = argparse.ArgumentParser()
     args.add_argument('linkedPairs', help='path to pickle file; ' + 'file has format detectionLinks+SNOBS_SEASON###_ML0#.pickle')
     args.add_argument('-n', '--chunkSize', help='size of chunks, leave empty for only one chunk')
-    args.add_argument('-c', '--cont', help='last chunk processed')
+    args.add_argument('-c', '--cont', help='checkpoint file or last chunk processed')
+    args.add_argument('-p', '--pickle', action='store_true',
+            help='save chunks as pickled lists instead of .npz arrays')
+    args.add_argument('-j', '--Ncpu', type=int, default=1,
+            help='number of processes forming triplets (needs --chunkSize)')
     args = args.parse_args()
     # Three arguments, of which the last two are optional.
 
     tripletStart = [-1,-1,-1]
     chunkStart = 1
+    startPos = (0, 0, 0)
+    tripletCount = 0
+    saveName = args.linkedPairs.split('+')[-1].split('.')[0]
+    checkpoint = None
     if(args.cont):
+        if(args.cont.endswith('.json')):
+            checkpoint = readCheckpoint(args.cont)
+        else:
+            # the checkpoint is only used if it was written after that chunk
+            checkpoint = readCheckpoint('checkpoint+' + saveName + '.json')
+            fname = args.cont.split('/')[-1].split('+')[0]
+            if(checkpoint is not None and checkpoint['chunk'] != int(fname[-6:]) + 1):
+                checkpoint = None
+    if(checkpoint is not None):
+        startPos = (checkpoint['anchor'], checkpoint['link'], checkpoint['link2'])
+        chunkStart = checkpoint['chunk']
+        tripletCount = checkpoint['count']
+        print('continuing from checkpoint at ' + str(startPos) + ' after ' +
+                str(tripletCount) + ' triplets')
+        print('starting from chunk: ' + str(chunkStart))
+    elif(args.cont):
         print('loading last chunk: ' + args.cont)
         fname = args.cont.split('+')[0]
         if('/' in fname):
             fname = fname.split('/')[-1]
         chunkStart = int(fname[-6:]) + 1
-        with open(args.cont, 'rb') as f:
-            lastChunk = pickle.load(f)
+        lastChunk = LL.loadTriplets(args.cont)
         lastTrip = lastChunk[-1]
         tripletStart = lastTrip[1]
         print('last triplet: ' + str(tripletStart))
@@ -107,9 +286,13 @@ def main():
     chunkSize = -1 
     if(args.chunkSize):
         chunkSize = int(args.chunkSize)
-    saveName = args.linkedPairs.split('+')[-1].split('.')[0]
     print('forming triplets')
-    triplets = formTriplets(detPairs, chunkSize, saveName, tripletStart, chunkStart)
+    if(args.Ncpu > 1 and chunkSize > 0 and not args.cont):
+        triplets = formTripletsParallel(detPairs, chunkSize, saveName,
+                            args.Ncpu, chunkStart, args.pickle)
+    else:
+        triplets = formTriplets(detPairs, chunkSize, saveName, tripletStart,
+                            chunkStart, args.pickle, startPos, tripletCount)
 
     # tripChunks = splitList(triplets, numChunks, buffered, saveName, printP)
     # triplets = multiProcessPairs(detPairs, Ncpu)
@@ -117,7 +300,7 @@ def main():
     # we save it earlier if argument is buffered
 
     x = 0
-    pickleTriplets(triplets, 'chunk{0:06d}'.format(x) + '+' + saveName + '.pickle', False)
+    saveChunk(triplets, x, saveName, args.pickle)
     writeTriplets(triplets, 'chunk{0:06d}'.format(x) + '+' + saveName + '.txt', False, False)
     # Writes and pickles triplets. (The second argument is the save name.)
     # The name is auto-generated and doesn't require an inputted save name.
@@ -0,0 +1,29 @@
+# Converts csv files of detections into the binary detection cache read by LinkerLib.loadCatalog.
+# The cache is written next to each csv file as <name>.detcache/ and only has to be made once per file.
+import sys
+import os
+tnopath = os.environ['TNO_PATH']
+sys.path.insert(0, tnopath)
+import time
+import argparse
+
+import LinkerLib as LL
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('detections', nargs='+', help='path to csv files with detections')
+    args.add_argument('-f', '--force', action='store_true',
+            help='rewrite the cache even if it is up to date')
+    args = args.parse_args()
+
+    for csvFile in args.detections:
+        if(not args.force and LL.readDetCache(csvFile) is not None):
+            print('cache is up to date: ' + LL.detCachePath(csvFile))
+            continue
+        time0 = time.time()
+        catalog = LL.DetectionCatalog.fromCsv(csvFile)
+        LL.writeDetCache(csvFile, catalog)
+        print('done after ' + str(time.time()-time0) + ' seconds')
+
+if __name__ == '__main__':
+    main()
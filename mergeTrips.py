@@ -19,6 +19,13 @@ except:
    import pickle
 import time
 import argparse
+from multiprocessing import cpu_count
+
+import fitRunner
+
+# BulkFit options of the merge fits (none, unlike the -bindingFactor=1 of
+# siftTriplets, so the fit cache does not share fits between the two)
+BULKFIT_OPTIONS = []
 
 '''
 Inputs:
@@ -28,7 +35,7 @@ Returns:
 --a list of merged triplets (finalList)
 '''
 # Merges triplets that share detections.
-def newMergeTrips(triplets, savename, thresh=10):
+def newMergeTrips(triplets, savename, thresh=10, nShards=1, cache=None):
     finalList = []
     totalSize = len(triplets)
     print('\nnumber to merge: '+ str(totalSize))
@@ -78,7 +85,7 @@ def newMergeTrips(triplets, savename, thresh=10):
         return finalList
     # Exits the function, returning finaList.
 
-    goodMergeIds, badMergeIds = siftChecks(checkList, savename, thresh)
+    goodMergeIds, badMergeIds = siftChecks(checkList, savename, thresh, nShards, cache)
     for i, chi in goodMergeIds:
         trip = Triplet(checkList[i])
         trip.chiSq = chi
@@ -95,11 +102,11 @@ def newMergeTrips(triplets, savename, thresh=10):
                 finalList.append(trip1)
             else:
                 finalList.append(trip2)
-    return newMergeTrips(finalList, savename, thresh)
+    return newMergeTrips(finalList, savename, thresh, nShards, cache)
     # Reruns the function with finalList as the initial triplets.
 
 # Returns a finalList of triplets with trackids and chisqs and prints the bad triplets.
-def getInitTrips(triplets, savename):
+def getInitTrips(triplets, savename, nShards=1, cache=None):
     trackID = 1
     trackDict = {}
     print('assigning trackids')
@@ -112,7 +119,7 @@ def getInitTrips(triplets, savename):
     # This loop makes a trackDict with trip.dets indexed starting at 1
     triplets = trips
     finalList = []
-    goodIDs, badIDs = siftChecks(trackDict, savename)
+    goodIDs, badIDs = siftChecks(trackDict, savename, nShards=nShards, cache=cache)
     for i, chi in goodIDs:
         trip = Triplet(trackDict[i])
         trip.chiSq = chi
@@ -128,28 +135,19 @@ def getInitTrips(triplets, savename):
     return finalList 
 
 # Returns lists of ids of good and bad triplets
-def siftChecks(trackDict, savename, thresh=30):
+# nShards is the number of BulkFit processes to run at once
+# cache is a fitRunner.FitCache; only CHISQ, DOF and FLAGS are used here, so earlier
+# merge fits are taken whatever frame they were fit in (sift fits never are, see fitRunner.fitKey)
+def siftChecks(trackDict, savename, thresh=30, nShards=1, cache=None):
     outName = LL.writeDetToOrb(trackDict, 'siftRequestMerge+' + savename + '.fits')
-    cmd = 'BulkFit -observationFile=' + str(outName) + ' -orbitFile='
     paramName = outName.split('.')[0] + '.orbit'
-    cmd = cmd + paramName
-    print('running BulkFit...')
-    time0 = time.time()
-    # Records an initial time.
-    os.system(cmd)
-    print('done after ' + str(time.time()-time0) + ' seconds')
-    orbits = Table.read(paramName, format='fits')
-    chiList = orbits['CHISQ'].tolist()
-    orbitIDs = orbits['ORBITID'].tolist()
-    dofList = orbits['DOF'].tolist()
-    flagList = orbits['FLAGS'].tolist()
-    goodid = []
-    badid = [] 
-    for x in range(len(chiList)):
-        if chiList[x] < thresh*dofList[x] and flagList[x] == 0 and chiList[x] > 0.0:
-            goodid.append((orbitIDs[x], chiList[x]))
-        else:
-            badid.append((orbitIDs[x], chiList[x]))
+    fitRunner.runBulkFit(outName, paramName, nShards, BULKFIT_OPTIONS, cache, matchFrame=False)
+    orbits = LL.OrbitColumns.read(paramName, ['ORBITID', 'CHISQ', 'DOF', 'FLAGS'])
+    good = orbits.goodFits(thresh, perDof=True)
+    orbitIDs = orbits.col('ORBITID')
+    chisq = orbits.col('CHISQ')
+    goodid = list(zip(orbitIDs[good].tolist(), chisq[good].tolist()))
+    badid = list(zip(orbitIDs[~good].tolist(), chisq[~good].tolist()))
     return goodid, badid
 
 # Returns trips, a list of triplets (per the LL Triplet class) with fakes merged in.
@@ -166,11 +164,39 @@ def mergeFakes(triplets):
         trips.append(Triplet(trip))
     return trips
     
+'''
+input: --a list of grown triplets (triplets)
+       --a name for the BulkFit requests (savename)
+       --whether to merge fakes by fakeid instead of fitting (fake)
+       --number of BulkFit processes to run at once (nShards)
+       --a fitRunner.FitCache or None (cache)
+output: --the merged triplets with five or more detections (finalList)
+'''
+def mergeTriplets(triplets, savename, fake=False, nShards=1, cache=None):
+    if(fake):
+        mergedTrips = mergeFakes(triplets)
+    else:
+        siftedTrips = getInitTrips(triplets, savename, nShards, cache)
+        mergedTrips = newMergeTrips(siftedTrips, savename, nShards=nShards, cache=cache)
+    print('\nsize of final list = ' + str(len(mergedTrips)))    
+    finalList =[]
+    for trip in mergedTrips:
+        if(trip.realLength()>4):
+            finalList.append(trip)
+    # Keeps triplets with five or more detections.
+    print('size after reducing: ' + str(len(finalList)))
+    return finalList
+
 def main():
     args = argparse.ArgumentParser()
     args.add_argument('triplets', nargs='+', help='list of triplets to merge')
     args.add_argument('-f', '--fake', action='store_true', 
             help='whether to look at fakes')
+    args.add_argument('-j', '--Ncpu', type=int, default=cpu_count(),
+            help='number of BulkFit processes to run at once')
+    args.add_argument('-c', '--fitCache', default=fitRunner.FIT_CACHE,
+            help='sqlite file of earlier fits to reuse')
+    args.add_argument('--noCache', action='store_true', help='fit every triplet again')
     args = args.parse_args()
     
     savename1 = args.triplets[0].split('/')[-1].split('.')[0]
@@ -185,18 +211,10 @@ def main():
         triplets.extend(pickle.load(open(trips, 'rb')))
     # Opens the file
     print('done loading after ' + str(time.time()-time0) + ' seconds')
-    if(args.fake):
-        mergedTrips = mergeFakes(triplets)
-    else:
-        siftedTrips = getInitTrips(triplets, savename1)
-        mergedTrips = newMergeTrips(siftedTrips, savename1)
-    print('\nsize of final list = ' + str(len(mergedTrips)))    
-    finalList =[]
-    for trip in mergedTrips:
-        if(trip.realLength()>4):
-            finalList.append(trip)
-    # Keeps triplets with five or more detections.
-    print('size after reducing: ' + str(len(finalList)))
+    cache = None
+    if(not args.fake and not args.noCache):
+        cache = fitRunner.FitCache(args.fitCache)
+    finalList = mergeTriplets(triplets, savename1, args.fake, args.Ncpu, cache)
     writeTriplets(finalList, savename + '.txt')
     pickleTriplets(finalList, savename + '.pickle')
     # Saves the kept and merged triplets to .txt and .pickle files.
@@ -0,0 +1,339 @@
+# Runs the whole linker on one or more seasons of detections:
+#   linkDetections -> linkPairs -> siftTriplets -> growTriplets (per chunk) -> mergeTrips -> finalConvert
+# Every step is a task with input and output files. A task is skipped when its outputs exist and
+# the content of its inputs and its command line are the same as when it last ran, as recorded
+# in .pipeline/<task>.json. Tasks that do not depend on each other (chunks, seasons) run at the
+# same time, with up to --Ncpu processes between them. With --fake the stand-in orbit tools of
+# fakebin/ (fakeBulk.py) are used instead of BulkFit and the rest on PATH.
+import sys
+import os
+import glob
+import json
+import time
+import hashlib
+import argparse
+import threading
+import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+STAGES = ['link', 'pairs', 'sift', 'grow', 'merge', 'final']
+LINKER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# One run of a linker script: the command line, the files it reads and writes and
+# the names of the tasks that have to finish first.
+# With outputGlob, the outputs are the files matching it after the run (linkPairs chunks);
+# the files matching it are removed before the run.
+# Files in optional may be missing: siftTriplets writes no .orbit when no triplet is left
+# to fit, and growTriplets does not need one then.
+# procs is the number of processes the script runs, counted against the Ncpu of runTasks.
+class Task(object):
+    def __init__(self, name, cmd, inputs, outputs, deps=[], outputGlob=None, env={}, optional=[],
+                 procs=1):
+        self.name = name
+        self.cmd = cmd
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = deps
+        self.outputGlob = outputGlob
+        self.env = env
+        self.optional = optional
+        self.procs = procs
+
+# Keeps the sha1 of files so a file is only read again when its size or mtime changed.
+class HashCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.hashes = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.hashes = {}
+
+    def hash(self, name):
+        stat = os.stat(name)
+        key = os.path.abspath(name)
+        with self.lock:
+            known = self.hashes.get(key)
+        if(known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime):
+            return known[2]
+        h = hashlib.sha1()
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        with self.lock:
+            self.hashes[key] = [stat.st_size, stat.st_mtime, h.hexdigest()]
+        return h.hexdigest()
+
+    def save(self):
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.hashes, f)
+            os.rename(self.path + '.tmp', self.path)
+
+'''
+input: --a Task (task)
+       --a HashCache (hashes)
+output: --sha1 of the command line and the content of every input of the task,
+          where a missing optional input counts as one more state of the file
+'''
+def taskKey(task, hashes):
+    h = hashlib.sha1(' '.join(task.cmd).encode('utf-8'))
+    for name in task.inputs:
+        if(name in task.optional and not os.path.isfile(name)):
+            digest = 'missing'
+        else:
+            digest = hashes.hash(name)
+        h.update((name + ' ' + digest + '\n').encode('utf-8'))
+    return h.hexdigest()
+
+'''
+input: --a Task (task)
+       --directory of the stamp files and logs (stampDir)
+       --a HashCache (hashes)
+       --whether to run it even if nothing changed (force)
+output: --runs the task unless its stamp is up to date, with the output of the
+          script in stampDir/<task>.log, and writes the stamp with the outputs
+          that were written
+          raises RuntimeError if the script fails or does not write an output
+          that is not optional
+'''
+def runTask(task, stampDir, hashes, force=False):
+    stampFile = os.path.join(stampDir, task.name + '.json')
+    key = taskKey(task, hashes)
+    try:
+        with open(stampFile) as f:
+            stamp = json.load(f)
+    except (IOError, OSError, ValueError):
+        stamp = None
+    if(not force and stamp is not None and stamp['key'] == key and
+            all(os.path.isfile(name) for name in stamp['outputs'])):
+        task.outputs = stamp['outputs']
+        print('up to date: ' + task.name)
+        return task
+    print('running ' + task.name + ': ' + ' '.join(task.cmd))
+    time0 = time.time()
+    # an optional output left from an earlier run would pass for a new one, and so
+    # would files matching outputGlob, such as the extra chunks of a run that made more
+    stale = [name for name in task.outputs if name in task.optional]
+    if(task.outputGlob is not None):
+        stale += glob.glob(task.outputGlob)
+    for name in stale:
+        if(os.path.isfile(name)):
+            os.remove(name)
+    env = dict(os.environ)
+    env.update(task.env)
+    with open(os.path.join(stampDir, task.name + '.log'), 'w') as log:
+        ret = subprocess.call(task.cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+    if(ret != 0):
+        raise RuntimeError(task.name + ' exited with ' + str(ret) + ', see ' +
+                os.path.join(stampDir, task.name + '.log'))
+    if(task.outputGlob is not None):
+        task.outputs = sorted(glob.glob(task.outputGlob))
+    missing = [name for name in task.outputs if not os.path.isfile(name)]
+    if([name for name in missing if name not in task.optional]):
+        raise RuntimeError(task.name + ' did not write ' +
+                ', '.join(name for name in missing if name not in task.optional))
+    task.outputs = [name for name in task.outputs if name not in missing]
+    with open(stampFile + '.tmp', 'w') as f:
+        json.dump({'key': key, 'cmd': task.cmd, 'outputs': task.outputs}, f, indent=1)
+    os.rename(stampFile + '.tmp', stampFile)
+    print('done ' + task.name + ' after ' + str(time.time()-time0) + ' seconds')
+    return task
+
+'''
+input: --a list of Tasks, each after the tasks it depends on (tasks)
+       --number of processes to run at once (Ncpu)
+       --directory of the stamp files and logs (stampDir)
+       --whether to run tasks even if nothing changed (force)
+output: --runs every task once all of its dependencies have and the procs of the
+          running tasks leave room for it, and returns a dictionary from task name
+          to the finished Task
+          a task with more procs than Ncpu runs on its own
+          after a failure no new tasks are started and the error is raised
+          once the running ones finish
+'''
+def runTasks(tasks, Ncpu, stampDir, force=False):
+    hashes = HashCache(os.path.join(stampDir, 'hashes.json'))
+    pending = list(tasks)
+    finished = {}
+    running = {}
+    errors = []
+    lock = threading.Condition()
+
+    def work(task):
+        try:
+            runTask(task, stampDir, hashes, force)
+            return task, None
+        except Exception as e:
+            return task, e
+
+    def done(result):
+        task, e = result
+        with lock:
+            if(e is None):
+                finished[task.name] = task
+            else:
+                errors.append(e)
+            del running[task.name]
+            lock.notify()
+
+    pool = ThreadPool(max(1, Ncpu))
+    with lock:
+        while(pending or running):
+            if(not errors):
+                for task in [t for t in pending if all(d in finished for d in t.deps)]:
+                    used = sum(t.procs for t in running.values())
+                    if(running and used + task.procs > Ncpu):
+                        continue
+                    pending.remove(task)
+                    running[task.name] = task
+                    pool.apply_async(work, (task,), callback=done)
+            if(not running):
+                break
+            lock.wait()
+    pool.close()
+    pool.join()
+    hashes.save()
+    if(errors):
+        raise errors[0]
+    if(pending):
+        raise RuntimeError('tasks never ran: ' + ', '.join(t.name for t in pending))
+    return finished
+
+# Returns the environment the tasks of a season run with: nothing is added unless
+# --fake asks for the stand-in orbit tools of fakebin/, which need the detections.
+def toolEnv(detections, args):
+    if(not args.fake):
+        return {}
+    return {'FAKE_BULK_DETECTIONS': os.path.abspath(detections),
+            'PATH': os.path.join(LINKER_DIR, 'fakebin') + os.pathsep + os.environ.get('PATH', ''),
+            'PYTHON': sys.executable}
+
+def script(name):
+    return [sys.executable, os.path.join(LINKER_DIR, name)]
+
+# Returns the tasks that make the triplet chunks of a season.
+# linkDetections and linkPairs each run a pool of procs processes.
+def seasonTasks(detections, args, procs):
+    saveName = detections.split('/')[-1].split('.')[0]
+    env = toolEnv(detections, args)
+    links = 'detectionLinks+' + saveName + '.pickle'
+    pairs = script('linkPairs.py') + [links, '-j', str(procs)]
+    if(args.chunkSize):
+        pairs += ['-n', str(args.chunkSize)]
+    return [Task('link+' + saveName,
+                 script('linkDetections.py') + [detections, '-l', str(args.lookAhead),
+                                                '-n', str(procs)],
+                 [detections], [links], env=env, procs=procs),
+            Task('pairs+' + saveName, pairs, [links], [], ['link+' + saveName],
+                 outputGlob='chunk[0-9][0-9][0-9][0-9][0-9][0-9]+' + saveName + '.npz', env=env,
+                 procs=procs)]
+
+# Returns the tasks that sift, grow, merge and convert the chunks of a season.
+def chunkTasks(detections, chunks, args):
+    saveName = detections.split('/')[-1].split('.')[0]
+    env = toolEnv(detections, args)
+    stop = STAGES.index(args.stop)
+    if(args.fused and stop >= STAGES.index('merge') and len(chunks)):
+        return fusedTasks(detections, chunks, args)
+    tasks = []
+    grown = []
+    for chunk in chunks:
+        chunkName = chunk.split('/')[-1].split('+')[0]
+        good = chunkName + '+goodtriplets+' + saveName + '.pickle'
+        orbit = chunkName + '+' + saveName + '.orbit'
+        tasks.append(Task('sift+' + chunkName + '+' + saveName,
+                          script('siftTriplets.py') + [chunk, '-d', detections,
+                                                       '-j', str(args.fitProcs)],
+                          [chunk, detections], [good, orbit], env=env, optional=[orbit],
+                          procs=args.fitProcs))
+        if(stop < STAGES.index('grow')):
+            continue
+        grow = chunkName + '+crossCampaignTriplets+' + saveName + '.pickle'
+        tasks.append(Task('grow+' + chunkName + '+' + saveName,
+                          script('growTriplets.py') + [good, detections, orbit, '-w'],
+                          [good, detections, orbit], [grow],
+                          ['sift+' + chunkName + '+' + saveName], env=env, optional=[orbit]))
+        grown.append(grow)
+    if(stop < STAGES.index('merge') or len(grown) == 0):
+        return tasks
+    first = grown[0].split('.')[0]
+    merged = 'merged+' + first + '.pickle'
+    mergeOrbit = 'siftRequestMerge+' + first + '.orbit'
+    tasks.append(Task('merge+' + saveName,
+                      script('mergeTrips.py') + grown + ['-j', str(args.fitProcs)],
+                      grown, [merged, mergeOrbit],
+                      ['grow+' + x.split('+')[0] + '+' + saveName for x in grown], env=env,
+                      procs=args.fitProcs))
+    if(stop >= STAGES.index('final')):
+        tasks.append(finalTask(saveName, merged, mergeOrbit, 'merge+' + saveName, env))
+    return tasks
+
+# Returns the task that sifts, grows and merges the chunks of a season in one
+# process with siftGrowMerge, which writes the same merged triplets.
+def fusedTasks(detections, chunks, args):
+    saveName = detections.split('/')[-1].split('.')[0]
+    env = toolEnv(detections, args)
+    first = chunks[0].split('/')[-1].split('+')[0] + '+crossCampaignTriplets+' + saveName
+    merged = 'merged+' + first + '.pickle'
+    mergeOrbit = 'siftRequestMerge+' + first + '.orbit'
+    tasks = [Task('fused+' + saveName,
+                  script('siftGrowMerge.py') + chunks + ['-d', detections, '-j', str(args.fitProcs)],
+                  chunks + [detections], [merged, mergeOrbit], env=env, procs=args.fitProcs)]
+    if(args.stop == 'final'):
+        tasks.append(finalTask(saveName, merged, mergeOrbit, 'fused+' + saveName, env))
+    return tasks
+
+def finalTask(saveName, merged, mergeOrbit, dep, env):
+    return Task('final+' + saveName,
+                script('finalConvert.py') + ['-t', merged, '-r', mergeOrbit],
+                [merged, mergeOrbit],
+                ['orbitParams+' + saveName + '.fits', 'detParams+' + saveName + '.fits'],
+                [dep], env=env)
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('detections', nargs='+', help='csv files of detections, one per season')
+    args.add_argument('-n', '--chunkSize', type=int, help='size of triplet chunks')
+    args.add_argument('-l', '--lookAhead', type=int, default=10,
+            help='number of nights to look ahead for links')
+    args.add_argument('-j', '--Ncpu', type=int, default=cpu_count(),
+            help='number of processes to run at once')
+    args.add_argument('--fitProcs', type=int, default=1,
+            help='number of BulkFit processes each sift and merge task runs')
+    args.add_argument('-s', '--stop', default='final', choices=STAGES,
+            help='last stage to run')
+    args.add_argument('--fused', action='store_true',
+            help='sift, grow and merge each season in one process with siftGrowMerge')
+    args.add_argument('--fake', action='store_true',
+            help='run the stand-in orbit tools of fakebin/ instead of the ones on PATH')
+    args.add_argument('-f', '--force', action='store_true',
+            help='run every task, even if its inputs have not changed')
+    args.add_argument('--stampDir', default='.pipeline',
+            help='directory for the task stamps and logs')
+    args = args.parse_args()
+
+    if(not os.path.isdir(args.stampDir)):
+        os.makedirs(args.stampDir)
+    time0 = time.time()
+    tasks = []
+    # the seasons share the processes, so their pools run side by side
+    procs = max(1, args.Ncpu // len(args.detections))
+    for detections in args.detections:
+        tasks.extend(seasonTasks(detections, args, procs))
+        if(args.stop == 'link'):
+            tasks.pop()
+    finished = runTasks(tasks, args.Ncpu, args.stampDir, args.force)
+    if(STAGES.index(args.stop) >= STAGES.index('sift')):
+        # the chunks are only known once linkPairs has run
+        tasks = []
+        for detections in args.detections:
+            saveName = detections.split('/')[-1].split('.')[0]
+            tasks.extend(chunkTasks(detections, finished['pairs+' + saveName].outputs, args))
+        runTasks(tasks, args.Ncpu, args.stampDir, args.force)
+    print('pipeline done after ' + str(time.time()-time0) + ' seconds')
+
+if __name__ == '__main__':
+    main()
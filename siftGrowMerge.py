@@ -0,0 +1,95 @@
+# Runs siftTriplets, growTriplets and mergeTrips on the triplet chunks of a season in one process.
+# The detections are read once and the triplets stay in memory from one step to the next; only the
+# requests and orbits of the Bulk* tools and the merged triplets are written, to the same
+# merged+<first chunk>+crossCampaignTriplets+<season>.txt and .pickle as running the steps one by one.
+import sys
+import os
+tnopath = os.environ['TNO_PATH']
+sys.path.insert(0, tnopath)
+import time
+import argparse
+from multiprocessing import cpu_count
+
+import LinkerLib as LL
+from LinkerLib import writeTriplets
+from LinkerLib import pickleTriplets
+
+import fitRunner
+import siftTriplets
+import growTriplets
+import mergeTrips
+
+'''
+input: --paths of .npz or pickle files of triplets, one per chunk of one season (tripletFiles)
+       --a DetectionCatalog of the season (catalog)
+       --the command line arguments (args)
+       --a fitRunner.FitCache or None (cache)
+output: --the grown triplets of every chunk; each chunk is grown while BulkFit
+          runs on the next
+'''
+def siftAndGrow(tripletFiles, catalog, args, cache=None):
+    interval = 2
+    errSize = 2
+    mjd_det = growTriplets.mjd_det_dict(catalog, interval)
+    grown = []
+
+    def grow(job):
+        if(job['orbitFile'] is None):
+            return job
+        lets = siftTriplets.siftTrips(job['orbitFile'], job['trackIDs'])
+        print('growing ' + str(len(lets)) + ' triplets of ' + job['chunkName'])
+        if(lets):
+            grown.extend(growTriplets.find_candidates(lets, catalog, job['orbitFile'],
+                    interval, errSize, job['chunkName'], job['saveName'], True, mjd_det))
+        return job
+
+    siftTriplets.siftChunks(tripletFiles, catalog, args, cache, finish=grow)
+    return grown
+
+def main():
+    args = argparse.ArgumentParser()
+    args.add_argument('triplets', nargs='+',
+            help='paths to .npz or pickle files of one season; files have format ' +
+            'chunk###+SNOBS_SEASON###_ML0#.npz')
+    args.add_argument('-d', '--detFile', required=True, help='path to csv file with detections')
+    args.add_argument('-f', '--fake', action='store_true',
+            help='merge fakes by fakeid instead of fitting')
+    args.add_argument('-j', '--Ncpu', type=int, default=cpu_count(),
+            help='number of BulkFit processes to run at once')
+    args.add_argument('-c', '--fitCache', default=fitRunner.FIT_CACHE,
+            help='sqlite file of earlier fits to reuse')
+    args.add_argument('--noCache', action='store_true', help='fit every triplet again')
+    args.add_argument('--noPrefilter', action='store_true',
+            help='send every triplet to BulkFit, without the prefilter cuts')
+    args.add_argument('--maxRate', type=float, default=1.0,
+            help='prefilter: largest rate of motion in degrees per day')
+    args.add_argument('--maxAccel', type=float, default=0.05,
+            help='prefilter: largest change of rate in degrees per day per day')
+    args.add_argument('--maxBend', type=float, default=0.02,
+            help='prefilter: largest acceleration off a great circle in degrees per day per day')
+    args.add_argument('--magThresh', type=float, default=1.0,
+            help='prefilter: largest spread of magnitudes within a band')
+    args = args.parse_args()
+    # siftTriplets.prepareChunk and finishChunk also look at these
+    args.suppress = False
+    args.orbit = False
+
+    tripletFiles = sorted(args.triplets)
+    chunkName = tripletFiles[0].split('/')[-1].split('+')[0]
+    saveName = tripletFiles[0].split('+')[-1].split('.')[0]
+    savename1 = chunkName + '+crossCampaignTriplets+' + saveName
+    savename = 'merged+' + savename1
+
+    time0 = time.time()
+    catalog = LL.loadCatalog(args.detFile)
+    print('loaded detections after ' + str(time.time()-time0) + ' seconds')
+    cache = None if args.noCache else fitRunner.FitCache(args.fitCache)
+    grown = siftAndGrow(tripletFiles, catalog, args, cache)
+    print('\ngrown triplets of all chunks: ' + str(len(grown)))
+    finalList = mergeTrips.mergeTriplets(grown, savename1, args.fake, args.Ncpu, cache)
+    writeTriplets(finalList, savename + '.txt')
+    pickleTriplets(finalList, savename + '.pickle')
+    print('done after ' + str(time.time()-time0) + ' seconds')
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@ from LinkerLib import pickleTriplets
 import LinkerLib as LL
 
 import numpy as np
+import numbers
 try:
    import cPickle as pickle
 except:
@@ -22,20 +23,44 @@ except:
 import argparse
 import time
 import subprocess
+import threading
+import traceback
+from multiprocessing import cpu_count
+try:
+   import queue
+except ImportError:
+   import Queue as queue
+
+import fitRunner
 
 from astropy.io import fits
 from astropy.table import Table
+
+# BulkFit options of the sift fits; fits made with other options (mergeTrips) are
+# kept apart from these in the fit cache
+BULKFIT_OPTIONS = ['-bindingFactor=1']
+
 '''
 input: --a list of triplets with objids as dets (triplets)
-       --a dictionary from objid to Detection objects (detDict)
+       --a dictionary or DetectionCatalog from objid to Detection objects (detDict)
        --chunk number of the chunk (chunkname)
        --save number (savename)
 output: --name of the output file (outName)
         --a dictionary of a list of objids of detections (trackIDs)
         --a list of triplets (tripList) 
+a TripletChunk with a DetectionCatalog is written straight from the arrays
 '''
 
 def writeProcessingFile(triplets, detDict, chunkname, savename):
+    if(isinstance(triplets, LL.TripletChunk) and isinstance(detDict, LL.DetectionCatalog)):
+        rows = detDict.indexOf(triplets.objids)
+        if((rows < 0).any()):
+            raise KeyError('objid not in catalog: ' + str(triplets.objids[rows < 0][0]))
+        trackIDs = LL.TrackRows(detDict, np.arange(len(triplets)),
+                np.arange(len(triplets)+1)*3, rows.ravel())
+        outName = LL.writeDetToOrb(trackIDs,
+                'siftRequest+' + chunkname + '+' + savename + '.fits')
+        return outName, trackIDs, []
     trackIDs = {}
     tripList = []
     for x in range(len(triplets)):
@@ -50,7 +75,7 @@ def writeProcessingFile(triplets, detDict, chunkname, savename):
         trackID = x
         dets = []
         for objid in tripdets:
-            if isinstance(objid, int):
+            if isinstance(objid, numbers.Integral):
                 dets.append(detDict[objid])
             elif isinstance(objid, Detection):
                 dets.append(objid)
@@ -63,22 +88,48 @@ def writeProcessingFile(triplets, detDict, chunkname, savename):
     
     return outName, trackIDs, tripList 
 
+'''
+input: --triplets as loaded by loadTriplets, a TripletChunk or a list (triplets)
+       --a DetectionCatalog, or anything else to use the detections in the triplets (catalog)
+       --the cuts of LL.prefilterTriplets, e.g. maxRate=1.0 (cuts)
+output: --the triplets that pass the cuts, kept as the same kind of list or chunk
+'''
+def prefilter(triplets, catalog, **cuts):
+    time0 = time.time()
+    if(isinstance(triplets, LL.TripletChunk)):
+        if(not isinstance(catalog, LL.DetectionCatalog)):
+            print('not prefiltering, no detections to look up the objids in')
+            return triplets
+        objids = triplets.objids
+    else:
+        dets = [trip.dets if isinstance(trip, Triplet) else trip[1] for trip in triplets]
+        if(any(len(x) != 3 for x in dets)):
+            print('not prefiltering, not every triplet has three detections')
+            return triplets
+        if(not isinstance(catalog, LL.DetectionCatalog)):
+            if(any(not isinstance(det, Detection) for x in dets for det in x)):
+                print('not prefiltering, no detections to look up the objids in')
+                return triplets
+            unique = dict((det.objid, det) for x in dets for det in x)
+            catalog = LL.DetectionCatalog.fromDetections(list(unique.values()))
+        objids = [[det.objid if isinstance(det, Detection) else det for det in x] for x in dets]
+    keep = LL.prefilterTriplets(catalog, objids, **cuts)
+    print('prefilter dropped ' + str(len(keep) - int(keep.sum())) + ' of ' +
+            str(len(keep)) + ' triplets after ' + str(time.time()-time0) + ' seconds')
+    if(isinstance(triplets, LL.TripletChunk)):
+        return LL.TripletChunk(triplets.trackids[keep], triplets.objids[keep])
+    return [triplets[x] for x in np.nonzero(keep)[0]]
+
 '''
 input: --name of fits file with a list of triplets to be fit
+       --number of BulkFit processes to run at once (nShards)
+       --a fitRunner.FitCache of earlier fits (cache)
 output: --name of file to open for fits file
 
 '''
-#TODO turn this into an actual wrapper rather than just calling it with subprocess
-def callBulkFit(tripletFile):
-    cmd = 'BulkFit -observationFile=' + str(tripletFile) + ' -orbitFile='
+def callBulkFit(tripletFile, nShards=1, cache=None):
     paramName = tripletFile.split('+',1)[-1].split('.')[0]+'.orbit'
-    cmd = cmd + paramName
-    cmd = cmd +' -bindingFactor=1'
-    print('running BulkFit...')
-    time0 = time.time()
-    os.system(cmd)
-    print('done running BulkFit after ' + str(time.time()-time0) + ' seconds')
-
+    fitRunner.runBulkFit(tripletFile, paramName, nShards, BULKFIT_OPTIONS, cache)
     return paramName
 
 '''
@@ -87,10 +138,9 @@ output: writes orbital parameters in aei to orbtifile
 '''
 
 def callBulkEle(orbitfile):
-    cmd = 'BulkElements -orbitFile=' + str(orbitfile)
     print('running BulkElements...')
     time0 = time.time()
-    os.system(cmd)
+    fitRunner.runCommand(['BulkElements', '-orbitFile=' + str(orbitfile)])
     print('done running BulkElements after ' + str(time.time()-time0) + ' seconds')
     return
 
@@ -104,87 +154,171 @@ output: a list of triplets with their objids (tripList)
 # Puts orbits with ChiSq under 50 (or another threshold given) into tripList.
 def siftTrips(fitsName, trackDict, chiThresh=50):
     print('only keeping orbtis with chisq under ' + str(chiThresh))
-    orbits = Table.read(fitsName, format='fits')
+    orbits = LL.OrbitColumns.read(fitsName, ['ORBITID', 'CHISQ', 'FLAGS'])
 
     # Records the initial time.
     time1 = time.time()
-    mask_chisq = (orbits['CHISQ']<chiThresh) & (orbits['FLAGS']==0)
-    orbitIDs = orbits[mask_chisq]['ORBITID']
+    orbitIDs = orbits.col('ORBITID')[orbits.goodFits(chiThresh)].tolist()
     # orbitIDs is the list of orbits with ChiSq under 50.
     tripList = []
-    for row in orbitIDs:
-        trackid = row 
-        objids = trackDict[trackid]
-        # trackDict is a dictionary of orbits; trackDict[trackid] is a single orbit.
-        del trackDict[trackid]
-        trip = Triplet(objids)
-        # Finds the triplet for the orbit.
+    for trackid in orbitIDs:
+        # trackDict[trackid] is the list of detections of a single orbit.
+        trip = Triplet(trackDict[trackid])
         trip.trackid = trackid
-        # Creates an ID for each triplet (called trackid).
         tripList.append(trip)
-        # Creates tripList, a list of all triplets.
 
     # Records the final time.
     time2 = time.time()
-    '''
-    #version 2
-    tripList2 = []
-    for row in orbits:
-        if row['CHISQ'] < chiThresh:
-            trackid = '{0:06d}'.format(row['ORBITID'])
-            objids = trackDict[trackid]
-            tripList2.append(Triplet(objids))
-    time3 = time.time()
-    '''
     print('done after ' + str(time2-time1) + ' seconds')
-    
-    #print('v2: ' + str(time3-time2))
-   
     return tripList
 
 def removeBadChisq(triplets):
     li = [trip for trip in triplets if trip.chiSq != -1]
     return li
 
+'''
+input: --path to a .npz or pickle file of triplets (tripletFile)
+       --a DetectionCatalog, or {} to use the detections in the triplets (detDict)
+       --the command line arguments (args)
+output: --a dictionary with the names of the chunk, the request file for BulkFit
+          (None if there is nothing to fit) and what writeProcessingFile returned
+'''
+def prepareChunk(tripletFile, detDict, args):
+    print('\nopen triplet file ' + tripletFile) 
+    triplets = LL.loadTriplets(tripletFile)
+    print('done loading')
+    job = {'saveName': tripletFile.split('+')[-1].split('.')[0],
+           'chunkName': tripletFile.split('/')[-1].split('+')[0],
+           'outname': None, 'orbitFile': None}
+    if(args.suppress):
+        job['lets'] = removeBadChisq(triplets)
+        return job
+    try:
+        triplets = list(set(triplets)) 
+    except TypeError:
+        triplets = triplets
+    if(not args.noPrefilter):
+        triplets = prefilter(triplets, detDict, maxRate=args.maxRate,
+                maxAccel=args.maxAccel, maxBend=args.maxBend, magThresh=args.magThresh)
+    outname, trackIDs, lets = writeProcessingFile(triplets, detDict,
+            job['chunkName'], job['saveName'])
+    # nothing left to fit if there is no request file
+    job['outname'] = outname if outname else None
+    job['trackIDs'] = trackIDs
+    job['lets'] = lets if outname else []
+    return job
+
+# Runs BulkFit on the request of a chunk from prepareChunk.
+def fitChunk(job, args, cache):
+    if(job['outname'] is not None):
+        job['orbitFile'] = callBulkFit(job['outname'], args.Ncpu, cache)
+    return job
+
+# Sifts the fitted orbits of a chunk, or runs BulkElements with -o, and writes
+# the triplets to chunkName + '+goodtriplets+' + saveName + '.txt' and .pickle
+def finishChunk(job, args):
+    if(job['orbitFile'] is not None):
+        if(args.orbit):
+            callBulkEle(job['orbitFile'])
+        else:
+            job['lets'] = siftTrips(job['orbitFile'], job['trackIDs'])
+    name = job['chunkName'] + '+goodtriplets+' + job['saveName']
+    writeTriplets(job['lets'], name + '.txt', args.orbit)
+    pickleTriplets(job['lets'], name + '.pickle', rmunbound=False)
+    return job
+
+# Runs func on every job taken from inQueue and puts the results in outQueue
+# until it takes None. After a failure it keeps taking jobs, so the stages
+# before it are not left waiting on a full queue, but does nothing with them.
+def pipelineStage(func, inQueue, outQueue, errors):
+    while True:
+        job = inQueue.get()
+        if(job is None):
+            break
+        if(errors):
+            continue
+        try:
+            job = func(job)
+        except Exception:
+            errors.append(sys.exc_info())
+            continue
+        if(outQueue is not None):
+            outQueue.put(job)
+    if(outQueue is not None):
+        outQueue.put(None)
+
+'''
+input: --paths of triplet files, one per chunk (tripletFiles)
+       --a DetectionCatalog, or {} to use the detections in the triplets (detDict)
+       --the command line arguments (args)
+       --a fitRunner.FitCache or None (cache)
+       --how many chunks may wait between two steps (depth)
+       --what to do with each fitted chunk, finishChunk by default (finish)
+output: --sifts every chunk like running siftTriplets on each in turn, but while
+          BulkFit runs on one chunk the request of the next is written and the
+          orbits of the last are read, each step in its own thread
+'''
+def siftChunks(tripletFiles, detDict, args, cache=None, depth=1, finish=None):
+    if(finish is None):
+        finish = lambda job: finishChunk(job, args)
+    errors = []
+    files = queue.Queue()
+    requests = queue.Queue(depth)
+    orbits = queue.Queue(depth)
+    threads = [threading.Thread(target=pipelineStage, args=(
+                    lambda f: prepareChunk(f, detDict, args), files, requests, errors)),
+               threading.Thread(target=pipelineStage, args=(
+                    lambda job: fitChunk(job, args, cache), requests, orbits, errors)),
+               threading.Thread(target=pipelineStage, args=(
+                    finish, orbits, None, errors))]
+    for thread in threads:
+        thread.start()
+    for tripletFile in tripletFiles:
+        files.put(tripletFile)
+    files.put(None)
+    for thread in threads:
+        thread.join()
+    if(errors):
+        traceback.print_exception(*errors[0])
+        raise errors[0][1]
+
 def main():
     args = argparse.ArgumentParser()
-    args.add_argument('triplets',
-                        help='path to pickle file; file has format ' + 
-                        'chunk###+SNOBS_S\EASON###_ML0#.pickle')
+    args.add_argument('triplets', nargs='+',
+                        help='paths to .npz or pickle files; files have format ' + 
+                        'chunk###+SNOBS_S\EASON###_ML0#.npz')
     args.add_argument('-d', '--detFile', help='path to csv file with detections')
     args.add_argument('-o', '--orbit', action='store_true', help='produce orbitfile only')
     args.add_argument('-x', '--suppress', action='store_true', help='do not run fitter')
+    args.add_argument('-j', '--Ncpu', type=int, default=cpu_count(),
+            help='number of BulkFit processes to run at once')
+    args.add_argument('-c', '--fitCache', default=fitRunner.FIT_CACHE,
+            help='sqlite file of earlier fits to reuse')
+    args.add_argument('--noCache', action='store_true', help='fit every triplet again')
+    args.add_argument('--noPrefilter', action='store_true',
+            help='send every triplet to BulkFit, without the prefilter cuts')
+    args.add_argument('--maxRate', type=float, default=1.0,
+            help='prefilter: largest rate of motion in degrees per day')
+    args.add_argument('--maxAccel', type=float, default=0.05,
+            help='prefilter: largest change of rate in degrees per day per day')
+    args.add_argument('--maxBend', type=float, default=0.02,
+            help='prefilter: largest acceleration off a great circle in degrees per day per day')
+    args.add_argument('--magThresh', type=float, default=1.0,
+            help='prefilter: largest spread of magnitudes within a band')
+    parser = args
     args = args.parse_args()
-    
-    print('\nopen pickle file ' + args.triplets) 
-    with open(args.triplets, 'rb') as pickleFile:
-        print('load pickle file')
-        triplets = pickle.load(pickleFile)
-        print('done loading')
-    saveName = args.triplets.split('+')[-1].split('.')[0]
-    chunkName = args.triplets.split('/')[-1].split('+')[0]
+    if(not args.suppress and args.detFile is None and
+            any(name.endswith('.npz') for name in args.triplets)):
+        parser.error('-d/--detFile is needed for .npz triplets, they only hold objids')
 
-    if(args.suppress):
-        lets = removeBadChisq(triplets)
+    if(args.suppress or args.detFile is None):
+        detDict = {}
     else:
-        if(args.detFile is None):
-            detDict = {}
-        else:
-            detDict = LL.objidDictionary(args.detFile)
-
-        try:
-            triplets = list(set(triplets)) 
-        except TypeError:
-            triplets = triplets
-        outname, trackIDs, lets= writeProcessingFile(triplets, detDict, chunkName, saveName)
-        fitsFile = callBulkFit(outname)
-        if(args.orbit):
-            callBulkEle(fitsFile)
-        else:
-            lets = siftTrips(fitsFile, trackIDs)
-    # Saving and pickling triplets to chunkName + '+goodtriplets+' + saveName + '.txt'
-    writeTriplets(lets, chunkName + '+goodtriplets+' + saveName + '.txt', args.orbit)
-    pickleTriplets(lets, chunkName + '+goodtriplets+' + saveName + '.pickle', rmunbound=False)
+        detDict = LL.loadCatalog(args.detFile)
+    cache = None
+    if(not args.suppress and not args.noCache):
+        cache = fitRunner.FitCache(args.fitCache)
+    siftChunks(args.triplets, detDict, args, cache)
 
 # Runs program.
 if __name__=='__main__':
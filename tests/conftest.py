@@ -0,0 +1,10 @@
+# The linker modules import GammaTPlotwStatTNOExFaster and Orbit from $TNO_PATH at import
+# time; tests that need them skip when they cannot be imported.
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('TNO_PATH', ROOT)
+for path in [ROOT, os.environ['TNO_PATH']]:
+    if(path not in sys.path):
+        sys.path.insert(0, path)
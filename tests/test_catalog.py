@@ -0,0 +1,183 @@
+import collections
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+
+def writeCsv(path, withMag=True, withFlux=True):
+    rng = np.random.RandomState(1)
+    n = 50
+    df = pd.DataFrame({'RA': rng.uniform(-10, 370, n), 'DEC': rng.uniform(-60, 5, n),
+                       'MJD': 57000 + rng.uniform(0, 30, n),
+                       'SNOBJID': rng.permutation(np.arange(1000, 1000+n)),
+                       'EXPNUM': rng.randint(100, 110, n), 'CCDNUM': rng.randint(1, 62, n),
+                       'BAND': rng.choice(['g', 'r', 'i', 'z'], n),
+                       'SNFAKE_ID': rng.randint(0, 3, n),
+                       'FLUX_ERR': rng.uniform(0, 50, n),
+                       'ERRAWIN_WORLD': rng.uniform(0, 1e-4, n)})
+    if(withMag):
+        df['MAG'] = rng.uniform(18, 24, n)
+    if(withFlux):
+        df['FLUX'] = rng.uniform(100, 5000, n)
+    path = str(path)
+    df.to_csv(path, index=False)
+    return path
+
+# the csv reader the catalog replaced, one Detection per row
+def wrapDets(csvFile):
+    df = pd.read_csv(csvFile)
+    df.rename(str.lower, axis='columns', inplace=True)
+    df.rename(columns={'snobjid': 'objid', 'snfake_id': 'fakeid', 'ccdnum': 'ccd'},
+              inplace=True)
+    if('mag' in df.columns):
+        fluxList = [0]*len(df)
+    else:
+        fluxList = df['flux'].tolist()
+    fakeidList = df['fakeid'].tolist() if 'fakeid' in df.columns else [0]*len(df)
+    fluxErrList = df['flux_err'].tolist() if 'flux_err' in df.columns else [10]*len(df)
+    posErrList = (df['errawin_world'].tolist() if 'errawin_world' in df.columns
+                  else [0]*len(df))
+    dets = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for y in range(len(df)):
+            det = LL.Detection(float(df['ra'][y]), float(df['dec'][y]), float(df['mjd'][y]),
+                    float(fluxList[y]), int(df['objid'][y]), int(df['expnum'][y]),
+                    int(df['ccd'][y]), df['band'][y], 0, int(fakeidList[y]))
+            det.setMagErr(int(fluxErrList[y]))
+            det.posErr = float(posErrList[y])
+            if(det.mag > 40):
+                det.mag = float(df['mag'][y])
+            dets.append(det)
+    return dets
+
+def assertSameAsWrapDets(csvFile):
+    dets = wrapDets(csvFile)
+    catalog = LL.DetectionCatalog.fromCsv(csvFile, chunkSize=7)
+    assert len(catalog) == len(dets)
+    for det, row in zip(dets, catalog):
+        for name in ['ra', 'dec', 'mjd', 'mag', 'magerr', 'posErr']:
+            np.testing.assert_equal(getattr(row, name), getattr(det, name), err_msg=name)
+        for name in ['objid', 'expnum', 'ccd', 'band', 'fakeid']:
+            assert getattr(row, name) == getattr(det, name), name
+
+@pytest.mark.parametrize('withMag,withFlux', [(True, True), (True, False), (False, True)])
+def test_fromCsv_matches_wrapDets(tmpdir, withMag, withFlux):
+    assertSameAsWrapDets(writeCsv(tmpdir.join('dets.csv'), withMag, withFlux))
+
+def test_calcCones_pads_short_cones(monkeypatch):
+    # a cone for fewer nites than lookAhead leaves the rest with radius 0
+    monkeypatch.setattr(LL.gts, 'calcCone',
+            lambda lookAhead, ra, dec, mjd: [[0.1, 0.2], [0.5, 0.6], [1.0, 2.0]])
+    angle1, angle2, radius = LL.calcCones(4, np.zeros(3), np.zeros(3), np.zeros(3))
+    assert radius.shape == (3, 4)
+    np.testing.assert_array_equal(radius[:, :2], [[1.0, 2.0]]*3)
+    np.testing.assert_array_equal(radius[:, 2:], 0)
+    np.testing.assert_array_equal(angle2[:, :2], [[0.5, 0.6]]*3)
+
+def fakeCone(lookAhead, ra, dec, mjd):
+    # cones that differ from detection to detection, some of them across the 0 angle
+    nites = np.arange(max(lookAhead, 0))
+    angle1 = (ra*0.7 + 0.3*nites) % (2*np.pi)
+    angle2 = (angle1 + 1.5 + dec*0.1) % (2*np.pi)
+    return [angle1, angle2, 0.4 + 0.3*nites]
+
+def test_withinCone_rows_matches_withinCone(monkeypatch):
+    monkeypatch.setattr(LL.gts, 'calcCone', fakeCone)
+    rng = np.random.RandomState(2)
+    n = 60
+    lookAhead = 5
+    ra = rng.uniform(-2, 2, n)
+    dec = rng.uniform(-2, 2, n)
+    mjd = 57000 + rng.uniform(0, 6, n)
+    dets = [LL.Detection(ra[i], dec[i], mjd[i], 1000., i, i, 1, 'r', lookAhead)
+            for i in range(n)]
+    catalog = LL.DetectionCatalog.fromDetections(dets, lookAhead)
+    anchors, cands = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    anchors = anchors.ravel()
+    cands = cands.ravel()
+    expected = np.array([dets[a].withinCone(dets[c]) for a, c in zip(anchors, cands)])
+    assert expected.any() and not expected.all()
+    np.testing.assert_array_equal(LL.withinCone_rows(catalog, anchors, cands), expected)
+
+def test_cached_catalog_rows_can_be_changed(tmpdir):
+    csvFile = writeCsv(tmpdir.join('dets.csv'))
+    LL.writeDetCache(csvFile)
+    catalog = LL.readDetCache(csvFile)
+    assert catalog is not None
+    fromCsv = LL.DetectionCatalog.fromCsv(csvFile)
+    for name in LL.DET_DTYPE.names:
+        np.testing.assert_array_equal(catalog.col(name), fromCsv.col(name))
+    det = catalog.row(3)
+    det.mag = 12.5
+    det.posErr = 0.25
+    assert catalog.row(3).mag == 12.5
+    assert catalog.row(3).posErr == 0.25
+    # the change stays in memory, the cache on disk is unchanged
+    again = LL.readDetCache(csvFile)
+    assert again.row(3).mag == fromCsv.row(3).mag
+    assert again.row(3).posErr == fromCsv.row(3).posErr
+
+def test_cone_keeps_the_lookAhead_it_was_made_with(monkeypatch):
+    monkeypatch.setattr(LL.gts, 'calcCone', fakeCone)
+    det = LL.Detection(1.5, -0.5, 57000.2, 1000., 7, 7, 1, 'r', 6)
+    catalog = LL.DetectionCatalog.fromDetections([det], 6)
+    row = catalog.row(0)
+    expected = fakeCone(6, 1.5, -0.5, 57000.2)
+    # a candidate is marked with lookAhead -1 before its cone is read
+    for d in (det, row, pickle.loads(pickle.dumps(row))):
+        d.lookAhead = -1
+        for got, want in zip((d.angle1, d.angle2, d.radius), expected):
+            np.testing.assert_array_equal(got, want)
+
+def makeConeField(n=60, lookAhead=5, seed=2):
+    rng = np.random.RandomState(seed)
+    # anchors around ra 0, so candidates stored as ra 358..360 wrap to -2..0
+    ra = rng.uniform(-2, 2, n)
+    dec = rng.uniform(-2, 2, n)
+    mjd = 57000 + rng.uniform(0, 6, n)
+    dets = [LL.Detection(ra[i], dec[i], mjd[i], 1000., i, i, 1, 'r', lookAhead)
+            for i in range(n)]
+    cands = np.zeros(n, dtype=[('ra', 'f8'), ('dec', 'f8'), ('mjd', 'f8')])
+    cands['ra'] = ra % 360
+    cands['dec'] = dec
+    cands['mjd'] = mjd
+    return dets, cands
+
+Cand = collections.namedtuple('Cand', 'ra dec mjd')
+
+def test_withinCone_batch_matches_withinCone(monkeypatch):
+    monkeypatch.setattr(LL.gts, 'calcCone', fakeCone)
+    dets, cands = makeConeField()
+    assert (cands['ra'] > 180).any()
+    catalog = LL.DetectionCatalog.fromDetections(dets, 5)
+    total = 0
+    for anchor in dets:
+        expected = np.array([anchor.withinCone(Cand(*c)) for c in cands.tolist()])
+        total += expected.sum()
+        np.testing.assert_array_equal(LL.withinCone_batch(anchor, cands), expected)
+        # the same positions without the wrap, rounded a little differently
+        expected = np.array([anchor.withinCone(det) for det in dets])
+        np.testing.assert_array_equal(LL.withinCone_batch(anchor, dets), expected)
+        np.testing.assert_array_equal(LL.withinCone_batch(anchor, catalog), expected)
+    assert 0 < total < len(dets)**2
+    # some of the cones cross the 0 angle
+    assert any((d.angle1 > d.angle2).any() for d in dets)
+
+def test_withinCone_pairs_matches_withinCone(monkeypatch):
+    monkeypatch.setattr(LL.gts, 'calcCone', fakeCone)
+    dets, cands = makeConeField(seed=4)
+    catalog = LL.DetectionCatalog.fromDetections(dets, 5)
+    # two blocks of rows, as two exposures would be
+    anchorRows = np.arange(0, 60, 2)
+    candRows = np.arange(1, 60, 3)
+    expected = np.array([[dets[a].withinCone(dets[c]) for c in candRows] for a in anchorRows])
+    assert expected.any() and not expected.all()
+    mask = LL.withinCone_pairs(catalog, anchorRows, candRows)
+    assert mask.shape == (len(anchorRows), len(candRows))
+    np.testing.assert_array_equal(mask, expected)
+    assert LL.withinCone_pairs(catalog, anchorRows, []).shape == (len(anchorRows), 0)
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+import fakeBulk
+
+def writeDetections(path, nExp=5):
+    rows = []
+    for exp in range(nExp):
+        for obj in range(3):
+            rows.append({'RA': 10. + obj, 'DEC': -5., 'MJD': 57000.5 + 0.25*exp,
+                         'FLUX': 1000., 'SNOBJID': 10*exp + obj, 'EXPNUM': 900 - 7*exp,
+                         'CCDNUM': 1, 'BAND': 'r'})
+    pd.DataFrame(rows).to_csv(str(path), index=False)
+    return str(path)
+
+def test_exposure_mjds_come_from_a_small_table(tmpdir):
+    csvFile = writeDetections(tmpdir.join('dets.csv'))
+    options = {'detections': csvFile}
+    expnums = np.array([900, 872, 893, 900])
+    np.testing.assert_array_equal(fakeBulk.expnumMjds(options, expnums),
+                                  [57000.5, 57001.5, 57000.75, 57000.5])
+    assert os.path.isfile(fakeBulk.exposureTablePath(csvFile))
+    with pytest.raises(RuntimeError):
+        fakeBulk.expnumMjds(options, np.array([901]))
+    # a changed detection file makes the table again
+    writeDetections(tmpdir.join('dets.csv'), nExp=7)
+    os.utime(csvFile, (1e9, 1e9))
+    assert fakeBulk.expnumMjds(options, np.array([858]))[0] == 57002.
+
+def test_exposure_table_from_the_detection_cache(tmpdir):
+    csvFile = writeDetections(tmpdir.join('dets.csv'))
+    LL.writeDetCache(csvFile)
+    exps, mjd = fakeBulk.exposureTable(csvFile)
+    catalog = LL.loadCatalog(csvFile)
+    expected, first = np.unique(catalog.col('expnum'), return_index=True)
+    np.testing.assert_array_equal(exps, expected)
+    np.testing.assert_array_equal(mjd, catalog.col('mjd')[first])
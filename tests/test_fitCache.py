@@ -0,0 +1,99 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.io import fits
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+import fitRunner
+import siftTriplets
+import mergeTrips
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# objects moving in straight lines, one detection per night each
+def writeDetections(path):
+    rows = []
+    for obj in range(6):
+        for nite in range(4):
+            rows.append({'RA': 30 + obj + 0.05*nite, 'DEC': -20 + 0.3*obj - 0.02*nite + 1e-4*nite**2,
+                         'MJD': 57000.1 + nite, 'MAG': 22., 'FLUX_ERR': 10,
+                         'SNOBJID': 100*obj + nite, 'EXPNUM': 500 + nite, 'CCDNUM': 1,
+                         'BAND': 'r', 'ERRAWIN_WORLD': 1e-5})
+    pd.DataFrame(rows).to_csv(str(path), index=False)
+    return str(path)
+
+@pytest.fixture
+def fitEnv(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    csvFile = writeDetections(tmpdir.join('dets.csv'))
+    monkeypatch.setenv('PATH', os.path.join(ROOT, 'fakebin') + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('PYTHON', sys.executable)
+    monkeypatch.setenv('FAKE_BULK_DETECTIONS', csvFile)
+    # counts the orbits sent to BulkFit in every run
+    fitted = []
+    runCommand = fitRunner.runCommand
+    def countingRunCommand(cmd):
+        if(cmd[0] == 'BulkFit'):
+            request = [x.split('=', 1)[1] for x in cmd if x.startswith('-observationFile=')][0]
+            fitted.append(len(np.unique(fits.getdata(request, 1)['ORBITID'])))
+        runCommand(cmd)
+    monkeypatch.setattr(fitRunner, 'runCommand', countingRunCommand)
+    catalog = LL.loadCatalog(csvFile, useCache=False)
+    cache = fitRunner.FitCache(str(tmpdir.join('fits.db')))
+    yield catalog, cache, fitted
+    cache.close()
+
+def tracks(catalog, nites, objects=range(6), first=0):
+    return dict((first + obj, [catalog[100*obj + nite] for nite in nites]) for obj in objects)
+
+def chisqs(goodid, badid):
+    return dict(goodid + badid)
+
+def test_merge_takes_fits_from_another_request(fitEnv):
+    catalog, cache, fitted = fitEnv
+    trackDict = tracks(catalog, [0, 1, 2])
+    first = chisqs(*mergeTrips.siftChecks(trackDict, 'first', cache=cache))
+    assert fitted == [6]
+    # the same tracks under other trackids and in another frame, and one new track
+    again = tracks(catalog, [0, 1, 2], range(1, 6), first=50)
+    again[99] = [catalog[nite] for nite in [1, 2, 3]]
+    second = chisqs(*mergeTrips.siftChecks(again, 'second', cache=cache))
+    assert fitted == [6, 1]
+    for obj in range(1, 6):
+        assert second[50 + obj] == first[obj]
+    assert 99 in second
+
+def test_sift_fits_are_not_taken_by_merge(fitEnv):
+    catalog, cache, fitted = fitEnv
+    trackDict = tracks(catalog, [0, 1, 2])
+    request = LL.writeDetToOrb(trackDict, 'siftRequest+chunk000001+dets.fits')
+    siftTriplets.callBulkFit(request, 1, cache)
+    assert fitted == [6]
+    # merge fits without -bindingFactor=1, so none of the sift fits can be used
+    mergeTrips.siftChecks(trackDict, 'merge', cache=cache)
+    assert fitted == [6, 6]
+    assert len(cache) == 12
+    # and the merge fits are not taken by sift either
+    siftTriplets.callBulkFit(request, 1, cache)
+    assert fitted == [6, 6]
+
+def test_sift_rerun_takes_its_fits(fitEnv):
+    catalog, cache, fitted = fitEnv
+    request = LL.writeDetToOrb(tracks(catalog, [0, 1, 2]), 'siftRequest+chunk000001+dets.fits')
+    orbitFile = siftTriplets.callBulkFit(request, 1, cache)
+    before = fits.getdata(orbitFile, 1)
+    siftTriplets.callBulkFit(request, 1, cache)
+    assert fitted == [6]
+    after = fits.getdata(orbitFile, 1)
+    for name in ['ORBITID', 'CHISQ', 'DOF', 'FLAGS', 'ABG', 'ELEMENTS']:
+        np.testing.assert_array_equal(after[name], before[name])
+    # a request with only some of the tracks is in another frame and is fit again
+    request = LL.writeDetToOrb(tracks(catalog, [0, 1, 2], range(3)),
+            'siftRequest+chunk000002+dets.fits')
+    siftTriplets.callBulkFit(request, 1, cache)
+    assert fitted == [6, 3]
@@ -0,0 +1,110 @@
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+import growTriplets
+
+Trip = namedtuple('Trip', 'trackid')
+
+# tracks all over the sky, near the poles and across ra 0, with a few wide
+# search radii and a crowd of detections around some of the predictions
+def makeField(seed=3, nTracks=60, nDets=4000):
+    rng = np.random.RandomState(seed)
+    trackids = rng.permutation(np.arange(100, 100 + 3*nTracks, 3))[:nTracks]
+    ra0 = np.concatenate((rng.uniform(0, 360, nTracks - 6), [359.9, 0.1, 10, 200, 45, 300]))
+    dec0 = np.concatenate((rng.uniform(-80, 80, nTracks - 6), [0, 0, 89.5, -89.7, 30, -45]))
+    rate = rng.uniform(-0.2, 0.2, (nTracks, 2))
+    err = rng.uniform(100, 3000, nTracks)
+    err[:4] = 40000
+    mjds = np.arange(57000, 57160, 20.)
+    predMjds = np.unique(np.concatenate((mjds, mjds + 2, mjds - 2)))
+    orbitid = np.repeat(trackids, len(predMjds))
+    mjd = np.tile(predMjds, nTracks)
+    idx = np.repeat(np.arange(nTracks), len(predMjds))
+    ra = (ra0[idx] + rate[idx, 0]*(mjd - 57000)) % 360
+    dec = np.clip(dec0[idx] + rate[idx, 1]*(mjd - 57000), -89.9, 89.9)
+    predictions = LL.PredictionTable(orbitid, mjd, ra, dec, err[idx])
+    # half the detections near a prediction, the rest anywhere
+    near = rng.randint(0, len(orbitid), nDets//2)
+    detRa = np.concatenate(((ra[near] + rng.normal(0, 0.5, nDets//2)) % 360,
+                            rng.uniform(0, 360, nDets - nDets//2)))
+    detDec = np.concatenate((np.clip(dec[near] + rng.normal(0, 0.5, nDets//2), -90, 90),
+                             np.degrees(np.arcsin(rng.uniform(-1, 1, nDets - nDets//2)))))
+    detMjd = np.clip(np.concatenate((mjd[near] + rng.uniform(-2, 2, nDets//2),
+                                     rng.uniform(57000, 57160, nDets - nDets//2))), 57000, 57159)
+    dets = {'objid': np.arange(nDets) + 1000, 'ra': detRa, 'dec': detDec, 'mjd': detMjd,
+            'expnum': rng.randint(1, 500, nDets), 'err': rng.uniform(1e-5, 1e-4, nDets)}
+    mjd_det = growTriplets.mjd_det_dict(dets, 20)
+    return [Trip(t) for t in trackids], predictions, mjd_det
+
+# every detection of each mjd range within the radius, nearest first, at most maxCands
+def bruteForce(trips, predictions, mjd_det, maxCands=20):
+    trackids = []
+    objids = []
+    for trip in trips:
+        for mjd in growTriplets.mjd_generator(mjd_det):
+            ra, dec, radius = growTriplets.search_radius(predictions, np.array([trip.trackid]),
+                    np.array([mjd], dtype='f8'), 2, 3)
+            det = mjd_det[mjd]
+            front = np.dot(growTriplets.unit_vectors(det.ra, det.dec),
+                           growTriplets.unit_vectors(ra, dec)[0]) > 0
+            x, y = growTriplets.radec_to_gnomonic(det.ra, det.dec, ra[0], dec[0])
+            dist = np.hypot(x, y)
+            rows = np.nonzero(front & (dist < radius[0]))[0]
+            rows = rows[np.argsort(dist[rows], kind='mergesort')][:maxCands]
+            trackids.extend([trip.trackid]*len(rows))
+            objids.extend(det.objid[rows].tolist())
+    return np.array(trackids), np.array(objids)
+
+@pytest.mark.parametrize('tileSize', [3., 10., 60.])
+def test_candidates_match_brute_force(tileSize):
+    trips, predictions, mjd_det = makeField()
+    expected = bruteForce(trips, predictions, mjd_det)
+    trackids, cands = growTriplets.determineCandsInRadius(trips, predictions, mjd_det,
+            growTriplets.mjd_generator(mjd_det), 2, 3, 1, tileSize)
+    # some searches are cut to the nearest maxCands
+    assert np.bincount(np.unique(expected[0], return_inverse=True)[1]).max() > 20
+    np.testing.assert_array_equal(trackids, expected[0])
+    np.testing.assert_array_equal(cands.objid, expected[1])
+    for name in growTriplets.Det._fields:
+        assert len(getattr(cands, name)) == len(trackids)
+
+def test_candidates_in_spawned_processes(monkeypatch):
+    trips, predictions, mjd_det = makeField(seed=5, nTracks=30, nDets=2000)
+    mjd_arr = growTriplets.mjd_generator(mjd_det)
+    serial = growTriplets.determineCandsInRadius(trips, predictions, mjd_det, mjd_arr, 2, 3, 1, 5.)
+    # nothing may depend on the state of the parent process
+    monkeypatch.setattr(growTriplets, 'Pool', multiprocessing.get_context('spawn').Pool)
+    parallel = growTriplets.determineCandsInRadius(trips, predictions, mjd_det, mjd_arr, 2, 3, 3, 5.)
+    np.testing.assert_array_equal(parallel[0], serial[0])
+    for x, y in zip(parallel[1], serial[1]):
+        np.testing.assert_array_equal(x, y)
+
+def test_no_tracks():
+    trips, predictions, mjd_det = makeField(nTracks=10, nDets=100)
+    trackids, cands = growTriplets.determineCandsInRadius([], predictions, mjd_det,
+            growTriplets.mjd_generator(mjd_det))
+    assert len(trackids) == 0
+    assert len(cands.objid) == 0
+
+def test_selectCandidates():
+    trackids = [7, 3, 5]
+    # triplet 7 owns 1, 2, 3; triplet 3 owns 4; triplet 5 owns nothing
+    ownPtr = [0, 3, 4, 4]
+    ownObjids = [1, 2, 3, 4]
+    orbitid = np.array([7, 7, 7, 7, 3, 3, 3, 5, 5, 9, 7])
+    objid = np.array([2, 10, 11, 12, 4, 20, 21, 30, 31, 40, 13])
+    chisq = np.array([0.1, 3., 1., 2., 0.1, 50., 4., 6., 5., 1., 2.])
+    indptr, cands = growTriplets.selectCandidates(trackids, ownPtr, ownObjids,
+            orbitid, objid, chisq, 10., 2)
+    np.testing.assert_array_equal(indptr, [0, 2, 3, 5])
+    # the smallest CHISQ first, ties by objid; not the triplet's own, not over thresh
+    np.testing.assert_array_equal(cands, [11, 12, 21, 31, 30])
+    indptr, cands = growTriplets.selectCandidates(trackids, ownPtr, ownObjids,
+            orbitid[:0], objid[:0], chisq[:0], 10., 2)
+    np.testing.assert_array_equal(indptr, [0, 0, 0, 0])
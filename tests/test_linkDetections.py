@@ -0,0 +1,35 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+import linkDetections
+
+def makeCatalog(lookAhead=4):
+    rng = np.random.RandomState(3)
+    n = 200
+    dets = [LL.Detection(rng.uniform(-1, 1), rng.uniform(-1, 1), 57000 + rng.uniform(0, 8),
+                         1000., i, rng.randint(0, 40), 1, 'r', lookAhead)
+            for i in range(n)]
+    return dets, LL.DetectionCatalog.fromDetections(dets, lookAhead)
+
+def test_linkDetections_matches_withinCone():
+    dets, catalog = makeCatalog()
+    links = dict(linkDetections.linkDetections(catalog, 1))
+    assert sorted(links.keys()) == list(range(len(dets)))
+    for det in dets:
+        expected = [x for x in dets if x.expnum != det.expnum and det.withinCone(x)]
+        expected.sort(key=lambda x: (x.mjd, x.objid))
+        assert links[det.objid] == [x.objid for x in expected]
+
+def test_linkDetections_spawned_workers(monkeypatch):
+    # the workers get the catalog from the pool initializer, not from a fork
+    dets, catalog = makeCatalog()
+    expected = linkDetections.linkDetections(catalog, 1)
+    monkeypatch.setattr(linkDetections, 'Pool', multiprocessing.get_context('spawn').Pool)
+    monkeypatch.setattr(linkDetections, '_catalog', None)
+    monkeypatch.setattr(linkDetections, '_niteRows', {})
+    assert linkDetections.linkDetections(catalog, 2) == expected
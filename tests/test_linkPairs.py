@@ -0,0 +1,103 @@
+import glob
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+import linkPairs
+
+def makeDetPairs(n=60, seed=4):
+    # every detection links to a few of the detections after it
+    rng = np.random.RandomState(seed)
+    detPairs = []
+    for i in range(n):
+        later = np.arange(i+1, n)
+        links = sorted(rng.choice(later, min(len(later), rng.randint(0, 5)), replace=False))
+        detPairs.append((i, [int(x) for x in links]))
+    return detPairs
+
+# returns the chunks written in a directory by number, as lists of (trackid, objids)
+def readChunks(path):
+    chunks = {}
+    for name in glob.glob(os.path.join(str(path), 'chunk*.npz')):
+        number = int(os.path.basename(name)[5:11])
+        chunks[number] = list(LL.TripletChunk.load(name))
+    return chunks
+
+def test_formTripletsParallel_matches_formTriplets(tmpdir, monkeypatch):
+    detPairs = makeDetPairs()
+    serial = tmpdir.mkdir('serial')
+    monkeypatch.chdir(serial)
+    tail = linkPairs.formTriplets(detPairs, 17, 'test')
+    parallel = tmpdir.mkdir('parallel')
+    monkeypatch.chdir(parallel)
+    # the workers get the links from the pool initializer, not from a fork
+    monkeypatch.setattr(linkPairs, 'Pool', multiprocessing.get_context('spawn').Pool)
+    parallelTail = linkPairs.formTripletsParallel(detPairs, 17, 'test', 3)
+    assert len(readChunks(serial)) > 3
+    assert readChunks(parallel) == readChunks(serial)
+    assert parallelTail == tail
+
+def test_seekTriplet_matches_iterTriplets():
+    detPairs = makeDetPairs()
+    linkDict = linkPairs.makeLinkDict(detPairs)
+    everything = [trip for pos, trip in linkPairs.iterTriplets(detPairs, linkDict)]
+    cumCounts = np.cumsum(linkPairs.countTriplets(detPairs, linkDict))
+    assert cumCounts[-1] == len(everything)
+    for index in range(len(everything)):
+        start = linkPairs.seekTriplet(detPairs, linkDict, cumCounts, index)
+        pos, trip = next(linkPairs.iterTriplets(detPairs, linkDict, start))
+        assert trip == everything[index]
+    start = linkPairs.seekTriplet(detPairs, linkDict, cumCounts, len(everything))
+    assert list(linkPairs.iterTriplets(detPairs, linkDict, start)) == []
+
+class Interrupted(Exception):
+    pass
+
+def test_checkpoint_resume_matches_full_run(tmpdir, monkeypatch):
+    detPairs = makeDetPairs()
+    full = tmpdir.mkdir('full')
+    monkeypatch.chdir(full)
+    tail = linkPairs.formTriplets(detPairs, 13, 'test')
+
+    resumed = tmpdir.mkdir('resumed')
+    monkeypatch.chdir(resumed)
+    saveChunk = linkPairs.saveChunk
+    def stopAfterThree(tripList, x, saveName, asPickle=False):
+        if(x > 3):
+            raise Interrupted()
+        saveChunk(tripList, x, saveName, asPickle)
+    monkeypatch.setattr(linkPairs, 'saveChunk', stopAfterThree)
+    with pytest.raises(Interrupted):
+        linkPairs.formTriplets(detPairs, 13, 'test')
+    monkeypatch.setattr(linkPairs, 'saveChunk', saveChunk)
+    checkpoint = linkPairs.readCheckpoint('checkpoint+test.json')
+    assert checkpoint['chunk'] == 4
+    assert checkpoint['count'] == 3*13
+    startPos = (checkpoint['anchor'], checkpoint['link'], checkpoint['link2'])
+    resumedTail = linkPairs.formTriplets(detPairs, 13, 'test', chunkStart=checkpoint['chunk'],
+            startPos=startPos, tripletCount=checkpoint['count'])
+    assert readChunks(resumed) == readChunks(full)
+    assert resumedTail == tail
+    with open(str(full.join('checkpoint+test.json'))) as f:
+        assert f.read() == open('checkpoint+test.json').read()
+
+def test_last_triplet_resume_matches_full_run(tmpdir, monkeypatch):
+    # the old way to continue: scan for the last triplet of the last chunk, which
+    # starts the new chunks with that triplet again, as it always has
+    detPairs = makeDetPairs()
+    linkDict = linkPairs.makeLinkDict(detPairs)
+    everything = [list(trip) for pos, trip in linkPairs.iterTriplets(detPairs, linkDict)]
+    monkeypatch.chdir(tmpdir)
+    lastTriplet = everything[3*13 - 1]
+    tail = linkPairs.formTriplets(detPairs, 13, 'again', lastTriplet, 4)
+    again = []
+    for name in sorted(glob.glob(str(tmpdir.join('chunk*+again.npz')))):
+        again.extend(trip for trackid, trip in LL.TripletChunk.load(name))
+    assert os.path.basename(sorted(glob.glob(str(tmpdir.join('chunk*+again.npz'))))[0]) == \
+            'chunk000004+again.npz'
+    assert again + [trip for trackid, trip in tail] == everything[3*13 - 1:]
@@ -0,0 +1,78 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+from astropy.table import Table
+import growTriplets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def makeTable(dense=True):
+    rng = np.random.RandomState(7)
+    orbitid, mjd = np.meshgrid([5, 2, 9, 40], [57001., 57003., 57000., 57005.5], indexing='ij')
+    orbitid = orbitid.ravel()
+    mjd = mjd.ravel()
+    if(not dense):
+        orbitid = orbitid[::3]
+        mjd = mjd[::3]
+    shuffle = rng.permutation(len(orbitid))
+    orbitid = orbitid[shuffle]
+    mjd = mjd[shuffle]
+    ra = orbitid*10. + mjd - 57000
+    dec = -orbitid - (mjd - 57000)/10.
+    err = (orbitid + mjd - 57000).astype('f4')
+    return LL.PredictionTable(orbitid, mjd, ra, dec, err), orbitid, mjd, ra, dec, err
+
+@pytest.mark.parametrize('dense', [True, False])
+def test_lookup(dense):
+    table, orbitid, mjd, ra, dec, err = makeTable(dense)
+    assert len(table) == len(orbitid)
+    got = table.lookup(orbitid, mjd)
+    np.testing.assert_array_equal(got[0], ra)
+    np.testing.assert_array_equal(got[1], dec)
+    np.testing.assert_array_equal(got[2], err)
+    # sorted by ORBITID, then MJD
+    order = np.lexsort((mjd, orbitid))
+    np.testing.assert_array_equal(table.col('ORBITID'), orbitid[order])
+    np.testing.assert_array_equal(table.col('MJD'), mjd[order])
+    with pytest.raises(KeyError):
+        table.lookup([2, 3], [57001., 57001.])
+    assert table.indexOf(2, 57002.) == -1
+
+def test_dense_table_size():
+    # RA and DEC as f8 and ERROR_A as f4 per prediction
+    table = makeTable()[0]
+    assert sum(col.nbytes for col in table.columns.values()) == 20*len(table)
+
+def test_failing_BulkPredict_raises(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv('PATH', os.path.join(ROOT, 'fakebin') + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('PYTHON', sys.executable)
+    with pytest.raises(RuntimeError) as error:
+        growTriplets.callMjdPrediction('missing.fits', 'missing.predict', 'missing.orbit')
+    assert 'BulkPredict exited with' in str(error.value)
+    with pytest.raises(RuntimeError) as error:
+        growTriplets.callSigmaDet('missing.fits', 'missing.prox', 'missing.orbit')
+    assert 'BulkProximity exited with' in str(error.value)
+
+def test_ellipse_columns_only_when_asked(tmpdir):
+    table, orbitid, mjd, ra, dec, err = makeTable(dense=False)
+    errB = err/2
+    pa = (orbitid*7. + mjd) % 180
+    path = str(tmpdir.join('preds.predict'))
+    Table([orbitid, mjd, ra, dec, err, errB, pa],
+          names=('ORBITID', 'MJD', 'RA', 'DEC', 'ERROR_A', 'ERROR_B', 'PA')).write(path, format='fits')
+    plain = LL.PredictionTable.read(path)
+    assert sorted(plain.columns) == ['DEC', 'ERROR_A', 'RA']
+    full = LL.PredictionTable.read(path, ellipse=True)
+    # ERROR_B and PA add 8 B per prediction
+    assert sum(col.nbytes for col in full.columns.values()) == 28*len(full)
+    got = full.lookup(orbitid, mjd, ('ERROR_A', 'ERROR_B', 'PA'))
+    np.testing.assert_array_equal(got[0], err)
+    np.testing.assert_array_equal(got[1], errB.astype('f4'))
+    np.testing.assert_array_equal(got[2], pa.astype('f4'))
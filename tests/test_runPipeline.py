@@ -0,0 +1,114 @@
+import os
+import sys
+
+import pytest
+
+import runPipeline
+
+def writer(*names):
+    # a command that writes the given files
+    return [sys.executable, '-c',
+            'import sys\nfor name in sys.argv[1:]: open(name, "w").write("x")'] + list(names)
+
+def test_optional_output_may_be_missing(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    stampDir = str(tmpdir.mkdir('.pipeline'))
+    hashes = runPipeline.HashCache(os.path.join(stampDir, 'hashes.json'))
+    # left over from an earlier run, must not pass for an output of this one
+    open('chunk.orbit', 'w').write('old')
+    task = runPipeline.Task('sift', writer('good.pickle'), [], ['good.pickle', 'chunk.orbit'],
+                            optional=['chunk.orbit'])
+    runPipeline.runTask(task, stampDir, hashes)
+    assert task.outputs == ['good.pickle']
+    assert not os.path.exists('chunk.orbit')
+
+    # the next task reads the missing file and runs again once it is there
+    grow = runPipeline.Task('grow', writer('grown.pickle'), ['good.pickle', 'chunk.orbit'],
+                            ['grown.pickle'], optional=['chunk.orbit'])
+    key = runPipeline.taskKey(grow, hashes)
+    runPipeline.runTask(grow, stampDir, hashes)
+    assert runPipeline.taskKey(grow, hashes) == key
+    open('chunk.orbit', 'w').write('new')
+    assert runPipeline.taskKey(grow, hashes) != key
+
+def test_required_output_must_be_written(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    stampDir = str(tmpdir.mkdir('.pipeline'))
+    hashes = runPipeline.HashCache(os.path.join(stampDir, 'hashes.json'))
+    task = runPipeline.Task('sift', writer('good.pickle'), [], ['good.pickle', 'chunk.orbit'])
+    with pytest.raises(RuntimeError) as error:
+        runPipeline.runTask(task, stampDir, hashes)
+    assert 'did not write chunk.orbit' in str(error.value)
+
+def test_up_to_date_without_optional_output(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    stampDir = str(tmpdir.mkdir('.pipeline'))
+    tasks = [runPipeline.Task('sift', writer('good.pickle'), [], ['good.pickle', 'chunk.orbit'],
+                              optional=['chunk.orbit'])]
+    runPipeline.runTasks(tasks, 1, stampDir)
+    mtime = os.stat('good.pickle').st_mtime
+    finished = runPipeline.runTasks(tasks, 1, stampDir)
+    assert finished['sift'].outputs == ['good.pickle']
+    assert os.stat('good.pickle').st_mtime == mtime
+
+def test_stale_glob_outputs_are_removed(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    stampDir = str(tmpdir.mkdir('.pipeline'))
+    hashes = runPipeline.HashCache(os.path.join(stampDir, 'hashes.json'))
+    # an earlier run made three chunks, this one makes two
+    for x in range(3):
+        open('chunk00000' + str(x) + '+s.npz', 'w').write('old')
+    open('chunk000000+other.npz', 'w').write('other season')
+    task = runPipeline.Task('pairs', writer('chunk000000+s.npz', 'chunk000001+s.npz'), [], [],
+                            outputGlob='chunk[0-9][0-9][0-9][0-9][0-9][0-9]+s.npz')
+    runPipeline.runTask(task, stampDir, hashes)
+    assert task.outputs == ['chunk000000+s.npz', 'chunk000001+s.npz']
+    assert not os.path.exists('chunk000002+s.npz')
+    assert os.path.exists('chunk000000+other.npz')
+
+def timed(name):
+    # a command that writes when it started and stopped to name
+    return [sys.executable, '-c',
+            'import sys, time\nt = time.time()\ntime.sleep(0.3)\n'
+            'open(sys.argv[1], "w").write(repr((t, time.time())))', name]
+
+def test_tasks_share_the_processes(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    stampDir = str(tmpdir.mkdir('.pipeline'))
+    tasks = [runPipeline.Task('a', timed('a'), [], ['a'], procs=2),
+             runPipeline.Task('b', timed('b'), [], ['b'], procs=2),
+             runPipeline.Task('c', timed('c'), [], ['c'], procs=1),
+             runPipeline.Task('big', timed('big'), [], ['big'], ['a'], procs=8)]
+    runPipeline.runTasks(tasks, 3, stampDir)
+    times = dict((name, eval(open(name).read())) for name in ['a', 'b', 'c', 'big'])
+    def overlap(x, y):
+        return times[x][0] < times[y][1] and times[y][0] < times[x][1]
+    # a and c fit in 3 processes, b has to wait for a
+    assert overlap('a', 'c')
+    assert not overlap('a', 'b')
+    # more than Ncpu runs on its own
+    assert not any(overlap('big', x) for x in ['a', 'b', 'c'])
+
+def test_season_pools_share_Ncpu():
+    class Args(object):
+        chunkSize = 100
+        lookAhead = 10
+        Ncpu = 8
+        fake = False
+    tasks = runPipeline.seasonTasks('s1.csv', Args(), 4)
+    assert [task.procs for task in tasks] == [4, 4]
+    assert tasks[0].cmd[-2:] == ['-n', '4']
+    assert tasks[1].cmd[tasks[1].cmd.index('-j') + 1] == '4'
+
+def test_fake_tools_only_when_asked():
+    class Args(object):
+        chunkSize = None
+        lookAhead = 10
+        fake = False
+    tasks = runPipeline.seasonTasks('s1.csv', Args(), 1)
+    assert all(task.env == {} for task in tasks)
+    Args.fake = True
+    env = runPipeline.seasonTasks('s1.csv', Args(), 1)[0].env
+    assert env['FAKE_BULK_DETECTIONS'] == os.path.abspath('s1.csv')
+    assert env['PATH'].split(os.pathsep)[0] == os.path.join(runPipeline.LINKER_DIR, 'fakebin')
+    assert env['PYTHON'] == sys.executable
@@ -0,0 +1,26 @@
+import subprocess
+import sys
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+import siftTriplets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_prefilter_without_catalog_keeps_chunk():
+    chunk = LL.TripletChunk([0, 1], [[1, 2, 3], [4, 5, 6]])
+    assert siftTriplets.prefilter(chunk, {}) is chunk
+
+def test_npz_needs_detections(tmpdir):
+    chunkFile = str(tmpdir.join('chunk000001+test.npz'))
+    LL.TripletChunk([0], [[1, 2, 3]]).save(chunkFile)
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'siftTriplets.py'), chunkFile],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=str(tmpdir))
+    out, err = proc.communicate()
+    assert proc.returncode == 2
+    assert b'-d/--detFile is needed' in err
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+from astropy.table import Table
+
+class FakeOrbit(object):
+    fits = []
+
+    def __init__(self, dates, ra, dec, obscode, err):
+        FakeOrbit.fits.append(list(dates))
+        self.chisq = float(len(dates))
+
+    def get_elements(self):
+        return {'a': 40.}, {'a': 1.}
+
+def makeTriplets():
+    rng = np.random.RandomState(6)
+    trips = []
+    for x in range(5):
+        trips.append(LL.Triplet([LL.Detection(rng.uniform(0, 10), rng.uniform(-10, 0),
+                57000.25 + 3*x + nite, 1000., 10*x + nite) for nite in range(3 + x % 2)]))
+    return trips
+
+def test_setOrbits_fits_each_triplet_once(monkeypatch):
+    monkeypatch.setattr(LL, 'Orbit', FakeOrbit)
+    monkeypatch.setattr(FakeOrbit, 'fits', [])
+    trips = makeTriplets()
+    done = LL.setOrbits(trips)
+    assert len(done) == len(trips)
+    assert len(FakeOrbit.fits) == len(trips)
+    # getChiSq takes the fitted orbit instead of fitting again
+    assert [trip.getChiSq() for trip in trips] == [float(len(trip.dets)) for trip in trips]
+    assert len(FakeOrbit.fits) == len(trips)
+    # and triplets that have an orbit are left alone
+    assert LL.setOrbits(trips) == []
+    assert len(FakeOrbit.fits) == len(trips)
+
+def test_setOrbits_dates_match_setOrbit(monkeypatch):
+    monkeypatch.setattr(LL, 'Orbit', FakeOrbit)
+    monkeypatch.setattr(FakeOrbit, 'fits', [])
+    LL._ephemDates.clear()
+    LL.setOrbits(makeTriplets())
+    together = list(FakeOrbit.fits)
+    FakeOrbit.fits[:] = []
+    LL._ephemDates.clear()
+    for trip in makeTriplets():
+        trip.setOrbit()
+    assert FakeOrbit.fits == together
+
+def test_saveElements_errs_are_the_covariance_diagonal():
+    trips = makeTriplets()[:3]
+    for x, trip in enumerate(trips):
+        trip.trackid = 70 + x
+    size = len(trips)
+    # every entry of the covariance is different, the diagonal holds squares
+    elcov = np.arange(size*36, dtype='f8').reshape(size, 6, 6) + 1000
+    diag = np.arange(size*6, dtype='f8').reshape(size, 6) + 1
+    for x in range(size):
+        elcov[x][np.diag_indices(6)] = diag[x]**2
+    table = Table([np.array([72, 70, 71]), np.array([1., 2., 3.]), np.array([3, 3, 3]),
+                   np.array([0, 0, 1], dtype='i4'), np.arange(size*6, dtype='f8').reshape(size, 6),
+                   elcov[[2, 0, 1]].reshape(size, 36), np.zeros((size, 6)), np.zeros((size, 36))],
+                  names=('ORBITID', 'CHISQ', 'DOF', 'FLAGS', 'ELEMENTS', 'ELCOV', 'ABG', 'ABGCOV'))
+    done = LL.saveElements(trips, table)
+    assert [trip.trackid for trip in done] == [72, 70, 71]
+    for trip in done[:2]:
+        # errs keeps the labels saveElements has always given the diagonal
+        got = [trip.errs[name] for name in ['a', 'e', 'i', 'lan', 'top', 'aop']]
+        np.testing.assert_array_equal(got, diag[trip.trackid - 70])
+    assert done[2].errs == 0
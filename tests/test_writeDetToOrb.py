@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+
+pytest.importorskip('GammaTPlotwStatTNOExFaster')
+pytest.importorskip('Orbit')
+import LinkerLib as LL
+
+# writeDetToOrb as it was before it took TrackRows, to compare the files with
+def loopWriteDetToOrb(trackIDs, outName):
+    ra_sum = 0
+    dec_sum = 0
+    mjd_sum = 0
+    num_dets = 0
+    for track in trackIDs.values():
+        for det in track:
+            ra_sum += det.ra
+            dec_sum += det.dec
+            mjd_sum += det.mjd
+            num_dets += 1
+    if(num_dets == 0):
+        return False
+    trackList = []
+    expList = []
+    raList = []
+    decList = []
+    errList = []
+    objList = []
+    for trackID in sorted(trackIDs.keys()):
+        for det in trackIDs[trackID]:
+            trackList.append(trackID)
+            expList.append(det.expnum)
+            raList.append(det.ra)
+            decList.append(det.dec)
+            if(det.posErr == 0):
+                errList.append(det.getPosErr()*3600)
+            else:
+                errList.append(det.posErr*3600)
+            objList.append(det.objid)
+    outTable = Table([trackList, expList, raList, decList, errList, objList],
+                names=('ORBITID', 'EXPNUM', 'RA', 'DEC', 'SIGMA', 'OBJID'),
+                dtype=('int64', 'i4', 'f8', 'f8', 'f8', 'i8'))
+    binTable = fits.BinTableHDU(outTable)
+    binTable.header['RA0'] = ra_sum / num_dets
+    binTable.header['DEC0'] = dec_sum / num_dets
+    binTable.header['MJD0'] = mjd_sum / num_dets
+    fits.HDUList([fits.PrimaryHDU(), binTable]).writeto(outName, overwrite=True)
+    return outName
+
+def makeDetections(n=40):
+    rng = np.random.RandomState(5)
+    dets = []
+    for i in range(n):
+        det = LL.Detection(rng.uniform(-180, 360), rng.uniform(-60, 10), 57000 + rng.uniform(0, 100),
+                rng.uniform(50, 5000), 10*i + 7, rng.randint(1000, 2000), 3, 'g', 0, 0)
+        det.posErr = 0 if i % 3 == 0 else rng.uniform(1e-6, 1e-4)
+        dets.append(det)
+    return dets
+
+def makeTracks(dets):
+    # trackids not in order, as a dictionary may have them
+    trackIDs = {}
+    for x, trackid in enumerate([12, 3, 40, 7, 5, 30, 1, 9]):
+        trackIDs[trackid] = dets[5*x:5*x+5:2] if x % 2 else dets[5*x:5*x+5]
+    return trackIDs
+
+def assertSameFile(name, expected):
+    with fits.open(name) as new, fits.open(expected) as old:
+        for key in ['RA0', 'DEC0', 'MJD0']:
+            assert new[1].header[key] == old[1].header[key], key
+        assert new[1].columns.names == old[1].columns.names
+        for column in old[1].columns:
+            assert new[1].columns[column.name].format == column.format
+            np.testing.assert_array_equal(new[1].data[column.name], old[1].data[column.name],
+                    err_msg=column.name)
+
+def test_plain_detections(tmpdir):
+    trackIDs = makeTracks(makeDetections())
+    expected = loopWriteDetToOrb(makeTracks(makeDetections()), str(tmpdir.join('old.fits')))
+    assertSameFile(LL.writeDetToOrb(trackIDs, str(tmpdir.join('new.fits'))), expected)
+
+def test_catalog_detections(tmpdir):
+    catalog = LL.DetectionCatalog.fromDetections(makeDetections())
+    trackIDs = makeTracks(catalog.rows(np.arange(len(catalog))))
+    expected = loopWriteDetToOrb(trackIDs, str(tmpdir.join('old.fits')))
+    assertSameFile(LL.writeDetToOrb(trackIDs, str(tmpdir.join('new.fits'))), expected)
+    tracks = LL.TrackRows.fromDict(trackIDs)
+    del tracks[40]
+    del trackIDs[40]
+    expected = loopWriteDetToOrb(trackIDs, str(tmpdir.join('old.fits')))
+    assertSameFile(LL.writeDetToOrb(tracks, str(tmpdir.join('new.fits'))), expected)
+
+def test_nothing_to_fit(tmpdir):
+    assert LL.writeDetToOrb({}, str(tmpdir.join('new.fits'))) is False
+    assert LL.writeDetToOrb({1: []}, str(tmpdir.join('new.fits'))) is False